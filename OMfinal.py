@@ -1,25 +1,41 @@
-import sqlite3
-import openmeteo_requests
-import requests_cache
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+import numpy as np
 import pandas as pd
-from retry_requests import retry
 
-cache_session = requests_cache.CachedSession('.cache', expire_after=3600)
-retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
-openmeteo = openmeteo_requests.Client(session=retry_session)
+from city_catalog import DEFAULT_CATALOG, load_cities, setup_city_catalog, weather_locations
+from climate_store import DEFAULT_STORE_DIR, ClimateStore
+from db import get_connection, transaction
+import instrumentation
+from instrumentation import span, timed
 
-#city details with state, zip_code, latitude, and longitude
-city_details = {
-    "phoenix": {"state": "az", "zip_code": "85001", "latitude": 33.4484, "longitude": -112.0740},
-    "seattle": {"state": "wa", "zip_code": "98101", "latitude": 47.6062, "longitude": -122.3321},
-    "minneapolis": {"state": "mn", "zip_code": "55401", "latitude": 44.9778, "longitude": -93.2650},
-    "miami": {"state": "fl", "zip_code": "33101", "latitude": 25.7617, "longitude": -80.1918},
-    "aurora": {"state": "co", "zip_code": "80019", "latitude": 39.7392, "longitude": -104.9903},  # Aurora coordinates as per your requirement
-}
+# the http cache and the api client are built on first use, importing this module only
+# to set up tables or read constants does not open .cache.sqlite or load the clients
+_cache_session = None
+_openmeteo = None
 
+def get_cache_session():
+    global _cache_session
+    if _cache_session is None:
+        import requests_cache
+        _cache_session = instrumentation.instrument_session(requests_cache.CachedSession('.cache', expire_after=3600),
+                                                            cached=True)
+    return _cache_session
 
+def get_client():
+    global _openmeteo
+    if _openmeteo is None:
+        import openmeteo_requests
+        from retry_requests import retry
+        _openmeteo = openmeteo_requests.Client(session=retry(get_cache_session(), retries=5, backoff_factor=0.2))
+    return _openmeteo
+
+
+@timed
 def initialize_db():
-    conn = sqlite3.connect('unified_data.db')
+    conn = get_connection()
     c = conn.cursor()
 
     # Create the cities table if it does not exist
@@ -45,10 +61,12 @@ def initialize_db():
             relative_humidity_2m REAL,
             windspeed_10m REAL,
             precipitation REAL,
+            sampling TEXT NOT NULL DEFAULT 'noon',
             FOREIGN KEY (city_id) REFERENCES cities(id),
             UNIQUE(city_id, date)
         )
     ''')
+    setup_climate_sampling(conn)
 
     # Create the city_averages table if it does not exist
     c.execute('''
@@ -61,124 +79,349 @@ def initialize_db():
             FOREIGN KEY (city_id) REFERENCES cities(id)
         )
     ''')
+    setup_city_catalog(conn)
 
-    conn.commit()
-    conn.close()
+# what a row of hourly_climate holds: the 12:00 UTC hourly sample ('noon') or the api's
+# daily aggregates ('daily'). the two measure different things, so a city keeps the kind
+# its first rows were stored with. tables from before the daily mode hold noon samples
+SAMPLINGS = ('noon', 'daily')
 
-def get_city_id(city_name, state, zip_code):
-    conn = sqlite3.connect('unified_data.db')
-    c = conn.cursor()
+def setup_climate_sampling(conn):
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(hourly_climate)')]
+    if 'sampling' in columns:
+        return
+    with transaction(conn):
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(hourly_climate)')]
+        if 'sampling' not in columns:
+            conn.execute("ALTER TABLE hourly_climate ADD COLUMN sampling TEXT NOT NULL DEFAULT 'noon'")
+
+# the sampling of a city's stored rows, None before it has any
+def stored_sampling(city_id, conn=None):
+    c = (conn or get_connection()).cursor()
+    c.execute('SELECT sampling FROM hourly_climate WHERE city_id = ? LIMIT 1', (city_id,))
+    row = c.fetchone()
+    return row[0] if row else None
+
+def get_city_id(city_name, state, zip_code, conn=None):
+    c = (conn or get_connection()).cursor()
     c.execute('SELECT id FROM cities WHERE city = ? AND state = ? AND zip_code = ?', (city_name, state, zip_code))
     result = c.fetchone()
-    conn.close()
     if result:
         return result[0]
     else:
         print(f"City not found: {city_name}, {state}, {zip_code}")
         return None
 
-def insert_data_to_db(city_id, data, rows_needed):
-    conn = sqlite3.connect('unified_data.db')
-    c = conn.cursor()
-    rows_inserted = 0
-
-    for row in data.itertuples(index=False):
-        if rows_inserted >= rows_needed:
-            break
-        try:
-            c.execute('''
-                INSERT INTO hourly_climate (city_id, date, temperature_2m, relative_humidity_2m, windspeed_10m, precipitation)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (city_id, row.date, row.temperature_2m, row.relative_humidity_2m, row.windspeed_10m, row.precipitation))
-            rows_inserted += 1
-        except sqlite3.IntegrityError:
-            continue
+CLIMATE_COLUMNS = ['date', 'temperature_2m', 'relative_humidity_2m', 'windspeed_10m', 'precipitation']
 
-    conn.commit()
-    conn.close()
-    return rows_inserted
-
-# fetch data from the API
-def fetch_weather_data(latitude, longitude):
-    url = "https://archive-api.open-meteo.com/v1/archive"
-    params = {
-        "latitude": latitude,
-        "longitude": longitude,
-        "start_date": "2018-01-01",
-        "end_date": "2024-12-03",
-        "hourly": "temperature_2m,relative_humidity_2m,windspeed_10m,precipitation"
-    }
-    
-    responses = openmeteo.weather_api(url, params=params)
-    response = responses[0]
-    hourly = response.Hourly()
-    hourly_temperature_2m = hourly.Variables(0).ValuesAsNumpy()
-    hourly_humidity = hourly.Variables(1).ValuesAsNumpy()
-    hourly_wind_speed = hourly.Variables(2).ValuesAsNumpy()
-    hourly_precipitation = hourly.Variables(3).ValuesAsNumpy()
-
-    min_len = min(len(hourly_temperature_2m), len(hourly_humidity), len(hourly_wind_speed), len(hourly_precipitation))
-    time_range = pd.date_range(
-        start=pd.to_datetime(hourly.Time(), unit="s", utc=True),
-        periods=min_len,
-        freq=pd.Timedelta(seconds=hourly.Interval())
-    )
+# bulk insert of one city's rows: the frame is staged in a temp table and anti-joined
+# against the stored dates, so duplicates are dropped in one statement instead of one
+# IntegrityError per row. rows_needed=None inserts every new date, sampling is one of
+# SAMPLINGS. returns (rows inserted, rows skipped because the date was already stored).
+# pass a connection to batch several cities into the caller's transaction
+@timed
+def insert_data_to_db(city_id, data, rows_needed, conn=None, sampling='noon'):
+    with transaction(conn) as conn:
+        c = conn.cursor()
+
+        c.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS incoming_climate (
+                date TEXT PRIMARY KEY,
+                temperature_2m REAL,
+                relative_humidity_2m REAL,
+                windspeed_10m REAL,
+                precipitation REAL
+            )
+        ''')
+        c.execute('DELETE FROM incoming_climate')
+        c.executemany('''
+            INSERT OR IGNORE INTO incoming_climate (date, temperature_2m, relative_humidity_2m, windspeed_10m, precipitation)
+            VALUES (?, ?, ?, ?, ?)
+        ''', data[CLIMATE_COLUMNS].itertuples(index=False, name=None))
 
+        c.execute('''
+            SELECT COUNT(*) FROM incoming_climate i
+            WHERE EXISTS (SELECT 1 FROM hourly_climate h WHERE h.city_id = ? AND h.date = i.date)
+        ''', (city_id,))
+        rows_skipped = c.fetchone()[0]
 
+        c.execute('''
+            INSERT INTO hourly_climate (city_id, date, temperature_2m, relative_humidity_2m, windspeed_10m, precipitation,
+                                        sampling)
+            SELECT ?, i.date, i.temperature_2m, i.relative_humidity_2m, i.windspeed_10m, i.precipitation, ?
+            FROM incoming_climate i
+            WHERE NOT EXISTS (SELECT 1 FROM hourly_climate h WHERE h.city_id = ? AND h.date = i.date)
+            ORDER BY i.date
+            LIMIT ?
+        ''', (city_id, sampling, city_id, -1 if rows_needed is None else rows_needed))
+        rows_inserted = c.rowcount
+        c.execute('DELETE FROM incoming_climate')
+    return rows_inserted, rows_skipped
+
+# point this at openmeteo_stub.py to run against recorded responses
+ARCHIVE_URL = os.environ.get('OPEN_METEO_ARCHIVE_URL', "https://archive-api.open-meteo.com/v1/archive")
+START_DATE = date(2018, 1, 1)
+END_DATE = date(2024, 12, 3)
+HOURLY_VARIABLES = ["temperature_2m", "relative_humidity_2m", "windspeed_10m", "precipitation"]
+# daily aggregates stored in the same columns. precipitation_sum is divided by 24 so it
+# stays in mm per hour like the hourly samples
+DAILY_VARIABLES = ["temperature_2m_mean", "relative_humidity_2m_mean", "wind_speed_10m_mean", "precipitation_sum"]
+# the archive keeps revising the last few days, anything older than this is final and
+# its responses are cached forever
+ARCHIVE_SETTLE_DAYS = 7
+OPEN_CHUNK_EXPIRE = 3600
+# locations per multi-location request, and threads decoding the responses
+BATCH_SIZE = 50
+DECODE_WORKERS = 4
+
+# splits start..end into calendar month requests. every chunk starts on the 1st so a
+# month is always requested (and cached) under the same url no matter where a city's
+# window begins; rows before `start` are dropped after decoding
+def month_chunks(start, end):
+    chunks = []
+    if start > end:
+        return chunks
+    chunk_start = start.replace(day=1)
+    while chunk_start <= end:
+        chunks.append((chunk_start, min(month_end(chunk_start), end)))
+        chunk_start = month_end(chunk_start) + timedelta(days=1)
+    return chunks
+
+def month_end(day):
+    return (day.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+
+def chunk_expire_after(chunk_end, today=None):
+    from requests_cache import NEVER_EXPIRE
+
+    today = today or date.today()
+    if chunk_end <= today - timedelta(days=ARCHIVE_SETTLE_DAYS):
+        return NEVER_EXPIRE
+    return OPEN_CHUNK_EXPIRE
+
+# the day after the latest date already stored for a city, or START_DATE
+def next_window_start(city_id, conn=None):
+    c = (conn or get_connection()).cursor()
+    c.execute('SELECT MAX(date) FROM hourly_climate WHERE city_id = ?', (city_id,))
+    latest = c.fetchone()[0]
+    if latest is None:
+        return START_DATE
+    return date.fromisoformat(latest[:10]) + timedelta(days=1)
+
+# decodes one location's response into plain arrays: unix times and one array per
+# column of HOURLY_VARIABLES. hourly responses are cut down to the 12:00 UTC sample of
+# each day before anything else is built, unless all_hours is set
+def _decode(job):
+    city_id, response, daily, all_hours = job
+    block = response.Daily() if daily else response.Hourly()
+    variables = DAILY_VARIABLES if daily else HOURLY_VARIABLES
+    values = [block.Variables(i).ValuesAsNumpy() for i in range(len(variables))]
+
+    min_len = min(len(v) for v in values)
+    times = block.Time() + np.arange(min_len, dtype=np.int64) * block.Interval()
+    if daily:
+        keep = slice(None)
+        values[3] = values[3] / 24
+    elif all_hours:
+        keep = slice(None)
+    else:
+        # filter to get one hour per day
+        keep = (times % 86400) // 3600 == 12
+    return city_id, times[keep], [v[:min_len][keep] for v in values]
+
+# fetch data from the API for many cities at once. locations is a list of
+# (city_id, latitude, longitude, start_date), optionally with a last_date; every city
+# is fetched from its own start date up to the month holding its last_date, or up to
+# end_date. each month is one request per BATCH_SIZE cities (the api takes comma
+# separated coordinates and answers with one response per location, in order) and the
+# responses are decoded on a thread pool into one long frame keyed by city_id.
+# hourly mode keeps the 12:00 UTC sample per day (every hour with all_hours=True, for
+# the climate store); daily=True asks the api for daily aggregates instead, which is
+# 1/24th of the payload. cells, the (city_id, latitude, longitude) of every weather
+# cell, fixes the batches; without it the batches are made of the locations
+@timed
+def fetch_weather_batch(locations, end_date=END_DATE, daily=False, batch_size=BATCH_SIZE, workers=DECODE_WORKERS,
+                        all_hours=False, cells=None):
+    locations = sorted((l for l in locations if l[3] <= end_date), key=lambda l: (l[0] is None, l[0]))
+    if not locations:
+        return pd.DataFrame(columns=['city_id', 'time'] + HOURLY_VARIABLES + ['date', 'hour'])
+    earliest = min(l[3] for l in locations)
+    last = {l[0]: min(l[4], end_date) if len(l) > 4 else end_date for l in locations}
+    openmeteo = get_client()
+
+    # fixed batches of the whole roster by id, so a month is always asked for with the
+    # same coordinates (and found in the cache) whichever of the cells are behind
+    roster = sorted(list(cells or []) + [l[:3] for l in locations if l[0] not in {c[0] for c in cells or []}],
+                    key=lambda l: (l[0] is None, l[0]))
+    batches = [roster[i:i + batch_size] for i in range(0, len(roster), batch_size)]
+
+    jobs = []
+    for chunk_start, chunk_end in month_chunks(earliest, max(last.values())):
+        wanted = {l[0] for l in locations if l[3] <= chunk_end and last[l[0]] >= chunk_start}
+        for batch in batches:
+            if not any(l[0] in wanted for l in batch):
+                continue
+            params = {
+                "latitude": ",".join(str(l[1]) for l in batch),
+                "longitude": ",".join(str(l[2]) for l in batch),
+                "start_date": chunk_start.isoformat(),
+                "end_date": chunk_end.isoformat(),
+            }
+            if daily:
+                params["daily"] = ",".join(DAILY_VARIABLES)
+            else:
+                params["hourly"] = ",".join(HOURLY_VARIABLES)
+
+            with span('open_meteo_request', locations=len(batch), month=chunk_start.isoformat()):
+                responses = openmeteo.weather_api(ARCHIVE_URL, params=params, expire_after=chunk_expire_after(chunk_end))
+            # responses for cells that do not need this month are dropped undecoded
+            jobs.extend((l[0], response, daily, all_hours) for l, response in zip(batch, responses) if l[0] in wanted)
+
+    with span('open_meteo_decode', responses=len(jobs)), ThreadPoolExecutor(max_workers=workers) as executor:
+        decoded = list(executor.map(_decode, jobs))
+
+    # one frame for every city, built from the concatenated arrays
+    times = np.concatenate([t for _, t, _ in decoded])
     df = pd.DataFrame({
-        'time': time_range,
-        'temperature_2m': hourly_temperature_2m,
-        'relative_humidity_2m': hourly_humidity,
-        'windspeed_10m': hourly_wind_speed,
-        'precipitation': hourly_precipitation
+        'city_id': np.repeat([city_id for city_id, _, _ in decoded], [len(t) for _, t, _ in decoded]),
+        'time': pd.to_datetime(times, unit='s', utc=True),
     })
-
-    # filter to get one hour per day
+    for i, name in enumerate(HOURLY_VARIABLES):
+        df[name] = np.concatenate([v[i] for _, _, v in decoded])
     df['date'] = df['time'].dt.date
     df['hour'] = df['time'].dt.hour
-    df_filtered = df[df['hour'] == 12]
 
-    df_filtered = df_filtered.reset_index(drop=True)
+    # drop the days before each city's own window start
+    starts = {l[0]: l[3] for l in locations}
+    city_start = df['city_id'].map(starts)
+    df = df[(df['date'] >= city_start) & (df['date'] <= end_date)]
+    return df.reset_index(drop=True)
+
+# single location version of fetch_weather_batch
+def fetch_weather_data(latitude, longitude, start_date=START_DATE, end_date=END_DATE, daily=False):
+    df = fetch_weather_batch([(0, latitude, longitude, start_date)], end_date, daily)
+    df_filtered = df.drop(columns='city_id')
     return df_filtered
 
+# the cells whose climate store partitions miss a year of START_DATE..END_DATE, as
+# locations starting at the first missing year. this goes by what the store holds, not
+# by hourly_climate's latest date, so cells loaded before the store existed get filled
+def store_gaps(store, cells):
+    years = range(START_DATE.year, END_DATE.year + 1)
+    gaps = []
+    for city_id, latitude, longitude in cells:
+        stored = set(store.years(city_id))
+        missing = [year for year in years if year not in stored]
+        if missing:
+            gaps.append((city_id, latitude, longitude, max(START_DATE, date(missing[0], 1, 1))))
+    return gaps
+
+# fetches every hour of the missing store years, BATCH_SIZE cells at a time so only one
+# batch of full hourly history is in memory. writes to the store only
+def backfill_store(store_dir, cells):
+    store = ClimateStore(store_dir)
+    gaps = store_gaps(store, cells)
+    hours_stored = 0
+    for i in range(0, len(gaps), BATCH_SIZE):
+        hours_stored += store.write_frame(fetch_weather_batch(gaps[i:i + BATCH_SIZE], END_DATE, all_hours=True,
+                                                              cells=cells))
+    print(f"Backfilled {hours_stored} hourly values per variable for {len(gaps)} cells in {store_dir}.")
+
 # Main function 
-def main():
+# backfill=True lifts the per run row cap so a new city loads its whole history at once.
+# store_dir also writes every fetched hour to the columnar climate store there, while
+# hourly_climate keeps its 12:00 sample. store_backfill=True first fills the store's
+# missing years for every cell, whatever hourly_climate already holds
+def main(backfill=False, daily=False, store_dir=None, catalog=DEFAULT_CATALOG, store_backfill=False):
     initialize_db()
+    load_cities(catalog)
     
     total_rows_inserted = 0
+    total_rows_skipped = 0
     max_total_rows_per_run = 15
-    rows_per_city = max_total_rows_per_run // len(city_details)
 
-    for city_name, details in city_details.items():
-        latitude = details['latitude']
-        longitude = details['longitude']
-        state = details['state']
-        zip_code = details['zip_code']
+    conn = get_connection()
+    c = conn.cursor()
+
+    # one series per weather grid cell, stored under the cell's first city and read
+    # through cities.weather_city_id by the others
+    cells = weather_locations(conn)
+    if store_backfill:
+        backfill_store(store_dir or DEFAULT_STORE_DIR, cells)
+    c.execute('SELECT city_id, COUNT(*) FROM hourly_climate GROUP BY city_id')
+    existing_row_counts = dict(c.fetchall())
 
-        city_id = get_city_id(city_name, state, zip_code)
-        if city_id is None:
-            print(f"Skipping city: {city_name}, {state}, {zip_code} because it was not found in the database.")
+    # a cell is only extended with the kind of rows it already holds
+    sampling = 'daily' if daily else 'noon'
+    pending = []
+    other_sampling = 0
+    for city_id, latitude, longitude in cells:
+        if stored_sampling(city_id, conn) not in (None, sampling):
+            other_sampling += 1
             continue
+        # only ask for the dates after what is already stored
+        start_date = next_window_start(city_id, conn)
+        if start_date <= END_DATE:
+            pending.append((city_id, latitude, longitude, start_date))
+    if other_sampling:
+        print(f"Skipping {other_sampling} cells stored with {'noon samples' if daily else 'daily aggregates'}, "
+              f"run {'without' if daily else 'with'} --daily to extend them.")
 
-        conn = sqlite3.connect('unified_data.db')
-        c = conn.cursor()
-        c.execute('SELECT COUNT(*) FROM hourly_climate WHERE city_id = ?', (city_id,))
-        existing_row_count = c.fetchone()[0]
-        conn.close()
-
-        if existing_row_count < 20:
-            start_offset = existing_row_count
-            df = fetch_weather_data(latitude, longitude, start_offset)
-            df['date'] = df['date'].astype(str)
-            rows_needed = min(rows_per_city, 100 - existing_row_count)
-            rows_inserted = insert_data_to_db(city_id, df, rows_needed)
-            total_rows_inserted += rows_inserted
-        else:
-            start_offset = existing_row_count
-            df = fetch_weather_data(latitude, longitude, start_offset)
-            df['date'] = df['date'].astype(str)
-            rows_inserted = insert_data_to_db(city_id, df, len(df))
+    rows_needed = {}
+    last_dates = {}
+    if backfill:
+        rows_needed = {l[0]: None for l in pending}
+    else:
+        # cells still filling up share the per run budget, at least one row each. with
+        # more of them than the budget has rows, the emptiest cells go first and the
+        # others wait for a later run, so the budget rotates over a large catalog
+        filling = sorted((l for l in pending if existing_row_counts.get(l[0], 0) < 20),
+                         key=lambda l: (existing_row_counts.get(l[0], 0), l[0]))[:max_total_rows_per_run]
+        rows_per_city = max_total_rows_per_run // max(len(filling), 1)
+        for l in filling:
+            rows_needed[l[0]] = min(rows_per_city, 100 - existing_row_counts.get(l[0], 0))
+            # one row per day, so only the months holding the next rows_needed days are fetched
+            last_dates[l[0]] = month_end(l[3] + timedelta(days=rows_needed[l[0]] - 1))
+        # cells with a history take every new date
+        for l in pending:
+            if existing_row_counts.get(l[0], 0) >= 20:
+                rows_needed[l[0]] = None
+    locations = [l + (last_dates[l[0]],) if l[0] in last_dates else l for l in pending if l[0] in rows_needed]
+
+    # every city in a few multi-location requests
+    weather = fetch_weather_batch(locations, END_DATE, daily, all_hours=store_dir is not None, cells=cells)
+    if store_dir is not None:
+        hours_stored = ClimateStore(store_dir).write_frame(weather)
+        print(f"Wrote {hours_stored} hourly values per variable to {store_dir}.")
+        weather = weather[weather['hour'] == 12].reset_index(drop=True)
+    weather['date'] = weather['date'].astype(str)
+
+    # one transaction for every city's rows
+    with transaction(conn):
+        for city_id, df in weather.groupby('city_id', sort=False):
+            rows_inserted, rows_skipped = insert_data_to_db(city_id, df, rows_needed[city_id], conn, sampling)
             total_rows_inserted += rows_inserted
+            total_rows_skipped += rows_skipped
+
+    print(f"Inserted {total_rows_inserted} rows, skipped {total_rows_skipped} already stored.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Load Open-Meteo weather history into unified_data.db")
+    parser.add_argument('--backfill', action='store_true',
+                        help="load every missing date instead of the small per run quota")
+    parser.add_argument('--daily', action='store_true',
+                        help="store daily aggregates from the api instead of the 12:00 hourly sample "
+                             "(cities already stored with the other kind are skipped)")
+    parser.add_argument('--climate-store', nargs='?', const=DEFAULT_STORE_DIR, metavar='DIR',
+                        help=f"also keep every hour in the columnar climate store (default {DEFAULT_STORE_DIR})")
+    parser.add_argument('--store-backfill', action='store_true',
+                        help="fetch every hour of the years missing from the climate store, for cities "
+                             "loaded before it existed (implies --climate-store)")
+    parser.add_argument('--catalog', default=DEFAULT_CATALOG, help="csv of cities to load before fetching")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    if args.store_backfill and not args.climate_store:
+        args.climate_store = DEFAULT_STORE_DIR
+    if args.daily and args.climate_store:
+        parser.error("--climate-store needs hourly data, it can not be combined with --daily")
+    with instrumentation.session(args.metrics, args.profile):
+        main(args.backfill, args.daily, args.climate_store, args.catalog, args.store_backfill)
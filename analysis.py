@@ -1,6 +1,19 @@
-import sqlite3
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
 import matplotlib.pyplot as plt
 import pandas as pd
+from matplotlib.figure import Figure
+from matplotlib.lines import Line2D
+
+from city_catalog import setup_city_catalog
+from climate_aggregates import get_climate_aggregates
+from climate_store import ClimateStore
+from db import get_connection
+import instrumentation
+from instrumentation import timed
 
 
 def normalize_city_names(df, column):
@@ -12,11 +25,16 @@ def map_city_names(df, column):
     df[column] = df[column].replace("aurora", "denver")
     return df
 
-# Fetch combined depreciation and weather data from the unified database
-def fetch_combined_data(db_path):
-    conn = sqlite3.connect(db_path)
+# Fetch combined depreciation and weather data from the unified database. with
+# store_dir the weather averages come from every hour in the columnar climate store
+@timed
+def fetch_combined_data(db_path, store_dir=None):
+    conn = get_connection(db_path)
+    setup_city_catalog(conn)
     query = '''
-    SELECT c.city, 
+    SELECT c.id as city_id,
+           COALESCE(c.weather_city_id, c.id) as weather_city_id,
+           c.city, 
            c.state, 
            avg.average_temperature_2m as avg_temp,
            avg.average_relative_humidity_2m as avg_humidity,
@@ -26,82 +44,168 @@ def fetch_combined_data(db_path):
            dep.avg_new_price,
            dep.avg_old_price
     FROM car_depreciation dep
-    JOIN city_averages avg ON dep.city_id = avg.city_id
     JOIN cities c ON dep.city_id = c.id
+    JOIN city_averages avg ON avg.city_id = COALESCE(c.weather_city_id, c.id)
     '''
     combined_df = pd.read_sql_query(query, conn)
-    conn.close()
+    if store_dir:
+        combined_df = apply_store_averages(combined_df, store_dir)
+    combined_df = combined_df.drop(columns=['city_id', 'weather_city_id'])
     combined_df = normalize_city_names(combined_df, 'city')
     combined_df = map_city_names(combined_df, 'city')
     print("Combined Data:")
     print(combined_df)
     return combined_df
 
+# depreciation per city next to one climate window's aggregates, e.g. window='season'
+# with metrics=['freeze_days'] gives every city's freeze days per winter. the aggregates
+# are refreshed from hourly_climate first, which only recomputes periods with new dates
+@timed
+def fetch_window_data(db_path, window, metrics=None):
+    conn = get_connection(db_path)
+    setup_city_catalog(conn)
+    aggregates = get_climate_aggregates(window, metrics, conn=conn)
+    query = '''
+    SELECT c.id as city_id, COALESCE(c.weather_city_id, c.id) as weather_city_id, c.city, c.state, dep.depreciation
+    FROM car_depreciation dep
+    JOIN cities c ON dep.city_id = c.id
+    '''
+    cities_df = pd.read_sql_query(query, conn)
+    # aggregates are stored once per weather grid cell
+    aggregates = aggregates.rename(columns={'city_id': 'weather_city_id'})
+    window_df = cities_df.merge(aggregates, on='weather_city_id').drop(columns='weather_city_id')
+    window_df = normalize_city_names(window_df, 'city')
+    window_df = map_city_names(window_df, 'city')
+    return window_df
+
+STORE_COLUMNS = {
+    'avg_temp': 'temperature_2m',
+    'avg_humidity': 'relative_humidity_2m',
+    'avg_windspeed': 'windspeed_10m',
+    'avg_precip': 'precipitation',
+}
+
+@timed
+def apply_store_averages(combined_df, store_dir):
+    weather_ids = list(combined_df['weather_city_id'].unique())
+    means = ClimateStore(store_dir).city_means(list(STORE_COLUMNS.values()), [int(i) for i in weather_ids])
+    means = pd.DataFrame.from_dict(means, orient='index')
+    for column, variable in STORE_COLUMNS.items():
+        if variable in means:
+            store_values = combined_df['weather_city_id'].map(means[variable])
+            combined_df[column] = store_values.fillna(combined_df[column])
+    return combined_df
+
+# title and x axis label of every metric that can be plotted against depreciation
+METRICS = {
+    'avg_temp': ('Temperature vs Car Depreciation', 'Average Daily Temperature (°C)'),
+    'avg_humidity': ('Humidity vs Car Depreciation', 'Average Daily Humidity (%)'),
+    'avg_windspeed': ('Windspeed vs Car Depreciation', 'Average Daily Windspeed (m/s)'),
+    'avg_precip': ('Precipitation vs Car Depreciation', 'Average Daily Precipitation (mm)'),
+}
+DEFAULT_METRICS = ['avg_temp', 'avg_humidity', 'avg_precip']
+# the y axis always covers at least this range so charts stay comparable between runs
+DEPRECIATION_YLIM = (35, 52)
+# above this many cities points are no longer labelled and there is no legend
+LABEL_LIMIT = 30
+
+# one color per city, from a qualitative colormap while that has enough colors
+def city_colors(cities):
+    cmap = plt.get_cmap('tab10' if len(cities) <= 10 else 'tab20' if len(cities) <= 20 else 'viridis')
+    if len(cities) <= 20:
+        return {city: cmap(i) for i, city in enumerate(cities)}
+    return {city: cmap(i / (len(cities) - 1)) for i, city in enumerate(cities)}
+
+# one scatter call for every city of a metric
+def draw_metric(ax, merged_df, column, colors):
+    title, xlabel = METRICS[column]
+    ax.scatter(merged_df[column], merged_df['depreciation'], c=[colors[city] for city in merged_df['city']])
+    if merged_df['city'].nunique() <= LABEL_LIMIT:
+        for city, x, y in zip(merged_df['city'], merged_df[column], merged_df['depreciation']):
+            ax.annotate(city.title(), (x, y), textcoords="offset points", xytext=(0,10), ha='center')
+        handles = [Line2D([], [], marker='o', linestyle='', color=color, label=city.title())
+                   for city, color in colors.items()]
+        ax.legend(handles=handles)
+
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel('Average Depreciation (%)')
+    low, high = merged_df['depreciation'].min(), merged_df['depreciation'].max()
+    ax.set_ylim(min(DEPRECIATION_YLIM[0], low - 1), max(DEPRECIATION_YLIM[1], high + 1))
+
 # Plot the data
-def plot_data(merged_df):
-    plt.figure(figsize=(18, 6))
-
-    colors = ['blue', 'green', 'red', 'purple', 'orange']
-    city_colors = dict(zip(merged_df['city'].unique(), colors))
-
-    # Scatter plot for temperature vs depreciation
-    plt.subplot(1, 3, 1)
-    for city, color in city_colors.items():
-        city_data = merged_df[merged_df['city'] == city]
-        plt.scatter(city_data['avg_temp'], city_data['depreciation'], color=color, label=city.title())
-        for i in range(len(city_data)):
-            plt.annotate(city_data['city'].values[i].title(), 
-                         (city_data['avg_temp'].values[i], city_data['depreciation'].values[i]), 
-                         textcoords="offset points", xytext=(0,10), ha='center')
-
-    plt.title('Temperature vs Car Depreciation')
-    plt.xlabel('Average Daily Temperature (°C)')
-    plt.ylabel('Average Depreciation (%)')
-    plt.ylim(35, 52)
-    plt.legend()
-
-    # Scatter plot for humidity vs depreciation
-    plt.subplot(1, 3, 2)
-    for city, color in city_colors.items():
-        city_data = merged_df[merged_df['city'] == city]
-        plt.scatter(city_data['avg_humidity'], city_data['depreciation'], color=color, label=city.title())
-        for i in range(len(city_data)):
-            plt.annotate(city_data['city'].values[i].title(), 
-                         (city_data['avg_humidity'].values[i], city_data['depreciation'].values[i]), 
-                         textcoords="offset points", xytext=(0,10), ha='center')
-    
-    plt.title('Humidity vs Car Depreciation')
-    plt.xlabel('Average Daily Humidity (%)')
-    plt.ylabel('Average Depreciation (%)')
-    plt.ylim(35, 52)
-    plt.legend()
-
-    # Scatter plot for precipitation vs depreciation
-    plt.subplot(1, 3, 3)
-    for city, color in city_colors.items():
-        city_data = merged_df[merged_df['city'] == city]
-        plt.scatter(city_data['avg_precip'], city_data['depreciation'], color=color, label=city.title())
-        for i in range(len(city_data)):
-            plt.annotate(city_data['city'].values[i].title(), 
-                         (city_data['avg_precip'].values[i], city_data['depreciation'].values[i]), 
-                         textcoords="offset points", xytext=(0,10), ha='center')
-    
-    plt.title('Precipitation vs Car Depreciation')
-    plt.xlabel('Average Daily Precipitation (mm)')
-    plt.ylabel('Average Depreciation (%)')
-    plt.ylim(35, 52)
-    plt.legend()
-
-    plt.tight_layout()
+@timed
+def plot_data(merged_df, metrics=DEFAULT_METRICS):
+    colors = city_colors(list(merged_df['city'].unique()))
+    fig, axes = plt.subplots(1, len(metrics), figsize=(6 * len(metrics), 6), squeeze=False)
+    for ax, column in zip(axes[0], metrics):
+        draw_metric(ax, merged_df, column, colors)
+
+    fig.tight_layout()
     plt.show()
 
-
-def main():
+# draws one figure without pyplot, so it needs no display and no global state and can
+# run in any process. job is (merged_df, metrics, colors, base path, formats)
+def _render_figure(job):
+    merged_df, metrics, colors, base_path, formats = job
+    fig = Figure(figsize=(6 * len(metrics), 6))
+    axes = fig.subplots(1, len(metrics), squeeze=False)
+    for ax, column in zip(axes[0], metrics):
+        draw_metric(ax, merged_df, column, colors)
+    fig.tight_layout()
+    paths = []
+    for fmt in formats:
+        paths.append(f"{base_path}.{fmt}")
+        fig.savefig(paths[-1], format=fmt)
+    return paths
+
+# headless version of plot_data for batch hosts: writes an overview figure with every
+# metric plus one figure per metric into output_dir, rendering the figures in
+# parallel worker processes. returns the written paths
+@timed
+def render_charts(merged_df, output_dir='charts', metrics=DEFAULT_METRICS, formats=('png',), workers=None):
+    os.makedirs(output_dir, exist_ok=True)
+    colors = city_colors(list(merged_df['city'].unique()))
+    jobs = [(merged_df, metrics, colors, os.path.join(output_dir, 'overview'), formats)]
+    jobs += [(merged_df, [column], colors, os.path.join(output_dir, column), formats) for column in metrics]
+
+    workers = workers or min(len(jobs), os.cpu_count() or 1)
+    if workers <= 1:
+        return [path for job in jobs for path in _render_figure(job)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return [path for paths in executor.map(_render_figure, jobs) for path in paths]
+
+
+def main(store_dir=None, headless=False, output_dir='charts', formats=('png',), metrics=DEFAULT_METRICS, workers=None):
     db_path = 'unified_data.db'
 
-    combined_df = fetch_combined_data(db_path)
+    combined_df = fetch_combined_data(db_path, store_dir)
 
-    plot_data(combined_df)
+    if headless:
+        for path in render_charts(combined_df, output_dir, metrics, formats, workers):
+            print(f"Wrote {path}")
+    else:
+        plot_data(combined_df, metrics)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Plot climate against car depreciation per city")
+    parser.add_argument('--climate-store', nargs='?', const='climate_store', metavar='DIR',
+                        help="use weather averages over every hour in the columnar climate store")
+    parser.add_argument('--headless', action='store_true',
+                        help="write chart files with the Agg backend instead of opening a window")
+    parser.add_argument('--output-dir', default='charts', help="where --headless writes the charts")
+    parser.add_argument('--format', dest='formats', action='append', choices=['png', 'svg', 'pdf'],
+                        help="chart file format, may be repeated (default png)")
+    parser.add_argument('--metric', dest='metrics', action='append', choices=list(METRICS),
+                        help="metric to plot against depreciation, may be repeated")
+    parser.add_argument('--workers', type=int, help="processes rendering charts in --headless mode")
+    # --metric already names the plotted metrics
+    parser.add_argument('--metrics-file', dest='metrics_path', metavar='PATH',
+                        help="append timing, http, cache and sqlite metrics to this json-lines file")
+    parser.add_argument('--profile', metavar='PATH', help="run under cProfile and write the stats here")
+    args = parser.parse_args()
+    if args.headless:
+        matplotlib.use('Agg')
+    with instrumentation.session(args.metrics_path, args.profile):
+        main(args.climate_store, args.headless, args.output_dir, args.formats or ('png',),
+             args.metrics or DEFAULT_METRICS, args.workers)
@@ -0,0 +1,100 @@
+# compares the price extractors over a corpus of saved KBB result pages
+#
+#   python benchmarks/bench_extract.py .kbb_cache --repeat 5
+#
+# every backend has to return exactly what the "soup" reference returns for every page
+# and for the hand written EDGE_CASES, then each one is timed (pages/sec) and its peak
+# memory for a single pass is measured
+
+import argparse
+import glob
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extract import EXTRACTORS, PRICE_CLASS
+
+PRICE_DIV = f'<div class="{PRICE_CLASS}">$23,990</div>'
+# markup around the price div that a targeted parser can get wrong
+EDGE_CASES = [
+    ('marker in a comment', '<!-- first-price -->' + PRICE_DIV),
+    ('marker in text after a tag', '<b>Sort</b> by first-price' + PRICE_DIV),
+    ('marker in another div', '<div class="x">first-price</div>' + PRICE_DIV),
+    ('marker twice in the tag', f'<div data-x="first-price" class="{PRICE_CLASS}">$12</div>'),
+    ('quoted > before the class', f'<div title="a>b" class="{PRICE_CLASS}">$16</div>'),
+    ('marker in the price text', f'<div class="{PRICE_CLASS}">first-price $7</div>'),
+    ('nested div', f'<DIV\nclass="{PRICE_CLASS}"><div>$7</div> more</DIV>'),
+]
+
+
+def load_corpus(paths):
+    pages = []
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(glob.glob(os.path.join(path, '**', '*.html'), recursive=True))
+        else:
+            files = [path]
+        for file_path in files:
+            with open(file_path, encoding='utf-8', errors='replace') as f:
+                pages.append((file_path, f.read()))
+    return pages
+
+
+def check_parity(pages, backends):
+    mismatches = []
+    for file_path, html in pages:
+        expected = EXTRACTORS['soup'](html)
+        for name in backends:
+            got = EXTRACTORS[name](html)
+            if got != expected:
+                mismatches.append((name, file_path, expected, got))
+    return mismatches
+
+
+def measure(extractor, pages, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for _, html in pages:
+            extractor(html)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    for _, html in pages:
+        extractor(html)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return len(pages) * repeat / elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark KBB price extractors")
+    parser.add_argument('corpus', nargs='+', help="saved .html pages or directories of them")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--backends', nargs='+', default=sorted(EXTRACTORS), choices=sorted(EXTRACTORS))
+    args = parser.parse_args()
+
+    pages = load_corpus(args.corpus)
+    if not pages:
+        print("No pages found in the corpus")
+        return 1
+    total_mb = sum(len(html) for _, html in pages) / 1e6
+    print(f"{len(pages)} pages, {total_mb:.1f} MB")
+
+    mismatches = check_parity([(f'<edge case: {name}>', html) for name, html in EDGE_CASES] + pages, args.backends)
+    for name, file_path, expected, got in mismatches[:10]:
+        print(f"MISMATCH {name} {file_path}: expected {expected[:5]}... got {got[:5]}...")
+
+    print(f"{'backend':<10} {'pages/sec':>10} {'peak MB':>9}")
+    for name in args.backends:
+        pages_per_sec, peak = measure(EXTRACTORS[name], pages, args.repeat)
+        print(f"{name:<10} {pages_per_sec:>10.1f} {peak / 1e6:>9.2f}")
+
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,225 @@
+# builds a synthetic unified_data.db at any scale, plus the offline fixtures the
+# benchmarks fetch from
+#
+#   python benchmarks/generate_db.py bench.db --cities 500 --cars 50 --listings 20 --years 5
+#   python benchmarks/generate_db.py bench.db --cities 50 --fixtures bench_fixtures --pages 100
+#
+# the schema comes from the scripts' own setup functions, so the database is the one the
+# pipeline would build. everything is drawn from a seeded generator and the same
+# arguments always give the same rows. cities are spread over the continental US,
+# every make/model gets a new and an old model year, and new cars lose more value in
+# colder cities so the climate analysis has something to find
+
+import argparse
+import json
+import os
+import sys
+from datetime import date, timedelta
+from urllib.parse import urlencode
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+from city_catalog import assign_weather_cells, weather_locations
+
+STATES = ['al', 'az', 'ca', 'co', 'fl', 'ga', 'il', 'mn', 'ny', 'oh', 'tx', 'wa']
+MAKES = ['ford', 'honda', 'toyota', 'tesla', 'chevrolet', 'nissan', 'subaru', 'hyundai', 'kia', 'mazda']
+# the page layout the extractors look for, padded with markup like a real result page
+PRICE_DIV = '<div class="text-size-600 text-ultra-bold first-price">{:,}</div>'
+PAGE_FILLER = '<div class="listing-card"><span class="title">{} {} {}</span><ul>' + '<li>detail</li>' * 40 + '</ul></div>'
+PRICES_PER_PAGE = 25
+# the month the weather fixtures cover
+FIXTURE_MONTH = date(2024, 11, 1)
+
+
+def _setup_schema(conn):
+    # the scripts create their tables on first run, call the same setup code
+    from carscraping import setup_database
+    from depreciation import setup_climate_state, setup_depreciation_tables
+    from frontier import setup_frontier
+    from OMfinal import initialize_db
+
+    setup_database()
+    initialize_db()
+    setup_frontier(conn)
+    setup_depreciation_tables(conn)
+    setup_climate_state(conn)
+
+
+def _cities(rng, count):
+    latitudes = rng.uniform(25.5, 48.5, count)
+    longitudes = rng.uniform(-123.5, -71.0, count)
+    return [(f"city{i:05d}", STATES[i % len(STATES)], f"{10000 + i:05d}", round(float(lat), 4), round(float(lon), 4))
+            for i, (lat, lon) in enumerate(zip(latitudes, longitudes))]
+
+
+def _cars(count, new_year, old_year):
+    cars = []
+    for i in range(count):
+        make, model = MAKES[i % len(MAKES)], f"model-{i // len(MAKES) + 1}"
+        cars += [(make, model, new_year), (make, model, old_year)]
+    return cars
+
+
+# listings_per_pair prices for every (city, car). a new car is priced around its model's
+# base price and an old one has lost 35 to 50% of it, more in colder (northern) cities
+def _prices(rng, city_rows, car_rows, listings_per_pair, new_year):
+    base = {}
+    rows = []
+    for city_id, latitude in city_rows:
+        loss = 0.35 + 0.15 * (latitude - 25.5) / 23.0
+        for car_id, make, model, year in car_rows:
+            price = base.setdefault((make, model), rng.uniform(25000, 60000))
+            if year != new_year:
+                price *= 1 - loss
+            dollars = np.round(price * rng.lognormal(0, 0.12, listings_per_pair))
+            rows.extend((car_id, city_id, int(d) * 100) for d in dollars)
+    return rows
+
+
+# one 12:00 sample per day, the rows OMfinal stores in hourly_climate
+def _climate(rng, city_id, latitude, days, start):
+    day = np.arange(days)
+    season = np.cos(2 * np.pi * (day + start.timetuple().tm_yday - 200) / 365.25)
+    temperature = 25 - 0.5 * latitude + 12 * season * latitude / 45 + rng.normal(0, 3, days)
+    humidity = np.clip(60 + rng.normal(0, 15, days), 5, 100)
+    wind = np.abs(rng.normal(4 + latitude / 10, 2, days))
+    rain = np.where(rng.random(days) < 0.25, rng.exponential(0.6, days), 0.0)
+    dates = [(start + timedelta(days=int(d))).isoformat() for d in day]
+    return zip([city_id] * days, dates, temperature.tolist(), humidity.tolist(), wind.tolist(), rain.tolist())
+
+
+# writes a complete database to path, replacing any file there. climate_years of daily
+# rows start at OMfinal.START_DATE for every weather grid cell. the derived tables
+# (price sketches, climate averages, depreciation) are filled the way the scripts fill
+# them. returns the row counts
+def generate_db(path, cities=50, cars=10, listings=20, climate_years=1, seed=0):
+    from depreciation import NEW_MODEL_YEAR, OLD_MODEL_YEAR, store_average_weather, update_depreciation
+    from OMfinal import START_DATE
+    from price_sketch import rebuild_price_sketches
+
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    db.close_connection(path)
+    db.DB_PATH = path
+    conn = db.get_connection(path)
+    rng = np.random.default_rng(seed)
+    _setup_schema(conn)
+
+    with db.transaction(conn):
+        c = conn.cursor()
+        c.executemany('INSERT INTO cities (city, state, zip_code, latitude, longitude) VALUES (?, ?, ?, ?, ?)',
+                      _cities(rng, cities))
+        assign_weather_cells(conn)
+        c.executemany('INSERT INTO cars (make, model, year) VALUES (?, ?, ?)',
+                      _cars(cars, NEW_MODEL_YEAR, OLD_MODEL_YEAR))
+
+        c.execute('SELECT id, latitude FROM cities ORDER BY id')
+        city_rows = c.fetchall()
+        c.execute('SELECT id, make, model, year FROM cars ORDER BY id')
+        car_rows = c.fetchall()
+        c.executemany('INSERT OR IGNORE INTO prices (car_id, city_id, price_cents) VALUES (?, ?, ?)',
+                      _prices(rng, city_rows, car_rows, listings, NEW_MODEL_YEAR))
+
+        days = int(round(365.25 * climate_years))
+        for city_id, latitude, _ in weather_locations(conn):
+            c.executemany('''
+                INSERT INTO hourly_climate (city_id, date, temperature_2m, relative_humidity_2m, windspeed_10m, precipitation)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', _climate(rng, city_id, latitude, days, START_DATE))
+
+    rebuild_price_sketches(conn)
+    store_average_weather(full=True)
+    update_depreciation()
+
+    counts = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+              for table in ('cities', 'cars', 'prices', 'hourly_climate')}
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    db.close_connection(path)
+    return counts
+
+
+def result_page(rng, make, model, year):
+    prices = rng.integers(8000, 90000, PRICES_PER_PAGE)
+    parts = ['<!DOCTYPE html><html><head><title>Cars for sale</title></head><body>']
+    for price in prices:
+        parts.append(PAGE_FILLER.format(year, make, model))
+        parts.append(PRICE_DIV.format(int(price)))
+    parts.append('</body></html>')
+    return ''.join(parts)
+
+
+# saves `pages` KBB result pages into a page cache under directory/pages, and the
+# Open-Meteo responses for one month of hourly weather at every weather cell of the
+# database under directory/weather (the layout openmeteo_stub.py serves). the urls and
+# request window are written to directory/manifest.json
+def write_fixtures(db_path, directory, pages=100, seed=0):
+    from carscraping import build_search_url
+    from http_cache import PageCache
+    from OMfinal import BATCH_SIZE, HOURLY_VARIABLES, month_chunks
+    from openmeteo_stub import response_key, synthetic_body
+
+    rng = np.random.default_rng(seed)
+    conn = db.connect(db_path, read_only=True)
+    c = conn.cursor()
+    c.execute('''
+        SELECT cars.make, cars.model, cars.year, cities.city, cities.state, cities.zip_code
+        FROM cities CROSS JOIN cars ORDER BY cities.id, cars.id LIMIT ?
+    ''', (pages,))
+    cache = PageCache(os.path.join(directory, 'pages'), max_bytes=1 << 40)
+    urls = []
+    for make, model, year, city, state, zip_code in c.fetchall():
+        urls.append(build_search_url(make, model, year, city, state, zip_code, base_url='https://www.kbb.com'))
+        cache.put(urls[-1], result_page(rng, make, model, year), {})
+
+    start = FIXTURE_MONTH
+    locations = [(city_id, latitude, longitude, start) for city_id, latitude, longitude in weather_locations(conn)]
+    conn.close()
+    weather_dir = os.path.join(directory, 'weather')
+    os.makedirs(weather_dir, exist_ok=True)
+    # the same requests fetch_weather_batch makes for these locations
+    (chunk_start, chunk_end), = month_chunks(start, start + timedelta(days=29))
+    for i in range(0, len(locations), BATCH_SIZE):
+        batch = locations[i:i + BATCH_SIZE]
+        query = urlencode({
+            "latitude": ",".join(str(l[1]) for l in batch),
+            "longitude": ",".join(str(l[2]) for l in batch),
+            "start_date": chunk_start.isoformat(),
+            "end_date": chunk_end.isoformat(),
+            "hourly": ",".join(HOURLY_VARIABLES),
+        })
+        with open(os.path.join(weather_dir, response_key(query) + '.fb'), 'wb') as f:
+            f.write(synthetic_body(query))
+
+    manifest = {'urls': urls, 'weather_start': chunk_start.isoformat(), 'weather_end': chunk_end.isoformat(),
+                'locations': len(locations)}
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic unified_data.db for benchmarking")
+    parser.add_argument('path', help="database file to write (replaced if it exists)")
+    parser.add_argument('--cities', type=int, default=50)
+    parser.add_argument('--cars', type=int, default=10, help="make/model pairs, each with a new and an old year")
+    parser.add_argument('--listings', type=int, default=20, help="prices per city and car")
+    parser.add_argument('--years', type=float, default=1, help="years of daily climate rows per weather cell")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fixtures', metavar='DIR', help="also write offline page and weather fixtures here")
+    parser.add_argument('--pages', type=int, default=100, help="result pages in the fixtures")
+    args = parser.parse_args()
+
+    counts = generate_db(args.path, args.cities, args.cars, args.listings, args.years, args.seed)
+    print(', '.join(f"{count} {table}" for table, count in counts.items()))
+    if args.fixtures:
+        manifest = write_fixtures(args.path, args.fixtures, args.pages, args.seed)
+        print(f"{len(manifest['urls'])} pages and {manifest['locations']} weather locations in {args.fixtures}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
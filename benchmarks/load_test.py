@@ -0,0 +1,153 @@
+# load test for query_service.py against a generated database
+#
+#   python benchmarks/load_test.py --cities 500 --duration 10 --clients 8
+#   python benchmarks/load_test.py --url http://127.0.0.1:8780 --duration 30
+#
+# without --url a database is generated with generate_db.py (reused from --data-dir),
+# its climate aggregates are refreshed and the service is started in this process.
+# every client thread keeps one keep-alive connection and loops over a mix of the
+# endpoints; a share of the requests revalidate with If-None-Match like a browser
+# would. prints requests per second, latency percentiles and the status counts, and
+# exits 1 when the throughput stays under --min-rps
+
+import argparse
+import http.client
+import os
+import random
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import db
+from generate_db import generate_db
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def request_mix(cities):
+    sample = [random.Random(i).randint(1, cities) for i in range(20)]
+    paths = ['/cities', '/combined', '/depreciation', '/depreciation?level=model',
+             '/climate/year', '/climate/season?metric=freeze_days']
+    for city_id in sample:
+        paths += [f'/depreciation?level=city_model&city_id={city_id}',
+                  f'/climate/month?city_id={city_id}&since=2018-06-01',
+                  f'/cities?city_id={city_id}']
+    return paths
+
+
+def client(url, paths, deadline, revalidate, seed, results):
+    rng = random.Random(seed)
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+    etags = {}
+    latencies = []
+    statuses = {}
+    while time.perf_counter() < deadline:
+        path = rng.choice(paths)
+        headers = {}
+        if path in etags and rng.random() < revalidate:
+            headers['If-None-Match'] = etags[path]
+        started = time.perf_counter()
+        try:
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            statuses['error'] = statuses.get('error', 0) + 1
+            conn.close()
+            conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+            continue
+        latencies.append(time.perf_counter() - started)
+        statuses[response.status] = statuses.get(response.status, 0) + 1
+        if response.getheader('ETag'):
+            etags[path] = response.getheader('ETag')
+    conn.close()
+    results.append((latencies, statuses))
+
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run_load(url, paths, duration, clients, revalidate):
+    results = []
+    deadline = time.perf_counter() + duration
+    threads = [threading.Thread(target=client, args=(url, paths, deadline, revalidate, i, results))
+               for i in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency for thread_latencies, _ in results for latency in thread_latencies]
+    statuses = {}
+    for _, thread_statuses in results:
+        for status, count in thread_statuses.items():
+            statuses[status] = statuses.get(status, 0) + count
+    return len(latencies) / elapsed, latencies, statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the query service")
+    parser.add_argument('--url', help="a running service, default starts one on a generated database")
+    parser.add_argument('--db', help="database to serve instead of a generated one")
+    parser.add_argument('--cities', type=int, default=200)
+    parser.add_argument('--cars', type=int, default=20)
+    parser.add_argument('--years', type=float, default=2)
+    parser.add_argument('--data-dir', default=os.path.join(HERE, 'data'))
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--revalidate', type=float, default=0.5,
+                        help="share of repeated requests sent with If-None-Match")
+    parser.add_argument('--min-rps', type=float, default=0, help="fail below this many requests per second")
+    args = parser.parse_args()
+
+    server = None
+    cities = args.cities
+    if not args.url:
+        from climate_aggregates import refresh_climate_aggregates
+        from query_service import serve
+
+        path = args.db
+        if not path:
+            os.makedirs(args.data_dir, exist_ok=True)
+            path = os.path.join(args.data_dir, f'load_{args.cities}_{args.cars}_{args.years:g}.db')
+            if not os.path.exists(path):
+                print(f"Generating {path}")
+                generate_db(path, args.cities, args.cars, 10, args.years)
+        # the service only reads, the aggregates have to be there already
+        db.DB_PATH = path
+        refresh_climate_aggregates(db.get_connection(path))
+        cities = db.get_connection(path).execute('SELECT COUNT(*) FROM cities').fetchone()[0]
+        db.close_connection(path)
+
+        server = serve(0, path)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        args.url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    paths = request_mix(cities)
+    print(f"{args.clients} clients for {args.duration:g}s against {args.url}, {len(paths)} distinct requests")
+    rps, latencies, statuses = run_load(args.url, paths, args.duration, args.clients, args.revalidate)
+    if server is not None:
+        server.shutdown()
+
+    print(f"{len(latencies)} requests, {rps:.0f} requests/sec")
+    print(f"latency ms: p50 {percentile(latencies, 0.5) * 1000:.2f}  p95 {percentile(latencies, 0.95) * 1000:.2f}  "
+          f"p99 {percentile(latencies, 0.99) * 1000:.2f}  max {max(latencies, default=0) * 1000:.2f}")
+    print("statuses: " + ', '.join(f"{status}: {count}" for status, count in sorted(statuses.items(), key=str)))
+    if rps < args.min_rps or 'error' in statuses:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,337 @@
+# times the hot paths against generated databases and checks them against a baseline
+#
+#   python benchmarks/run_benchmarks.py                          small and medium, compare to baseline.json
+#   python benchmarks/run_benchmarks.py --scale large --update-baseline
+#   python benchmarks/run_benchmarks.py --bench extract_prices --bench fetch_weather
+#
+# every scale gets a database (and fixtures) from generate_db.py, built once into
+# --data-dir and reused while the scale parameters stay the same. each benchmark is run
+# --repeat times and the fastest run counts; peak python memory is measured in one extra
+# run under tracemalloc. benchmarks that write start every run from a fresh copy of the
+# database. nothing touches the network: scraping replays saved pages from a page cache
+# and the weather fetch is answered by openmeteo_stub.py from saved responses.
+#
+# results are compared with --baseline and the run fails (exit status 1) when a time or
+# peak grew by more than --tolerance. timings depend on the machine, so the baseline is
+# recorded with --update-baseline on the machine the comparisons run on. without a
+# baseline the run fails too
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import db
+from generate_db import generate_db, write_fixtures
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(HERE, 'baseline.json')
+DEFAULT_DATA_DIR = os.path.join(HERE, 'data')
+
+# cities, make/model pairs, listings per (city, car), years of climate, fixture pages
+SCALES = {
+    'small': {'cities': 5, 'cars': 10, 'listings': 10, 'climate_years': 1, 'pages': 20},
+    'medium': {'cities': 50, 'cars': 20, 'listings': 20, 'climate_years': 3, 'pages': 100},
+    'large': {'cities': 500, 'cars': 50, 'listings': 20, 'climate_years': 5, 'pages': 500},
+}
+# days of new (and of already stored) weather per city in the insert_data_to_db benchmark
+INSERT_DAYS = 30
+# lookups per run of the nearest_city benchmark, the per lookup time is seconds / 1000
+NEAREST_LOOKUPS = 1000
+
+
+# a benchmark is a setup(work) function that returns the callable to time. work has the
+# paths of the scale: 'db' (a database the benchmark may change), 'fixtures' and
+# 'manifest'. writes=True gives every run its own copy of the database
+class Benchmark:
+    def __init__(self, name, setup, writes=False):
+        self.name = name
+        self.setup = setup
+        self.writes = writes
+
+
+def setup_insert_data_to_db(work):
+    import numpy as np
+    import pandas as pd
+    from city_catalog import weather_locations
+    from OMfinal import CLIMATE_COLUMNS, insert_data_to_db
+
+    conn = db.get_connection(work['db'])
+    last = conn.execute('SELECT MAX(date) FROM hourly_climate').fetchone()[0]
+    # the last INSERT_DAYS stored days and as many new ones, the anti-join drops the first half
+    dates = pd.date_range(end=pd.Timestamp(last[:10]) + pd.Timedelta(days=INSERT_DAYS),
+                          periods=2 * INSERT_DAYS).strftime('%Y-%m-%d')
+    rng = np.random.default_rng(0)
+    frames = []
+    for city_id, _, _ in weather_locations(conn):
+        frame = pd.DataFrame({'date': dates})
+        for column in CLIMATE_COLUMNS[1:]:
+            frame[column] = rng.normal(10, 5, len(frame))
+        frames.append((city_id, frame[CLIMATE_COLUMNS]))
+
+    def run():
+        with db.transaction(conn):
+            for city_id, frame in frames:
+                insert_data_to_db(city_id, frame, None, conn)
+    return run
+
+def setup_store_average_weather(work):
+    from depreciation import store_average_weather
+    return lambda: store_average_weather(full=True)
+
+def setup_calculate_average_depreciation_by_city(work):
+    from depreciation import calculate_average_depreciation_by_city
+    return calculate_average_depreciation_by_city
+
+def setup_fetch_combined_data(work):
+    from analysis import fetch_combined_data
+
+    def run():
+        # fetch_combined_data prints the frame
+        with contextlib.redirect_stdout(io.StringIO()):
+            fetch_combined_data(work['db'])
+    return run
+
+def setup_extract_prices(work):
+    from extract import extract_prices
+    from http_cache import PageCache
+
+    cache = PageCache(os.path.join(work['fixtures'], 'pages'), max_bytes=1 << 40)
+    pages = [cache.get(url).text for url in work['manifest']['urls']]
+    return lambda: [extract_prices(html) for html in pages]
+
+# NEAREST_LOOKUPS nearest city lookups at random points over the continental US
+def setup_nearest_city(work):
+    import numpy as np
+    from city_catalog import CityGrid
+
+    grid = CityGrid.from_db(db.get_connection(work['db']))
+    rng = np.random.default_rng(0)
+    points = list(zip(rng.uniform(25, 49, NEAREST_LOOKUPS), rng.uniform(-124, -67, NEAREST_LOOKUPS)))
+    return lambda: [grid.nearest(latitude, longitude) for latitude, longitude in points]
+
+# the scraper's fetch and parse loop, replaying the saved pages
+def setup_scrape_replay(work):
+    from carscraping import parse_prices
+    from fetcher import Fetcher
+    from http_cache import PageCache
+
+    cache = PageCache(os.path.join(work['fixtures'], 'pages'), max_bytes=1 << 40)
+    jobs = list(enumerate(work['manifest']['urls']))
+
+    def run():
+        fetcher = Fetcher(cache=cache, replay_only=True)
+        try:
+            for _, response, error in fetcher.fetch_all(jobs):
+                if error is not None:
+                    raise error
+                parse_prices(response.text)
+        finally:
+            fetcher.close()
+    return run
+
+# one month of hourly weather for every weather cell, served by openmeteo_stub from the
+# saved responses with the http cache of OMfinal turned off
+def setup_fetch_weather(work):
+    from datetime import date
+    import OMfinal
+    from city_catalog import weather_locations
+    from openmeteo_stub import serve
+
+    server = serve(0, os.path.join(work['fixtures'], 'weather'))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    work['cleanup'].append(server.shutdown)
+    archive_url = f"http://127.0.0.1:{server.server_address[1]}/v1/archive"
+
+    start = date.fromisoformat(work['manifest']['weather_start'])
+    end = date.fromisoformat(work['manifest']['weather_end'])
+    conn = db.get_connection(work['db'])
+    locations = [(city_id, latitude, longitude, start) for city_id, latitude, longitude in weather_locations(conn)]
+
+    def run():
+        saved_url, OMfinal.ARCHIVE_URL = OMfinal.ARCHIVE_URL, archive_url
+        try:
+            with OMfinal.get_cache_session().cache_disabled():
+                weather = OMfinal.fetch_weather_batch(locations, end)
+        finally:
+            OMfinal.ARCHIVE_URL = saved_url
+        if weather.empty:
+            raise RuntimeError("the weather fixtures returned no rows")
+    return run
+
+
+BENCHMARKS = {bench.name: bench for bench in (
+    Benchmark('insert_data_to_db', setup_insert_data_to_db, writes=True),
+    Benchmark('store_average_weather', setup_store_average_weather, writes=True),
+    Benchmark('calculate_average_depreciation_by_city', setup_calculate_average_depreciation_by_city),
+    Benchmark('fetch_combined_data', setup_fetch_combined_data),
+    Benchmark('extract_prices', setup_extract_prices),
+    Benchmark('nearest_city', setup_nearest_city),
+    Benchmark('scrape_replay', setup_scrape_replay),
+    Benchmark('fetch_weather', setup_fetch_weather),
+)}
+
+
+# the generated database and fixtures of a scale, rebuilt when its parameters changed
+def prepare_scale(name, params, data_dir, seed=0):
+    os.makedirs(data_dir, exist_ok=True)
+    db_path = os.path.join(data_dir, f'{name}.db')
+    fixtures = os.path.join(data_dir, f'{name}_fixtures')
+    params_path = os.path.join(data_dir, f'{name}.json')
+    wanted = dict(params, seed=seed)
+    try:
+        with open(params_path) as f:
+            current = json.load(f)
+    except (OSError, ValueError):
+        current = None
+    if current != wanted or not os.path.exists(db_path):
+        print(f"Generating the {name} database ({', '.join(f'{k}={v}' for k, v in params.items())})")
+        started = time.perf_counter()
+        generate_db(db_path, params['cities'], params['cars'], params['listings'], params['climate_years'], seed)
+        shutil.rmtree(fixtures, ignore_errors=True)
+        write_fixtures(db_path, fixtures, params['pages'], seed)
+        with open(params_path, 'w') as f:
+            json.dump(wanted, f)
+        print(f"  done in {time.perf_counter() - started:.1f}s")
+    with open(os.path.join(fixtures, 'manifest.json')) as f:
+        manifest = json.load(f)
+    return db_path, fixtures, manifest
+
+
+# runs setup in a fresh working copy of the database when the benchmark writes to it
+def _prepared(bench, db_path, fixtures, manifest, scratch):
+    if bench.writes:
+        db.close_connection(scratch)
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(scratch + suffix):
+                os.remove(scratch + suffix)
+        shutil.copyfile(db_path, scratch)
+        path = scratch
+    else:
+        path = db_path
+    db.close_connection(path)
+    db.DB_PATH = path
+    work = {'db': path, 'fixtures': fixtures, 'manifest': manifest, 'cleanup': []}
+    return work, bench.setup(work)
+
+def _cleanup(work):
+    for callback in work['cleanup']:
+        callback()
+
+
+# (best seconds, peak traced bytes) of one benchmark
+def measure(bench, db_path, fixtures, manifest, repeat, scratch):
+    times = []
+    for _ in range(repeat):
+        work, run = _prepared(bench, db_path, fixtures, manifest, scratch)
+        try:
+            started = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - started)
+        finally:
+            _cleanup(work)
+
+    work, run = _prepared(bench, db_path, fixtures, manifest, scratch)
+    try:
+        tracemalloc.start()
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        _cleanup(work)
+    return min(times), peak
+
+
+# [(scale, benchmark, field, baseline, current)] for every value over the tolerance
+def regressions(results, baseline, tolerance):
+    found = []
+    for scale, benches in results.items():
+        for name, current in benches.items():
+            previous = baseline.get(scale, {}).get(name)
+            if not previous:
+                continue
+            for field in ('seconds', 'peak_bytes'):
+                if current[field] > previous[field] * (1 + tolerance):
+                    found.append((scale, name, field, previous[field], current[field]))
+    return found
+
+
+def _change(current, previous):
+    if not previous:
+        return ''
+    return f"{(current / previous - 1) * 100:+.0f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths on generated databases")
+    parser.add_argument('--scale', dest='scales', action='append', choices=list(SCALES),
+                        help="scale to run, may be repeated (default small and medium)")
+    parser.add_argument('--bench', dest='benches', action='append', choices=list(BENCHMARKS),
+                        help="benchmark to run, may be repeated (default all)")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR, help="where generated databases are kept")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed growth over the baseline before a result counts as a regression")
+    parser.add_argument('--update-baseline', action='store_true', help="store these results as the new baseline")
+    parser.add_argument('--json', metavar='PATH', help="also write the results to this file")
+    args = parser.parse_args()
+
+    scales = args.scales or ['small', 'medium']
+    benches = args.benches or list(BENCHMARKS)
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except OSError:
+        baseline = {}
+
+    results = {}
+    for scale in scales:
+        db_path, fixtures, manifest = prepare_scale(scale, SCALES[scale], args.data_dir, args.seed)
+        scratch = os.path.join(args.data_dir, f'{scale}_scratch.db')
+        print(f"\n{scale}: {', '.join(f'{k}={v}' for k, v in SCALES[scale].items())}")
+        print(f"{'benchmark':<40} {'seconds':>10} {'change':>7} {'peak MB':>9} {'change':>7}")
+        results[scale] = {}
+        for name in benches:
+            seconds, peak = measure(BENCHMARKS[name], db_path, fixtures, manifest, args.repeat, scratch)
+            results[scale][name] = {'seconds': seconds, 'peak_bytes': peak}
+            previous = baseline.get(scale, {}).get(name, {})
+            print(f"{name:<40} {seconds:>10.4f} {_change(seconds, previous.get('seconds')):>7} "
+                  f"{peak / 1e6:>9.2f} {_change(peak, previous.get('peak_bytes')):>7}")
+        db.close_connection(scratch)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.update_baseline:
+        for scale, benches_run in results.items():
+            baseline.setdefault(scale, {}).update(benches_run)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"\nBaseline written to {args.baseline}")
+        return 0
+
+    # nothing to compare against is a failure, a check that can not fire must not pass
+    if not baseline:
+        print(f"\nNo baseline at {args.baseline}, record one with --update-baseline")
+        return 1
+    found = regressions(results, baseline, args.tolerance)
+    for scale, name, field, previous, current in found:
+        print(f"REGRESSION {scale} {name} {field}: {previous:.4g} -> {current:.4g} ({_change(current, previous)})")
+    if not found:
+        print(f"\nNo regressions over {args.tolerance:.0%} against {args.baseline}")
+    return 1 if found else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,34 +1,55 @@
 #file to scrape data from Kelley Blue Book Website
 
+import argparse
+import os
 import requests
-from bs4 import BeautifulSoup
 import json
 import re
-import sqlite3
+
+from city_catalog import DEFAULT_CATALOG, load_cities
+from db import get_connection, transaction
+from extract import extract_prices, DEFAULT_EXTRACTOR, EXTRACTORS
+from fetcher import Fetcher
+from frontier import PAGE_SIZE, setup_frontier, seed_frontier, next_units, mark_fetched, mark_failed
+from http_cache import PageCache, DEFAULT_CACHE_DIR
+import instrumentation
+from instrumentation import timed
+from price_sketch import setup_price_sketches, update_price_sketch
+from price_store import parse_price_cents, setup_price_storage
+
+# point this at a local stub server to run the scraper against saved pages
+KBB_BASE_URL = os.environ.get('KBB_BASE_URL', 'https://www.kbb.com')
 
 #https://www.kbb.com/cars-for-sale/all/2022/audi/a5/miami-fl?newSearch=true&searchRadius=100&zip=33101
-def scrape_car_data(make, model, year, city, state, zip_code):
-    url = f"https://www.kbb.com/cars-for-sale/all/{year}/{make}/{model}/{city}-{state}?newSearch=true&searchRadius=100&zip={zip_code}"
-    response = requests.get(url)
+def build_search_url(make, model, year, city, state, zip_code, base_url=None, page=0):
+    base_url = (base_url or KBB_BASE_URL).rstrip('/')
+    url = f"{base_url}/cars-for-sale/all/{year}/{make}/{model}/{city}-{state}?newSearch=true&searchRadius=100&zip={zip_code}"
+    if page:
+        url += f"&numRecords={PAGE_SIZE}&firstRecord={page * PAGE_SIZE}"
+    return url
+
+@timed
+def parse_prices(html, extractor=None):
+    return extract_prices(html, extractor)
+
+def scrape_car_data(make, model, year, city, state, zip_code, fetcher=None):
+    url = build_search_url(make, model, year, city, state, zip_code)
+    response = fetcher.fetch(url) if fetcher else requests.get(url)
     if response.status_code != 200:
         raise Exception(f"Failed to load page {url}")
     
-    soup = BeautifulSoup(response.text, 'html.parser')
-    
-    price_tags = soup.find_all('div', class_="text-size-600 text-ultra-bold first-price")
-    prices = [price_tag.text.strip() for price_tag in price_tags if price_tag.text != '']
-    
     return {
         'make': make,
         'model': model,
         'year': year,
-        'prices': prices
+        'prices': parse_prices(response.text)
     }
 
 
 
+@timed
 def setup_database():
-    conn = sqlite3.connect('unified_data.db')
+    conn = get_connection()
     c = conn.cursor()
     c.execute('''CREATE TABLE IF NOT EXISTS cities
                  (id INTEGER PRIMARY KEY, city TEXT, state TEXT, zip_code TEXT, latitude Real, longitude Real,
@@ -36,11 +57,6 @@ def setup_database():
     c.execute('''CREATE TABLE IF NOT EXISTS cars
                  (id INTEGER PRIMARY KEY, make TEXT, model TEXT, year INTEGER,
                   UNIQUE(make, model, year))''')
-    c.execute('''CREATE TABLE IF NOT EXISTS prices
-                 (id INTEGER PRIMARY KEY, car_id INTEGER, city_id INTEGER, price TEXT,
-                  FOREIGN KEY(car_id) REFERENCES cars(id),
-                  FOREIGN KEY(city_id) REFERENCES cities(id),
-                  UNIQUE(car_id, city_id, price))''')
     c.execute('''CREATE TABLE IF NOT EXISTS car_depreciation (
             city_id INTEGER PRIMARY KEY,
             city TEXT,
@@ -51,12 +67,15 @@ def setup_database():
             FOREIGN KEY (city_id) REFERENCES cities(id)
         )
     ''')
-    conn.commit()
-    conn.close()
+    # prices table, cents migration and aggregate indexes
+    setup_price_storage(conn)
+    setup_price_sketches(conn)
 
 def store_car_and_city(car_data, city, state, zip_code, latitude=None, longitude=None):
-    conn = sqlite3.connect('unified_data.db')
-    c = conn.cursor()
+    with transaction() as conn:
+        return _store_car_and_city(conn.cursor(), car_data, city, state, zip_code, latitude, longitude)
+
+def _store_car_and_city(c, car_data, city, state, zip_code, latitude, longitude):
     
     # Insert city data and get the city_id
     c.execute('''
@@ -75,26 +94,35 @@ def store_car_and_city(car_data, city, state, zip_code, latitude=None, longitude
         SELECT id FROM cars WHERE make = ? AND model = ? AND year = ?''',
               (car_data['make'], car_data['model'], car_data['year']))
     car_id = c.fetchone()[0]
-
-    conn.commit()
-    conn.close()
     
     return car_id, city_id
 
-def store_prices(car_id, city_id, prices):
-    conn = sqlite3.connect('unified_data.db')
-    c = conn.cursor()
-    
-    # Insert prices data
-    for price in prices:
-        c.execute('''INSERT OR IGNORE INTO prices (car_id, city_id, price) 
-                     VALUES (?, ?, ?)''', (car_id, city_id, price))
-    
-    conn.commit()
-    conn.close()
+@timed
+def store_prices(car_id, city_id, prices, limit=None):
+    # Insert prices data as integer cents, stopping once `limit` new rows have been added
+    added = []
+    with transaction() as conn:
+        c = conn.cursor()
+        for price in prices:
+            if limit is not None and len(added) >= limit:
+                break
+            price_cents = parse_price_cents(price)
+            if price_cents is None:
+                continue
+            c.execute('''INSERT OR IGNORE INTO prices (car_id, city_id, price_cents) 
+                         VALUES (?, ?, ?)''', (car_id, city_id, price_cents))
+            if c.rowcount > 0:
+                added.append(price_cents)
+        # the (city, car) quantile sketch sees each listing once, like prices
+        update_price_sketch(conn, city_id, car_id, added)
+    return len(added)
 
-def main():
+def main(requests_per_second=2.0, max_concurrency=4, retries=3, max_requests_per_run=50,
+         cache_dir=DEFAULT_CACHE_DIR, cache_ttl=24 * 3600, cache_max_bytes=200 * 1024 * 1024, replay_only=False,
+         extractor=DEFAULT_EXTRACTOR, catalog=DEFAULT_CATALOG):
     setup_database()
+    # cities come from the catalogue csv, new rows are added to the cities table
+    load_cities(catalog)
     cars = [
         ('ford', 'f150', 2018),
         ('honda', 'civic', 2018),
@@ -108,41 +136,71 @@ def main():
         ('toyota', 'camry', 2024),
     ]
     
-    cities = {
-        'miami': {'state': 'fl', 'zip': '33101', 'latitude': 25.7617, 'longitude': -80.1918},
-        'phoenix': {'state': 'az', 'zip': '85001', 'latitude': 33.4484, 'longitude': -112.0740},
-        'seattle': {'state': 'wa', 'zip': '98101', 'latitude': 47.6062, 'longitude': -122.3321},
-        'minneapolis': {'state': 'mn', 'zip': '55401', 'latitude': 44.9778, 'longitude': -93.2650},
-        'aurora': {'state': 'co', 'zip': '80019', 'latitude': 39.7392, 'longitude': -104.9903}  # Denver's coord for Aurora
-    }
-
     total_prices_added = 0
     max_new_prices_per_run = 25
 
-    for make, model, year in cars:
-        for city, details in cities.items():
+    # the frontier decides what this run fetches: unfetched pages first, then stale
+    # pages that have been yielding new prices
+    conn = get_connection()
+    setup_frontier(conn)
+    seed_frontier(conn, cars)
+    units = next_units(conn, max_requests_per_run)
+    if not units:
+        print("Nothing to fetch, every page in the frontier is up to date.")
+        return
+
+    jobs = (
+        ((car_id, city_id, page), build_search_url(make, model, year, city, state, zip_code, page=page))
+        for car_id, city_id, page, make, model, year, city, state, zip_code in units
+    )
+
+    # pages are fetched concurrently and stored in the order they finish
+    # re-runs are served from the page cache; replay_only never touches the network
+    cache = PageCache(cache_dir, ttl=cache_ttl, max_bytes=cache_max_bytes) if cache_dir else None
+    fetcher = Fetcher(requests_per_second=requests_per_second, max_concurrency=max_concurrency, retries=retries,
+                      cache=cache, replay_only=replay_only)
+    try:
+        for (car_id, city_id, page), response, error in fetcher.fetch_all(jobs):
             if total_prices_added >= max_new_prices_per_run:
                 print(f"Reached limit of {max_new_prices_per_run} new prices for this run.")
                 return
-            
-            car_data = scrape_car_data(make, model, year, city, details['state'], details['zip'])
-            car_id, city_id = store_car_and_city(car_data, city, details['state'], details['zip'], details['latitude'], details['longitude'])
-            
-            conn = sqlite3.connect('unified_data.db')
-            c = conn.cursor()
-            for price in car_data['prices']:
-                if total_prices_added >= max_new_prices_per_run:
-                    break  
-
-                c.execute('''
-                    INSERT OR IGNORE INTO prices (car_id, city_id, price) 
-                    VALUES (?, ?, ?)
-                ''', (car_id, city_id, price))
-                if c.rowcount > 0:
-                    total_prices_added += 1
-            conn.commit()
-            conn.close()
+            if error is not None or response.status_code != 200:
+                print(f"Skipping car {car_id} in city {city_id} (page {page}): {error or response.status_code}")
+                mark_failed(conn, car_id, city_id, page)
+                continue
 
-if __name__ == "__main__":
-    main()
+            prices = parse_prices(response.text, extractor)
+            remaining = max_new_prices_per_run - total_prices_added
+            added = store_prices(car_id, city_id, prices, remaining)
+            total_prices_added += added
 
+            # a page cut short by the price budget stays pending so the next run finishes it
+            if added < remaining or added == len(prices):
+                mark_fetched(conn, car_id, city_id, page, len(prices), added)
+    finally:
+        fetcher.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scrape KBB listing prices into unified_data.db")
+    parser.add_argument('--rate', type=float, default=2.0, help="max requests per second per host")
+    parser.add_argument('--concurrency', type=int, default=4, help="max requests in flight per host")
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--max-requests', type=int, default=50, help="request budget for this run")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help="page cache directory")
+    parser.add_argument('--no-cache', action='store_true', help="always fetch pages from the network")
+    parser.add_argument('--cache-ttl', type=float, default=24 * 3600, help="seconds before a cached page is revalidated")
+    parser.add_argument('--cache-max-mb', type=float, default=200, help="evict least recently used pages above this size")
+    parser.add_argument('--replay', action='store_true', help="run from cached pages only, with no network access")
+    parser.add_argument('--extractor', choices=sorted(EXTRACTORS), default=DEFAULT_EXTRACTOR,
+                        help="price extraction backend, 'soup' is the reference implementation")
+    parser.add_argument('--catalog', default=DEFAULT_CATALOG, help="csv of cities to scrape")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    with instrumentation.session(args.metrics, args.profile):
+        main(args.rate, args.concurrency, args.retries, args.max_requests,
+             cache_dir=None if args.no_cache else args.cache_dir,
+             cache_ttl=args.cache_ttl,
+             cache_max_bytes=int(args.cache_max_mb * 1024 * 1024),
+             replay_only=args.replay,
+             extractor=args.extractor,
+             catalog=args.catalog)
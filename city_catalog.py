@@ -0,0 +1,195 @@
+# the cities table, loaded in bulk from a csv catalogue (city, state, zip_code,
+# latitude, longitude) instead of the lists that used to be hardcoded in the scripts
+#
+# every city is snapped to a cell of the weather model's grid. cities in the same cell
+# get the same weather, so only one of them (the lowest id, its weather_city_id) is
+# fetched and stored and the others read its rows. at national scale that makes the
+# weather work scale with the number of cells instead of the number of cities
+#
+#   python city_catalog.py --catalog cities.csv
+#   python city_catalog.py --nearest 39.74 -104.99      the closest city and whose weather it reads
+
+import argparse
+import csv
+import math
+
+from db import get_connection, transaction
+
+DEFAULT_CATALOG = 'cities.csv'
+# ERA5-Land, the finest model behind the Open-Meteo archive, is on a 0.1 degree grid
+GRID_DEGREES = 0.1
+EARTH_RADIUS_KM = 6371.0
+
+
+def grid_cell(latitude, longitude, degrees=GRID_DEGREES):
+    return int(round(latitude / degrees)), int(round(longitude / degrees))
+
+def cell_center(cell, degrees=GRID_DEGREES):
+    return round(cell[0] * degrees, 6), round(cell[1] * degrees, 6)
+
+def distance_km(lat1, lon1, lat2, lon2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+# adds the grid columns to a cities table created before the catalogue existed. the
+# scraper and the weather loader can get here at the same time, so the columns are
+# checked again under the write lock before they are added
+def setup_city_catalog(conn):
+    wanted = ('grid_lat', 'grid_lon', 'weather_city_id')
+    if not all(column in _columns(conn) for column in wanted):
+        with transaction(conn):
+            c = conn.cursor()
+            columns = _columns(conn)
+            if 'grid_lat' not in columns:
+                c.execute('ALTER TABLE cities ADD COLUMN grid_lat INTEGER')
+            if 'grid_lon' not in columns:
+                c.execute('ALTER TABLE cities ADD COLUMN grid_lon INTEGER')
+            if 'weather_city_id' not in columns:
+                c.execute('ALTER TABLE cities ADD COLUMN weather_city_id INTEGER REFERENCES cities(id)')
+    c = conn.cursor()
+    c.execute('CREATE INDEX IF NOT EXISTS idx_cities_grid ON cities(grid_lat, grid_lon)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_cities_weather ON cities(weather_city_id)')
+
+def _columns(conn):
+    return [row[1] for row in conn.execute('PRAGMA table_info(cities)')]
+
+
+# inserts every row of the csv that is not in the table yet and assigns grid cells.
+# returns the number of new cities
+def load_cities(path=DEFAULT_CATALOG, conn=None):
+    conn = conn or get_connection()
+    setup_city_catalog(conn)
+    with open(path, newline='') as f:
+        rows = [(row['city'].strip().lower(), row['state'].strip().lower(), row['zip_code'].strip(),
+                 float(row['latitude']), float(row['longitude'])) for row in csv.DictReader(f)]
+    with transaction(conn):
+        c = conn.cursor()
+        c.execute('SELECT COUNT(*) FROM cities')
+        before = c.fetchone()[0]
+        c.executemany('''
+            INSERT OR IGNORE INTO cities (city, state, zip_code, latitude, longitude)
+            VALUES (?, ?, ?, ?, ?)
+        ''', rows)
+        c.execute('SELECT COUNT(*) FROM cities')
+        added = c.fetchone()[0] - before
+        assign_weather_cells(conn)
+    return added
+
+
+# snaps cities without a cell and points every city at the first city of its cell.
+# an existing representative keeps its role, so stored weather never moves
+def assign_weather_cells(conn, degrees=GRID_DEGREES):
+    with transaction(conn):
+        c = conn.cursor()
+        c.execute('SELECT id, latitude, longitude FROM cities WHERE grid_lat IS NULL AND latitude IS NOT NULL')
+        c.executemany('UPDATE cities SET grid_lat = ?, grid_lon = ? WHERE id = ?',
+                      [grid_cell(latitude, longitude, degrees) + (city_id,)
+                       for city_id, latitude, longitude in c.fetchall()])
+        c.execute('''
+            UPDATE cities SET weather_city_id = (
+                SELECT MIN(other.id) FROM cities other
+                WHERE other.grid_lat = cities.grid_lat AND other.grid_lon = cities.grid_lon
+            )
+            WHERE weather_city_id IS NULL AND grid_lat IS NOT NULL
+        ''')
+
+
+# (city_id, latitude, longitude) of the one city per grid cell whose weather is fetched,
+# at the center of its cell
+def weather_locations(conn=None, degrees=GRID_DEGREES):
+    c = (conn or get_connection()).cursor()
+    c.execute('SELECT id, grid_lat, grid_lon FROM cities WHERE weather_city_id = id ORDER BY id')
+    return [(city_id,) + cell_center((grid_lat, grid_lon), degrees) for city_id, grid_lat, grid_lon in c.fetchall()]
+
+
+# in-memory grid index over the cities for nearest neighbour lookups. only the cell of
+# the query point and the rings of cells around it are searched, so in a dense catalogue
+# a lookup costs the same for five cities or fifty thousand. when the rings would cover
+# more cells than there are cities, a plain scan is cheaper and is used instead
+class CityGrid:
+    def __init__(self, cities, degrees=GRID_DEGREES):
+        self.degrees = degrees
+        self.cities = list(cities)
+        self.cells = {}
+        for city_id, latitude, longitude in self.cities:
+            self.cells.setdefault(grid_cell(latitude, longitude, degrees), []).append((city_id, latitude, longitude))
+
+    @classmethod
+    def from_db(cls, conn=None, degrees=GRID_DEGREES):
+        c = (conn or get_connection()).cursor()
+        c.execute('SELECT id, latitude, longitude FROM cities WHERE latitude IS NOT NULL')
+        return cls(c.fetchall(), degrees)
+
+    def _ring(self, center, ring):
+        i0, j0 = center
+        if ring == 0:
+            yield center
+            return
+        for j in range(j0 - ring, j0 + ring + 1):
+            yield i0 - ring, j
+            yield i0 + ring, j
+        for i in range(i0 - ring + 1, i0 + ring):
+            yield i, j0 - ring
+            yield i, j0 + ring
+
+    def _closest(self, latitude, longitude, cities, best=None):
+        for city_id, city_lat, city_lon in cities:
+            d = distance_km(latitude, longitude, city_lat, city_lon)
+            if best is None or d < best[1]:
+                best = (city_id, d)
+        return best
+
+    # (city_id, distance in km) of the closest city, or None for an empty index
+    def nearest(self, latitude, longitude):
+        if not self.cities:
+            return None
+        center = grid_cell(latitude, longitude, self.degrees)
+        cell_km = math.radians(self.degrees) * EARTH_RADIUS_KM
+        best = None
+        visited = 0
+        ring = 0
+        while True:
+            for cell in self._ring(center, ring):
+                best = self._closest(latitude, longitude, self.cells.get(cell, ()), best)
+            visited += max(1, 8 * ring)
+            # anything outside the searched rings is at least `ring` cells away, and a
+            # cell of longitude shrinks towards the poles
+            shrink = math.cos(math.radians(min(abs(latitude) + (ring + 1) * self.degrees, 89.9)))
+            if best is not None and best[1] <= ring * cell_km * shrink:
+                return best
+            if visited > len(self.cities):
+                return self._closest(latitude, longitude, self.cities)
+            ring += 1
+
+
+# (city_id, city, state, weather_city_id, distance in km) of the catalogued city closest
+# to a point, e.g. to snap a ZIP code's coordinates to a city. None for an empty table
+def nearest_city(grid, latitude, longitude, conn=None):
+    found = grid.nearest(latitude, longitude)
+    if found is None:
+        return None
+    city_id, km = found
+    c = (conn or get_connection()).cursor()
+    c.execute('SELECT city, state, COALESCE(weather_city_id, id) FROM cities WHERE id = ?', (city_id,))
+    return (city_id,) + c.fetchone() + (km,)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the city catalogue into unified_data.db and look up cities")
+    parser.add_argument('--catalog', default=DEFAULT_CATALOG, help="csv of cities to load first")
+    parser.add_argument('--nearest', nargs=2, type=float, action='append', default=[], metavar=('LAT', 'LON'),
+                        help="print the closest city to a point, may be repeated")
+    args = parser.parse_args()
+    print(f"Loaded {load_cities(args.catalog)} new cities from {args.catalog}.")
+    grid = CityGrid.from_db()
+    for latitude, longitude in args.nearest:
+        found = nearest_city(grid, latitude, longitude)
+        if found is None:
+            print("The cities table is empty.")
+            break
+        city_id, city, state, weather_city_id, km = found
+        print(f"{latitude}, {longitude}: {city}, {state} (id {city_id}) {km:.1f} km away, "
+              f"weather from city {weather_city_id}")
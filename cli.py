@@ -0,0 +1,112 @@
+# one command line for every script, quick to start for cron jobs
+#
+#   python cli.py report --climate-store
+#   python cli.py aggregates season --metric freeze_days --city-id 3
+#   python cli.py weather --backfill          (any OMfinal.py option)
+#   python cli.py pipeline --charts           (any pipeline.py option)
+#
+# report and aggregates run here on plain sqlite: they import neither pandas nor
+# matplotlib (aggregates only loads pandas when hourly_climate has rows that are not
+# aggregated yet). the other subcommands hand their arguments to the script's own
+# parser, and the script and its dependencies are imported only when chosen
+
+import argparse
+import csv
+import json
+import runpy
+import sys
+
+from climate_aggregates import WINDOWS
+from db import get_connection
+import instrumentation
+
+# subcommand -> (module run as __main__, help)
+SCRIPTS = {
+    'scrape': ('carscraping', "scrape KBB listing prices"),
+    'weather': ('OMfinal', "load Open-Meteo weather history"),
+    'cities': ('city_catalog', "load the city catalogue and look up the nearest city to a point"),
+    'depreciation': ('depreciation', "recompute depreciation and climate averages and write the report"),
+    'stats': ('depreciation_stats', "bootstrap regression of depreciation against climate"),
+    'charts': ('analysis', "plot climate against depreciation"),
+    'pipeline': ('pipeline', "refresh everything, skipping stages that are up to date"),
+    'serve': ('query_service', "serve the results as json"),
+    'export': ('export', "stream tables and joins to csv, json lines or parquet"),
+}
+
+
+def run_script(module, argv):
+    sys.argv = [module] + argv
+    runpy.run_module(module, run_name='__main__', alter_sys=True)
+
+
+def command_report(args):
+    from depreciation import write_stored_report
+    write_stored_report(args.climate_store, args.output)
+    print(f"Wrote {args.output}.")
+
+def command_aggregates(args):
+    from climate_aggregates import aggregates_stale, fetch_climate_periods
+
+    conn = get_connection()
+    if args.refresh and aggregates_stale(conn):
+        from climate_aggregates import refresh_climate_aggregates
+        print(f"Wrote {refresh_climate_aggregates(conn)} climate aggregate rows.", file=sys.stderr)
+    periods = fetch_climate_periods(args.window, args.metric_names, args.city_ids, args.since, conn)
+    if args.format == 'jsonl':
+        for period in periods:
+            sys.stdout.write(json.dumps(period) + '\n')
+        return
+    metrics = sorted({metric for period in periods for metric in period['metrics']})
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    writer.writerow(['city_id', 'period', 'period_start', 'period_end'] + metrics)
+    for period in periods:
+        writer.writerow([period['city_id'], period['period'], period['period_start'], period['period_end']] +
+                        [period['metrics'].get(metric) for metric in metrics])
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Car depreciation and climate tools")
+    commands = parser.add_subparsers(dest='command', metavar='command')
+
+    report = commands.add_parser('report', help="rewrite depreciation_report.txt from the stored results")
+    report.add_argument('--climate-store', nargs='?', const='climate_store', metavar='DIR',
+                        help="weather averages over every hour in the columnar climate store (loads numpy and pandas)")
+    report.add_argument('--output', default='depreciation_report.txt')
+    instrumentation.add_arguments(report)
+    report.set_defaults(handler=command_report)
+
+    aggregates = commands.add_parser('aggregates', help="print one window of the climate aggregates")
+    aggregates.add_argument('window', choices=WINDOWS)
+    aggregates.add_argument('--metric', dest='metric_names', action='append', help="may be repeated, default all")
+    aggregates.add_argument('--city-id', dest='city_ids', type=int, action='append', help="may be repeated")
+    aggregates.add_argument('--since', metavar='YYYY-MM-DD', help="periods ending on or after this day")
+    aggregates.add_argument('--format', choices=['csv', 'jsonl'], default='csv')
+    aggregates.add_argument('--no-refresh', dest='refresh', action='store_false',
+                            help="print what is stored even if newer weather is not aggregated yet")
+    instrumentation.add_arguments(aggregates)
+    aggregates.set_defaults(handler=command_aggregates)
+
+    for name, (module, help) in SCRIPTS.items():
+        # -h and every other option go to the script's parser
+        commands.add_parser(name, help=f"{help} (python cli.py {name} -h for options)", add_help=False)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args, rest = parser.parse_known_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+    if args.command in SCRIPTS:
+        run_script(SCRIPTS[args.command][0], rest)
+        return 0
+    if rest:
+        parser.error(f"unrecognized arguments: {' '.join(rest)}")
+    with instrumentation.session(args.metrics, args.profile):
+        args.handler(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,254 @@
+# monthly, seasonal, yearly and rolling climate aggregates per city, computed from
+# hourly_climate with pandas resampling and memoized in the climate_aggregates table
+#
+# a row is (city_id, window, period, metric) -> value, e.g.
+#   (3, 'season', '2021-DJF', 'freeze_days') -> 41
+#   (3, 'rolling90', '2021-03', 'temperature_2m_mean') -> -2.4   (90 days ending in March 2021)
+# newly ingested dates only invalidate the periods that end on or after the earliest new
+# date of each city, so a daily append recomputes the last month, season and year and
+# leaves the rest of the history alone
+#
+# pandas is only imported to compute aggregates. reading stored ones goes through plain
+# sqlite, so the report and the query service start without it
+
+from datetime import date, timedelta
+
+from db import get_connection, transaction
+
+VARIABLES = ('temperature_2m', 'relative_humidity_2m', 'windspeed_10m', 'precipitation')
+# pandas resample rule per calendar window. seasons are meteorological (DJF, MAM, JJA,
+# SON) and december counts towards the next year's winter
+CALENDAR_WINDOWS = {'month': 'MS', 'season': 'QS-DEC', 'year': 'YS'}
+ROLLING_DAYS = (30, 90, 365)
+WINDOWS = tuple(CALENDAR_WINDOWS) + tuple(f'rolling{n}' for n in ROLLING_DAYS)
+SEASONS = {12: 'DJF', 3: 'MAM', 6: 'JJA', 9: 'SON'}
+FREEZE_THRESHOLD = 0.0
+
+
+def setup_climate_aggregates(conn):
+    c = conn.cursor()
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS climate_aggregates (
+            city_id INTEGER,
+            window TEXT,
+            period TEXT,
+            metric TEXT,
+            value REAL,
+            period_start TEXT,
+            period_end TEXT,
+            PRIMARY KEY (city_id, window, period, metric),
+            FOREIGN KEY (city_id) REFERENCES cities(id)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_climate_aggregates_end ON climate_aggregates(city_id, period_end)')
+    # last hourly_climate.id folded into each city's aggregates
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS climate_aggregate_state (
+            city_id INTEGER PRIMARY KEY,
+            last_id INTEGER,
+            FOREIGN KEY (city_id) REFERENCES cities(id)
+        )
+    ''')
+
+
+# one row per stored day for every city in city_ids, read from `since` on
+def load_daily(conn, city_ids, since=None):
+    import pandas as pd
+
+    placeholders = ', '.join('?' * len(city_ids))
+    query = f'''
+        SELECT city_id, date, {', '.join(VARIABLES)} FROM hourly_climate
+        WHERE city_id IN ({placeholders})'''
+    params = list(city_ids)
+    if since is not None:
+        query += ' AND date >= ?'
+        params.append(since.isoformat())
+    df = pd.read_sql_query(query, conn, params=params)
+    df['date'] = pd.to_datetime(df['date'].str[:10])
+    # stored values are the 12:00 (or daily mean) rate in mm per hour
+    df['freeze'] = (df['temperature_2m'] < FREEZE_THRESHOLD).astype(float)
+    df['precipitation_day'] = df['precipitation'] * 24
+    return df
+
+
+def _calendar_label(window, start):
+    import pandas as pd
+
+    if window == 'month':
+        return start.strftime('%Y-%m')
+    if window == 'season':
+        return f"{(start + pd.DateOffset(months=1)).year}-{SEASONS[start.month]}"
+    return start.strftime('%Y')
+
+
+# every window's metrics for one city's daily frame (indexed by date), as a long frame
+# of (window, period, period_start, period_end, metric, value)
+def compute_aggregates(daily):
+    import pandas as pd
+
+    named = {'days': ('temperature_2m', 'count'),
+             'freeze_days': ('freeze', 'sum'),
+             'precipitation_total': ('precipitation_day', 'sum')}
+    for v in VARIABLES:
+        named[f'{v}_mean'] = (v, 'mean')
+        named[f'{v}_min'] = (v, 'min')
+        named[f'{v}_max'] = (v, 'max')
+
+    parts = []
+    for window, rule in CALENDAR_WINDOWS.items():
+        frame = daily.resample(rule).agg(**named)
+        frame = frame[frame['days'] > 0]
+        starts = frame.index
+        ends = starts.shift(1, freq=rule) - pd.Timedelta(days=1)
+        frame.index = pd.MultiIndex.from_arrays([
+            [window] * len(frame),
+            [_calendar_label(window, start) for start in starts],
+            starts.strftime('%Y-%m-%d'),
+            ends.strftime('%Y-%m-%d'),
+        ], names=['window', 'period', 'period_start', 'period_end'])
+        parts.append(frame)
+
+    # trailing windows, sampled at the last stored day of every month
+    months = daily.index.to_period('M')
+    for n in ROLLING_DAYS:
+        rolling = daily.rolling(f'{n}D')
+        frame = rolling[list(VARIABLES)].mean().add_suffix('_mean')
+        frame['freeze_days'] = rolling['freeze'].sum()
+        frame['precipitation_total'] = rolling['precipitation_day'].sum()
+        frame['days'] = rolling['temperature_2m'].count()
+        frame = frame.groupby(months).last()
+        month_ends = frame.index.to_timestamp(how='end').normalize()
+        frame.index = pd.MultiIndex.from_arrays([
+            [f'rolling{n}'] * len(frame),
+            frame.index.strftime('%Y-%m'),
+            (month_ends - pd.Timedelta(days=n - 1)).strftime('%Y-%m-%d'),
+            month_ends.strftime('%Y-%m-%d'),
+        ], names=['window', 'period', 'period_start', 'period_end'])
+        parts.append(frame)
+
+    long = pd.concat(parts).rename_axis(columns='metric').stack().rename('value').reset_index()
+    return long.dropna(subset=['value'])
+
+
+# the earliest day any period ending on or after `first_new` can start on
+def _recompute_from(first_new):
+    season_start = date(first_new.year - 1, 12, 1)
+    rolling_start = first_new.replace(day=1) - timedelta(days=max(ROLLING_DAYS))
+    return min(season_start, rolling_start)
+
+
+# True when hourly_climate has rows that are not in the aggregates yet
+def aggregates_stale(conn=None):
+    conn = conn or get_connection()
+    setup_climate_aggregates(conn)
+    c = conn.cursor()
+    c.execute('''
+        SELECT EXISTS (SELECT 1 FROM hourly_climate
+                       WHERE id > (SELECT COALESCE(MAX(last_id), 0) FROM climate_aggregate_state))
+    ''')
+    return bool(c.fetchone()[0])
+
+
+# brings climate_aggregates up to date with hourly_climate and returns the number of
+# aggregate rows written. full=True recomputes everything (needed if rows were ever
+# updated or deleted rather than appended)
+def refresh_climate_aggregates(conn=None, full=False):
+    conn = conn or get_connection()
+    setup_climate_aggregates(conn)
+    with transaction(conn):
+        c = conn.cursor()
+        if full:
+            c.execute('DELETE FROM climate_aggregates')
+            c.execute('DELETE FROM climate_aggregate_state')
+
+        c.execute('SELECT COALESCE(MAX(last_id), 0) FROM climate_aggregate_state')
+        high_water_mark = c.fetchone()[0]
+        c.execute('''
+            SELECT city_id, MIN(date), MAX(id) FROM hourly_climate
+            WHERE id > ? GROUP BY city_id
+        ''', (high_water_mark,))
+        touched = {city_id: (date.fromisoformat(first[:10]), last_id) for city_id, first, last_id in c.fetchall()}
+        if not touched:
+            return 0
+
+        since = _recompute_from(min(first for first, _ in touched.values()))
+        daily = load_daily(conn, list(touched), since)
+
+        written = 0
+        for city_id, city_daily in daily.groupby('city_id'):
+            city_id = int(city_id)
+            first_new, _ = touched[city_id]
+            aggregates = compute_aggregates(city_daily.drop(columns='city_id').set_index('date').sort_index())
+            # only periods that could contain a new date are replaced
+            aggregates = aggregates[aggregates['period_end'] >= first_new.isoformat()]
+            c.execute('DELETE FROM climate_aggregates WHERE city_id = ? AND period_end >= ?',
+                      (city_id, first_new.isoformat()))
+            c.executemany('''
+                INSERT INTO climate_aggregates (city_id, window, period, period_start, period_end, metric, value)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', ((city_id,) + row for row in aggregates.itertuples(index=False, name=None)))
+            written += len(aggregates)
+
+        c.executemany('INSERT OR REPLACE INTO climate_aggregate_state (city_id, last_id) VALUES (?, ?)',
+                      [(city_id, last_id) for city_id, (_, last_id) in touched.items()])
+    return written
+
+
+# one window's aggregates as a wide frame: a row per (city_id, period) and a column per
+# metric. stale aggregates are refreshed first unless refresh=False
+def get_climate_aggregates(window, metrics=None, city_ids=None, conn=None, refresh=True):
+    import pandas as pd
+
+    if window not in WINDOWS:
+        raise ValueError(f"Unknown window {window!r}, expected one of {', '.join(WINDOWS)}")
+    conn = conn or get_connection()
+    if refresh:
+        refresh_climate_aggregates(conn)
+    else:
+        setup_climate_aggregates(conn)
+
+    query = 'SELECT city_id, period, period_start, period_end, metric, value FROM climate_aggregates WHERE window = ?'
+    params = [window]
+    if metrics:
+        query += f" AND metric IN ({', '.join('?' * len(metrics))})"
+        params.extend(metrics)
+    if city_ids:
+        query += f" AND city_id IN ({', '.join('?' * len(city_ids))})"
+        params.extend(city_ids)
+    long = pd.read_sql_query(query, conn, params=params)
+    wide = long.pivot_table(index=['city_id', 'period', 'period_start', 'period_end'],
+                            columns='metric', values='value', aggfunc='first')
+    return wide.reset_index().rename_axis(columns=None).sort_values(['city_id', 'period_start'], ignore_index=True)
+
+
+# the stored aggregates of one window without pandas: a dict per (city_id, period) with
+# the metrics in a nested dict, ordered by city and period. aggregates are kept per
+# weather cell, so city_ids are mapped through cities.weather_city_id
+def fetch_climate_periods(window, metrics=None, city_ids=None, since=None, conn=None):
+    if window not in WINDOWS:
+        raise ValueError(f"Unknown window {window!r}, expected one of {', '.join(WINDOWS)}")
+    conn = conn or get_connection()
+    query = '''
+        SELECT a.city_id, a.period, a.period_start, a.period_end, a.metric, a.value
+        FROM climate_aggregates a WHERE a.window = ?'''
+    params = [window]
+    if metrics:
+        query += f" AND a.metric IN ({', '.join('?' * len(metrics))})"
+        params.extend(metrics)
+    if city_ids:
+        query += f'''
+          AND a.city_id IN (SELECT COALESCE(weather_city_id, id) FROM cities
+                            WHERE id IN ({', '.join('?' * len(city_ids))}))'''
+        params.extend(city_ids)
+    if since:
+        query += ' AND a.period_end >= ?'
+        params.append(since)
+    c = conn.cursor()
+    c.execute(query + ' ORDER BY a.city_id, a.period_start, a.metric', params)
+    periods = []
+    for city_id, period, start, end, metric, value in c:
+        if not periods or periods[-1]['city_id'] != city_id or periods[-1]['period'] != period:
+            periods.append({'city_id': city_id, 'period': period, 'period_start': start, 'period_end': end,
+                            'metrics': {}})
+        periods[-1]['metrics'][metric] = value
+    return periods
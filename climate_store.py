@@ -0,0 +1,133 @@
+# columnar store for the full hourly weather series, next to the one-sample-a-day
+# hourly_climate table in sqlite
+#
+#   climate_store/<city_id>/<year>/<variable>.npy
+#
+# every file is a float32 array with one slot per hour of the year (8760 or 8784),
+# NaN until the hour has been fetched. times are implicit in the position, so a
+# year of one variable is 35 KB and the files are opened as numpy memmaps: readers
+# get views straight onto the page cache and only touch the years they ask for
+
+import os
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_STORE_DIR = 'climate_store'
+VARIABLES = ('temperature_2m', 'relative_humidity_2m', 'windspeed_10m', 'precipitation')
+
+HOUR = 3600
+EPOCH = pd.Timestamp(0, tz='UTC')
+
+
+def _year_start(year):
+    return int(pd.Timestamp(year=year, month=1, day=1, tz='UTC').timestamp())
+
+def hours_in_year(year):
+    return (_year_start(year + 1) - _year_start(year)) // HOUR
+
+
+class ClimateStore:
+    def __init__(self, directory=DEFAULT_STORE_DIR):
+        self.directory = directory
+
+    def _path(self, city_id, year, variable):
+        return os.path.join(self.directory, str(city_id), str(year), variable + '.npy')
+
+    def cities(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(int(name) for name in os.listdir(self.directory) if name.isdigit())
+
+    def years(self, city_id):
+        folder = os.path.join(self.directory, str(city_id))
+        if not os.path.isdir(folder):
+            return []
+        return sorted(int(name) for name in os.listdir(folder) if name.isdigit())
+
+    # writes hourly values for one city. times are unix seconds on the hour, values maps
+    # a variable name to an array the same length as times. hours already in the store
+    # are overwritten, so refetching a window is harmless
+    def write(self, city_id, times, values):
+        times = np.asarray(times, dtype=np.int64)
+        if not len(times):
+            return 0
+        years = pd.to_datetime(times, unit='s', utc=True).year.to_numpy()
+        for year in np.unique(years):
+            in_year = years == year
+            slots = (times[in_year] - _year_start(year)) // HOUR
+            folder = os.path.join(self.directory, str(city_id), str(year))
+            os.makedirs(folder, exist_ok=True)
+            for variable, series in values.items():
+                path = self._path(city_id, year, variable)
+                if os.path.exists(path):
+                    array = np.lib.format.open_memmap(path, mode='r+')
+                else:
+                    array = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32,
+                                                      shape=(hours_in_year(year),))
+                    array[:] = np.nan
+                array[slots] = np.asarray(series, dtype=np.float32)[in_year]
+                array.flush()
+                del array
+        return len(times)
+
+    # the long frame fetch_weather_batch returns (a city_id and time column plus one
+    # column per variable), split by city
+    def write_frame(self, df, variables=VARIABLES):
+        written = 0
+        for city_id, city_df in df.groupby('city_id', sort=False):
+            times = ((city_df['time'] - EPOCH) // pd.Timedelta(seconds=1)).to_numpy()
+            written += self.write(city_id, times, {v: city_df[v].to_numpy() for v in variables})
+        return written
+
+    # read-only memmap of one city, variable and year, or None if nothing was stored
+    def year_array(self, city_id, variable, year):
+        path = self._path(city_id, year, variable)
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode='r')
+
+    # hourly series of one variable as a pandas Series on a UTC DatetimeIndex. a single
+    # year is a view onto the memmap, several years are concatenated
+    def series(self, city_id, variable, start=None, end=None):
+        years = [y for y in self.years(city_id)
+                 if (start is None or y >= start.year) and (end is None or y <= end.year)]
+        parts = []
+        for year in years:
+            array = self.year_array(city_id, variable, year)
+            if array is None:
+                continue
+            index = pd.date_range(pd.Timestamp(year=year, month=1, day=1, tz='UTC'),
+                                  periods=len(array), freq='h')
+            parts.append(pd.Series(array, index=index, name=variable, copy=False))
+        if not parts:
+            return pd.Series(dtype=np.float32, name=variable)
+        series = parts[0] if len(parts) == 1 else pd.concat(parts)
+        # start and end are dates, end is inclusive
+        first = pd.Timestamp(start, tz='UTC') if start is not None else None
+        last = pd.Timestamp(end, tz='UTC') + pd.Timedelta(hours=23) if end is not None else None
+        if first is not None or last is not None:
+            series = series.loc[first:last]
+        return series
+
+    def frame(self, city_id, start=None, end=None, variables=VARIABLES):
+        return pd.DataFrame({v: self.series(city_id, v, start, end) for v in variables})
+
+    # mean of every variable over every stored hour, per city:
+    # {city_id: {variable: mean}}. runs on the memmaps a year at a time
+    def city_means(self, variables=VARIABLES, city_ids=None):
+        means = {}
+        for city_id in (self.cities() if city_ids is None else city_ids):
+            means[city_id] = {}
+            for variable in variables:
+                total = 0.0
+                count = 0
+                for year in self.years(city_id):
+                    array = self.year_array(city_id, variable, year)
+                    if array is None:
+                        continue
+                    valid = ~np.isnan(array)
+                    total += float(array.sum(where=valid, dtype=np.float64))
+                    count += int(valid.sum())
+                means[city_id][variable] = total / count if count else None
+        return means
@@ -0,0 +1,82 @@
+# shared access to unified_data.db for every script
+#
+# each thread gets one long lived connection per database file, opened once with WAL
+# and tuned pragmas, so functions no longer pay for a connect() on every call and the
+# scraper, the weather loader and analysis can run side by side (WAL lets readers keep
+# reading while one writer commits). connections are in autocommit mode; group writes
+# with `with transaction():`, which joins an outer transaction if one is already open
+
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import instrumentation
+
+DB_PATH = os.environ.get('UNIFIED_DB', 'unified_data.db')
+
+PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    # with WAL, NORMAL only syncs at checkpoints and can not corrupt the database
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -64000),         # 64 MB page cache
+    ('mmap_size', 256 * 1024 * 1024),
+    ('temp_store', 'MEMORY'),
+    ('busy_timeout', 30000),
+)
+# prepared statements kept per connection by the sqlite3 module
+STATEMENT_CACHE_SIZE = 256
+
+_local = threading.local()
+
+
+# with instrumentation enabled the connection times every statement
+def connect(path=None, read_only=False):
+    path = path or DB_PATH
+    factory = instrumentation.connection_factory() or sqlite3.Connection
+    if read_only:
+        conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, isolation_level=None,
+                               cached_statements=STATEMENT_CACHE_SIZE, check_same_thread=False, factory=factory)
+    else:
+        conn = sqlite3.connect(path, isolation_level=None, cached_statements=STATEMENT_CACHE_SIZE, factory=factory)
+    for name, value in PRAGMAS:
+        if read_only and name == 'journal_mode':
+            continue
+        conn.execute(f'PRAGMA {name} = {value}')
+    return conn
+
+
+# the calling thread's connection to `path`, opened on first use
+def get_connection(path=None):
+    path = path or DB_PATH
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(path)
+    if conn is None:
+        conn = connections[path] = connect(path)
+    return conn
+
+
+@contextmanager
+def transaction(conn=None):
+    conn = conn or get_connection()
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+
+def close_connection(path=None):
+    path = path or DB_PATH
+    connections = getattr(_local, 'connections', {})
+    conn = connections.pop(path, None)
+    if conn is not None:
+        conn.close()
@@ -1,111 +1,533 @@
 # calculates the depreciation of the cars in our database and calculates weather averages
 
-import sqlite3
-import re
+import argparse
+
+from city_catalog import setup_city_catalog
+from db import get_connection, transaction
+import instrumentation
+from instrumentation import timed
+from price_sketch import TDigest, fetch_sketch_groups, setup_price_sketches
+from price_store import setup_price_storage
 
 def get_average_price_by_year_and_city(year, city_id):
-    conn = sqlite3.connect('unified_data.db')
+    conn = get_connection()
     c = conn.cursor()
     
-    c.execute('''SELECT price FROM prices 
+    c.execute('''SELECT AVG(prices.price_cents) / 100.0 FROM prices 
                  JOIN cars ON prices.car_id = cars.id 
                  WHERE cars.year = ? AND prices.city_id = ?''', (year, city_id))
-    prices = [float(re.sub(r'[^\d.]', '', price[0])) for price in c.fetchall()]
-    
-    conn.close()
+    average = c.fetchone()[0]
     
-    if prices:
-        return sum(prices) / len(prices)
-    else:
+    return average
+
+# count, mean, min, max and nearest-rank percentiles (in dollars), all computed by sqlite
+def get_price_stats_by_year_and_city(year, city_id, percentiles=(0.25, 0.5, 0.75)):
+    conn = get_connection()
+    c = conn.cursor()
+
+    percentile_columns = ', '.join(
+        f'MAX(CASE WHEN rn = MAX(1, CAST({p!r} * n AS INTEGER) + ({p!r} * n > CAST({p!r} * n AS INTEGER))) THEN price_cents END) / 100.0'
+        for p in percentiles)
+    c.execute(f'''
+        WITH ranked AS (
+            SELECT prices.price_cents,
+                   ROW_NUMBER() OVER (ORDER BY prices.price_cents) AS rn,
+                   COUNT(*) OVER () AS n
+            FROM prices
+            JOIN cars ON prices.car_id = cars.id
+            WHERE cars.year = ? AND prices.city_id = ?
+        )
+        SELECT COUNT(*), AVG(price_cents) / 100.0, MIN(price_cents) / 100.0, MAX(price_cents) / 100.0,
+               {percentile_columns}
+        FROM ranked
+    ''', (year, city_id))
+    row = c.fetchone()
+
+    count, average, minimum, maximum = row[:4]
+    return {
+        'count': count,
+        'average': average,
+        'min': minimum,
+        'max': maximum,
+        'percentiles': dict(zip(percentiles, row[4:])),
+    }
+
+NEW_MODEL_YEAR = 2024
+OLD_MODEL_YEAR = 2018
+# how far a model year may be moved when a model has no listings for the requested one,
+# e.g. the tesla model 3 is scraped as a 2023 instead of a 2024
+MAX_YEAR_SUBSTITUTION = 1
+
+MODEL_DEPRECIATION_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        city_id INTEGER,
+        make TEXT,
+        model TEXT,
+        new_year INTEGER,
+        old_year INTEGER,
+        statistic TEXT NOT NULL DEFAULT 'mean',
+        depreciation REAL,
+        avg_new_price REAL,
+        avg_old_price REAL,
+        new_listings INTEGER,
+        old_listings INTEGER,
+        PRIMARY KEY (city_id, make, model, new_year, old_year, statistic)
+    )
+'''
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+# every stored figure records the price statistic it compares. tables from before that
+# held means only: car_depreciation gets the column, model_depreciation is rebuilt
+# because the statistic is part of its key
+def setup_depreciation_tables(conn):
+    c = conn.cursor()
+    c.execute(MODEL_DEPRECIATION_SCHEMA.format(table='model_depreciation'))
+    if 'statistic' in _columns(conn, 'model_depreciation') and 'statistic' in _columns(conn, 'car_depreciation'):
+        return
+    with transaction(conn):
+        if 'statistic' not in _columns(conn, 'model_depreciation'):
+            c.execute(MODEL_DEPRECIATION_SCHEMA.format(table='model_depreciation_migrated'))
+            c.execute('''
+                INSERT INTO model_depreciation_migrated
+                (city_id, make, model, new_year, old_year, depreciation, avg_new_price, avg_old_price,
+                 new_listings, old_listings)
+                SELECT city_id, make, model, new_year, old_year, depreciation, avg_new_price, avg_old_price,
+                       new_listings, old_listings
+                FROM model_depreciation''')
+            c.execute('DROP TABLE model_depreciation')
+            c.execute('ALTER TABLE model_depreciation_migrated RENAME TO model_depreciation')
+        columns = _columns(conn, 'car_depreciation')
+        if columns and 'statistic' not in columns:
+            c.execute("ALTER TABLE car_depreciation ADD COLUMN statistic TEXT NOT NULL DEFAULT 'mean'")
+
+# the statistic the stored car_depreciation figures compare, 'mean' before any are stored
+def stored_statistic(conn=None):
+    conn = conn or get_connection()
+    setup_depreciation_tables(conn)
+    c = conn.cursor()
+    c.execute('SELECT statistic FROM car_depreciation GROUP BY statistic ORDER BY COUNT(*) DESC LIMIT 1')
+    row = c.fetchone()
+    return row[0] if row else 'mean'
+
+# listing count and price total for every (city, make, model, year) in a single grouped query
+def fetch_price_groups(conn, city_ids=None):
+    c = conn.cursor()
+    where = ''
+    params = ()
+    if city_ids is not None:
+        city_ids = list(city_ids)
+        where = f"WHERE prices.city_id IN ({', '.join('?' * len(city_ids))})"
+        params = tuple(city_ids)
+    c.execute(f'''
+        SELECT prices.city_id, cars.make, cars.model, cars.year,
+               COUNT(*), SUM(prices.price_cents)
+        FROM prices
+        JOIN cars ON prices.car_id = cars.id
+        {where}
+        GROUP BY prices.city_id, cars.make, cars.model, cars.year
+    ''', params)
+    return c.fetchall()
+
+# picks the (new, old) model years to compare for every make/model. when a model has no
+# listings for a requested year anywhere, the closest scraped year within
+# MAX_YEAR_SUBSTITUTION is used instead
+def choose_model_years(groups, new_year, old_year, max_substitution=MAX_YEAR_SUBSTITUTION):
+    years_by_model = {}
+    for _, make, model, year, _, _ in groups:
+        years_by_model.setdefault((make, model), set()).add(year)
+
+    def closest(years, target, exclude):
+        candidates = [y for y in years if abs(y - target) <= max_substitution and y != exclude]
+        if target in years:
+            return target
+        return min(candidates, key=lambda y: (abs(y - target), -y), default=None)
+
+    chosen = {}
+    for key, years in years_by_model.items():
+        new = closest(years, new_year, old_year)
+        old = closest(years, old_year, new)
+        if new is not None and old is not None:
+            chosen[key] = (new, old)
+    return chosen
+
+def _depreciation(new_count, new_total, old_count, old_total):
+    if not new_count or not old_count:
         return None
+    avg_new = new_total / new_count / 100.0
+    avg_old = old_total / old_count / 100.0
+    if not avg_new:
+        return None
+    return ((avg_new - avg_old) / avg_new) * 100, avg_new, avg_old, new_count, old_count
+
+# one pass over the grouped totals. level is 'city', 'model' or 'city_model' and decides
+# what the results are keyed by: city_id, (make, model) or (city_id, make, model)
+def compute_depreciation(groups, new_year=NEW_MODEL_YEAR, old_year=OLD_MODEL_YEAR, level='city',
+                         model_years=None):
+    if level not in ('city', 'model', 'city_model'):
+        raise ValueError(f"Unknown depreciation level {level!r}")
+    model_years = model_years or choose_model_years(groups, new_year, old_year)
 
-def calculate_average_depreciation_by_city():
-    conn = sqlite3.connect('unified_data.db')
+    totals = {}
+    for city_id, make, model, year, count, total in groups:
+        years = model_years.get((make, model))
+        if years is None or year not in years:
+            continue
+        if level == 'city':
+            key = city_id
+        elif level == 'model':
+            key = (make, model)
+        else:
+            key = (city_id, make, model)
+        bucket = totals.setdefault(key, [0, 0, 0, 0])
+        if year == years[0]:
+            bucket[0] += count
+            bucket[1] += total
+        else:
+            bucket[2] += count
+            bucket[3] += total
+
+    results = {}
+    for key, (new_count, new_total, old_count, old_total) in totals.items():
+        result = _depreciation(new_count, new_total, old_count, old_total)
+        if result is not None:
+            results[key] = result
+    return results
+
+# the price statistic depreciation compares. 'median' and 'trimmed' (the mean of the
+# middle 80% of listings) come from the price_sketches and are not moved by a few
+# mislabelled listings
+STATISTICS = ('mean', 'median', 'trimmed')
+TRIM = 0.1
+
+def _sketch_price(digest, statistic):
+    if statistic == 'median':
+        return digest.quantile(0.5)
+    return digest.trimmed_mean(TRIM, 1 - TRIM)
+
+# compute_depreciation on merged quantile sketches. besides the levels of
+# compute_depreciation, 'state' and 'national' merge the city sketches of a state or of
+# every city
+def compute_robust_depreciation(sketch_groups, new_year=NEW_MODEL_YEAR, old_year=OLD_MODEL_YEAR, level='city',
+                                model_years=None, statistic='median'):
+    if level not in ('city', 'model', 'city_model', 'state', 'national'):
+        raise ValueError(f"Unknown depreciation level {level!r}")
+    if model_years is None:
+        model_years = choose_model_years([(g[0],) + g[2:7] for g in sketch_groups], new_year, old_year)
+
+    merged = {}
+    for city_id, state, make, model, year, count, _, digest in sketch_groups:
+        years = model_years.get((make, model))
+        if years is None or year not in years:
+            continue
+        key = {
+            'city': city_id,
+            'model': (make, model),
+            'city_model': (city_id, make, model),
+            'state': state,
+            'national': None,
+        }[level]
+        bucket = merged.setdefault(key, [TDigest(), TDigest()])
+        bucket[0 if year == years[0] else 1].merge(digest)
+
+    results = {}
+    for key, (new, old) in merged.items():
+        if not new.count or not old.count:
+            continue
+        price_new = _sketch_price(new, statistic) / 100.0
+        price_old = _sketch_price(old, statistic) / 100.0
+        if price_new:
+            results[key] = (((price_new - price_old) / price_new) * 100, price_new, price_old,
+                            int(new.count), int(old.count))
+    return results
+
+# depreciation at every level from one grouped query, or from the stored price sketches
+# for the median and trimmed statistics
+@timed
+def calculate_depreciation(new_year=NEW_MODEL_YEAR, old_year=OLD_MODEL_YEAR, city_ids=None, statistic='mean'):
+    conn = get_connection()
+    if statistic == 'mean':
+        groups = fetch_price_groups(conn, city_ids)
+        model_years = choose_model_years(groups, new_year, old_year)
+        return {
+            level: compute_depreciation(groups, new_year, old_year, level, model_years)
+            for level in ('city', 'model', 'city_model')
+        }, model_years
+
+    setup_price_sketches(conn)
+    sketch_groups = fetch_sketch_groups(conn, city_ids)
+    model_years = choose_model_years([(g[0],) + g[2:7] for g in sketch_groups], new_year, old_year)
+    return {
+        level: compute_robust_depreciation(sketch_groups, new_year, old_year, level, model_years, statistic)
+        for level in ('city', 'model', 'city_model')
+    }, model_years
+
+# the price groups of every city and the model years they compare: listing totals for
+# the mean, merged price sketches for the median and trimmed statistics
+def fetch_depreciation_groups(conn, new_year=NEW_MODEL_YEAR, old_year=OLD_MODEL_YEAR, statistic='mean'):
+    if statistic == 'mean':
+        groups = fetch_price_groups(conn)
+        return groups, choose_model_years(groups, new_year, old_year)
+    setup_price_sketches(conn)
+    groups = fetch_sketch_groups(conn)
+    return groups, choose_model_years([(g[0],) + g[2:7] for g in groups], new_year, old_year)
+
+# recomputes and stores the city and city/model figures of city_ids only (every city when
+# None) plus the all-cities model figures, for runs where only some cities got new
+# listings. the model years are still chosen over every city, so callers should refresh
+# every city when they change: pass the groups and model years of
+# fetch_depreciation_groups to decide that before anything is written. returns the
+# chosen model years
+@timed
+def update_depreciation(city_ids=None, new_year=NEW_MODEL_YEAR, old_year=OLD_MODEL_YEAR, statistic='mean',
+                        groups=None, model_years=None):
+    conn = get_connection()
+    # the city figures all compare one statistic, switching it recomputes every city
+    if city_ids is not None and stored_statistic(conn) != statistic:
+        city_ids = None
+    if groups is None:
+        groups, model_years = fetch_depreciation_groups(conn, new_year, old_year, statistic)
+    if statistic == 'mean':
+        compute = compute_depreciation
+    else:
+        compute = lambda g, n, o, level, years: compute_robust_depreciation(g, n, o, level, years, statistic)
+
+    city_groups = groups if city_ids is None else [g for g in groups if g[0] in city_ids]
+    store_depreciation_results({
+        'city': compute(city_groups, new_year, old_year, 'city', model_years),
+        'city_model': compute(city_groups, new_year, old_year, 'city_model', model_years),
+        'model': compute(groups, new_year, old_year, 'model', model_years),
+    }, new_year, old_year, statistic)
+    return model_years
+
+# city level results keyed by "city, state", the shape the report and car_depreciation use
+def label_by_city(by_city_id):
+    conn = get_connection()
     c = conn.cursor()
-    
     c.execute('''SELECT id, city, state FROM cities''')
     cities = c.fetchall()
-    
+
     depreciation_by_city = {}
-    
     for city_id, city, state in cities:
-        avg_price_new = get_average_price_by_year_and_city(2024, city_id)
-        avg_price_6_year_old = get_average_price_by_year_and_city(2018, city_id)
-        
-        if avg_price_new and avg_price_6_year_old:
-            depreciation = ((avg_price_new - avg_price_6_year_old) / avg_price_new) * 100
-            depreciation_by_city[f"{city}, {state}"] = (depreciation, avg_price_new, avg_price_6_year_old)
-        elif city == 'tesla':
-            avg_price_5_year_old = get_average_price_by_year_and_city(2023, city_id)
-            if avg_price_new and avg_price_5_year_old:
-                depreciation = ((avg_price_new - avg_price_5_year_old) / avg_price_new) * 100
-                depreciation_by_city[f"{city}, {state}"] = (depreciation, avg_price_new, avg_price_5_year_old)
-    
-    conn.close()
+        if city_id in by_city_id:
+            depreciation, avg_price_new, avg_price_old, _, _ = by_city_id[city_id]
+            depreciation_by_city[f"{city}, {state}"] = (depreciation, avg_price_new, avg_price_old)
     
     return depreciation_by_city
 
+@timed
+def calculate_average_depreciation_by_city(new_year=NEW_MODEL_YEAR, old_year=OLD_MODEL_YEAR):
+    conn = get_connection()
+    groups = fetch_price_groups(conn)
+
+    return label_by_city(compute_depreciation(groups, new_year, old_year, 'city'))
+
 def store_depreciation_data(depreciation_by_city):
-    conn = sqlite3.connect('unified_data.db')
-    c = conn.cursor()
-    
-    for city_state, data in depreciation_by_city.items():
-        city, state = city_state.split(", ")
-        depreciation, avg_new_price, avg_old_price = data
-        c.execute('''
+    with transaction() as conn:
+        c = conn.cursor()
+
+        rows = []
+        for city_state, data in depreciation_by_city.items():
+            city, state = city_state.split(", ")
+            depreciation, avg_new_price, avg_old_price = data
+            rows.append((city, state, city, state, depreciation, avg_new_price, avg_old_price))
+        c.executemany('''
             INSERT OR REPLACE INTO car_depreciation 
             (city_id, city, state, depreciation, avg_new_price, avg_old_price)
             VALUES (
                 (SELECT id FROM cities WHERE city = ? AND state = ?), 
                 ?, ?, ?, ?, ?
             )
-        ''', (city, state, city, state, depreciation, avg_new_price, avg_old_price))
-    
-    conn.commit()
-    conn.close()
+        ''', rows)
+
+# writes the city level results to car_depreciation and the per model results to
+# model_depreciation (city_id 0 holds the all-cities figure for a model) in one
+# transaction, both tagged with the price statistic they compare
+@timed
+def store_depreciation_results(results, new_year=NEW_MODEL_YEAR, old_year=OLD_MODEL_YEAR, statistic='mean'):
+    conn = get_connection()
+    setup_depreciation_tables(conn)
+    with transaction(conn):
+        c = conn.cursor()
+
+        city_rows = [
+            (city_id, depreciation, avg_new, avg_old, statistic, city_id)
+            for city_id, (depreciation, avg_new, avg_old, _, _) in results['city'].items()
+        ]
+        c.executemany('''
+            INSERT OR REPLACE INTO car_depreciation
+            (city_id, city, state, depreciation, avg_new_price, avg_old_price, statistic)
+            SELECT ?, city, state, ?, ?, ?, ? FROM cities WHERE id = ?
+        ''', city_rows)
+
+        # stored under the requested year pair and statistic so different comparisons do
+        # not overwrite each other
+        model_rows = [
+            (city_id, make, model, new_year, old_year, statistic) + result
+            for (city_id, make, model), result in results['city_model'].items()
+        ] + [
+            (0, make, model, new_year, old_year, statistic) + result
+            for (make, model), result in results['model'].items()
+        ]
+        c.executemany('''
+            INSERT OR REPLACE INTO model_depreciation
+            (city_id, make, model, new_year, old_year, statistic, depreciation, avg_new_price, avg_old_price,
+             new_listings, old_listings)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', model_rows)
+
+CLIMATE_VARIABLES = ('temperature_2m', 'relative_humidity_2m', 'windspeed_10m', 'precipitation')
+STAT_FIELDS = ('n', 'mean', 'm2', 'min', 'max')
+
+# running count, mean, M2 (sum of squared deviations, variance = m2 / n), min and max of
+# every climate variable per city, plus the last hourly_climate.id folded into them
+def setup_climate_state(conn):
+    c = conn.cursor()
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS city_climate_state (
+            city_id INTEGER,
+            variable TEXT,
+            last_id INTEGER,
+            n INTEGER,
+            mean REAL,
+            m2 REAL,
+            min REAL,
+            max REAL,
+            PRIMARY KEY (city_id, variable),
+            FOREIGN KEY (city_id) REFERENCES cities(id)
+        )
+    ''')
 
-def store_average_weather():
-    conn = sqlite3.connect('unified_data.db') 
+# per city stats of the hourly_climate rows with id > after_id, in one two-pass query
+# {city_id: (last_id, {variable: (n, mean, m2, min, max)})}
+def climate_batch_stats(conn, after_id=0):
+    means = ', '.join(f'AVG({v}) AS mean_{v}' for v in CLIMATE_VARIABLES)
+    stats = ', '.join(
+        f'''COUNT(r.{v}), m.mean_{v}, SUM((r.{v} - m.mean_{v}) * (r.{v} - m.mean_{v})),
+               MIN(r.{v}), MAX(r.{v})'''
+        for v in CLIMATE_VARIABLES)
     c = conn.cursor()
+    c.execute(f'''
+        WITH r AS (SELECT * FROM hourly_climate WHERE id > ?),
+        m AS (SELECT city_id, MAX(id) AS last_id, {means} FROM r GROUP BY city_id)
+        SELECT m.city_id, m.last_id, {stats}
+        FROM r JOIN m ON r.city_id = m.city_id
+        GROUP BY m.city_id
+    ''', (after_id,))
 
-    c.execute('SELECT id, city FROM cities')
-    cities = c.fetchall()
+    batch = {}
+    width = len(STAT_FIELDS)
+    for row in c.fetchall():
+        city_id, last_id, values = row[0], row[1], row[2:]
+        batch[city_id] = (last_id, {
+            v: tuple(values[i * width:(i + 1) * width]) for i, v in enumerate(CLIMATE_VARIABLES)
+        })
+    return batch
 
-    for city_id, city_name in cities:
-        c.execute('''
-            SELECT 
-                AVG(temperature_2m) AS avg_temp, 
-                AVG(relative_humidity_2m) AS avg_humidity, 
-                AVG(windspeed_10m) AS avg_windspeed,
-                AVG(precipitation) AS avg_precip
-            FROM hourly_climate 
-            WHERE city_id=?
-        ''', (city_id,))
-        
-        averages = c.fetchone()
-        if averages is None:
-            continue
-        
-        c.execute('''
+# Chan et al.'s parallel combination of two (n, mean, m2, min, max) summaries
+def merge_stats(a, b):
+    if not a or not a[0]:
+        return b
+    if not b or not b[0]:
+        return a
+    n_a, mean_a, m2_a, min_a, max_a = a
+    n_b, mean_b, m2_b, min_b, max_b = b
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * n_b / n
+    m2 = (m2_a or 0.0) + (m2_b or 0.0) + delta * delta * n_a * n_b / n
+    return n, mean, m2, min(min_a, min_b), max(max_a, max_b)
+
+def load_climate_state(conn, city_ids=None):
+    c = conn.cursor()
+    c.execute('SELECT city_id, variable, last_id, n, mean, m2, min, max FROM city_climate_state')
+    state = {}
+    for city_id, variable, last_id, *stats in c.fetchall():
+        if city_ids is None or city_id in city_ids:
+            state[(city_id, variable)] = (last_id, tuple(stats))
+    return state
+
+# city_averages is refreshed from the running state, so each run only reads the
+# hourly_climate rows added since the last one. full=True rebuilds the state from
+# scratch (needed if rows were ever updated or deleted) and verify=True checks the
+# incremental state against a full recompute
+@timed
+def store_average_weather(full=False, verify=False):
+    conn = get_connection()
+    setup_climate_state(conn)
+    with transaction(conn):
+        c = conn.cursor()
+
+        if full:
+            c.execute('DELETE FROM city_climate_state')
+            c.execute('DELETE FROM city_averages')
+
+        c.execute('SELECT COALESCE(MAX(last_id), 0) FROM city_climate_state')
+        high_water_mark = c.fetchone()[0]
+        batch = climate_batch_stats(conn, high_water_mark)
+        state = load_climate_state(conn, set(batch))
+
+        rows = []
+        for city_id, (last_id, stats) in batch.items():
+            for variable in CLIMATE_VARIABLES:
+                _, old = state.get((city_id, variable), (None, None))
+                merged = merge_stats(old, stats[variable])
+                rows.append((city_id, variable, last_id) + tuple(merged))
+        c.executemany('''
+            INSERT OR REPLACE INTO city_climate_state (city_id, variable, last_id, n, mean, m2, min, max)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+
+        averages = ', '.join(f"MAX(CASE WHEN variable = '{v}' THEN mean END)" for v in CLIMATE_VARIABLES)
+        c.executemany(f'''
             INSERT OR REPLACE INTO city_averages (city_id, average_temperature_2m, average_relative_humidity_2m, average_windspeed_10m, average_precipitation)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (city_id, averages[0], averages[1], averages[2], averages[3]))
+            SELECT city_id, {averages} FROM city_climate_state WHERE city_id = ? GROUP BY city_id
+        ''', [(city_id,) for city_id in batch])
+        # cities without any climate rows still get an (empty) averages row
+        c.execute('INSERT OR IGNORE INTO city_averages (city_id) SELECT id FROM cities')
 
-    conn.commit()
-    conn.close()
+    if verify:
+        mismatches = verify_climate_state(conn)
+        for city_id, variable, field, stored, expected in mismatches:
+            print(f"city_climate_state mismatch for city {city_id} {variable}.{field}: {stored} != {expected}")
+        if not mismatches:
+            print("Incremental climate averages match a full recompute.")
 
+    return len(batch)
+
+def _close(a, b, tolerance):
+    if a is None or b is None:
+        return a is None and b is None
+    return abs(a - b) <= tolerance * max(1.0, abs(a), abs(b))
+
+def verify_climate_state(conn, tolerance=1e-9):
+    expected = climate_batch_stats(conn, 0)
+    state = load_climate_state(conn)
+    mismatches = []
+    for city_id, (_, stats) in expected.items():
+        for variable in CLIMATE_VARIABLES:
+            _, stored = state.get((city_id, variable), (None, (None,) * len(STAT_FIELDS)))
+            for field, s_value, e_value in zip(STAT_FIELDS, stored, stats[variable]):
+                if not _close(s_value, e_value, tolerance):
+                    mismatches.append((city_id, variable, field, s_value, e_value))
+    for city_id, variable in state:
+        if city_id not in expected:
+            mismatches.append((city_id, variable, 'n', state[(city_id, variable)][1][0], None))
+    return mismatches
+
+@timed
 def fetch_weather_data_by_city():
-    conn = sqlite3.connect('unified_data.db')
+    conn = get_connection()
     c = conn.cursor()
     
     c.execute('''
     SELECT c.city, c.state, ca.average_temperature_2m, ca.average_relative_humidity_2m, ca.average_windspeed_10m, ca.average_precipitation
-    FROM city_averages ca
-    JOIN cities c ON ca.city_id = c.id
+    FROM cities c
+    JOIN city_averages ca ON ca.city_id = COALESCE(c.weather_city_id, c.id)
     ''')
     
     weather_data = c.fetchall()
-    conn.close()
     
     weather_by_city = {}
     for city, state, avg_temp, avg_humidity, avg_windspeed, avg_precip in weather_data:
@@ -113,18 +535,37 @@ def fetch_weather_data_by_city():
     
     return weather_by_city
 
-def main():
-    store_average_weather()
-    
-    # Calculate and store average depreciation by city using all cars
-    depreciation_by_city = calculate_average_depreciation_by_city()
-    store_depreciation_data(depreciation_by_city)
-    
-    # Fetch weather data by city
+# the same averages over every hour in the columnar climate store instead of the
+# 12:00 samples in city_averages. cities missing from the store fall back to city_averages
+@timed
+def fetch_store_weather_by_city(store_dir):
+    # numpy and pandas are only needed when a store is used
+    from climate_store import ClimateStore
+
     weather_by_city = fetch_weather_data_by_city()
-    
-    with open('depreciation_report.txt', 'w') as file:
-        for city, data in depreciation_by_city.items():
+    c = get_connection().cursor()
+    c.execute('SELECT city, state, COALESCE(weather_city_id, id) FROM cities')
+    cities = c.fetchall()
+    means = ClimateStore(store_dir).city_means(CLIMATE_VARIABLES, {weather_id for _, _, weather_id in cities})
+    for city, state, weather_id in cities:
+        if means[weather_id][CLIMATE_VARIABLES[0]] is not None:
+            weather_by_city[f"{city}, {state}"] = tuple(means[weather_id][v] for v in CLIMATE_VARIABLES)
+    return weather_by_city
+
+# the depreciation_by_city shape from the stored car_depreciation rows
+def fetch_depreciation_by_city():
+    c = get_connection().cursor()
+    c.execute('SELECT city, state, depreciation, avg_new_price, avg_old_price FROM car_depreciation ORDER BY city_id')
+    return {f"{city}, {state}": (depreciation, avg_new, avg_old)
+            for city, state, depreciation, avg_new, avg_old in c.fetchall()}
+
+# cities are written in "city, state" order whichever way the figures were gathered, so
+# the stored report and a fresh run write the same file
+@timed
+def write_report(depreciation_by_city, weather_by_city, statistic='mean', path='depreciation_report.txt'):
+    price_label = {'mean': 'Average', 'median': 'Median', 'trimmed': 'Trimmed mean'}[statistic]
+    with open(path, 'w') as file:
+        for city, data in sorted(depreciation_by_city.items()):
             depreciation, avg_price_new, avg_price_old = data
             avg_temp, avg_humidity, avg_windspeed, avg_precip = weather_by_city.get(city, (None, None, None, None))
             
@@ -135,8 +576,8 @@ def main():
                 file.write(f"  Average depreciation: {depreciation:.2f}% (value increased)\n")
             else:
                 file.write(f"  Average depreciation: {depreciation:.2f}% (value remained the same)\n")
-            file.write(f"  Average price of a new car: ${avg_price_new:.2f}\n")
-            file.write(f"  Average price of a 6-year-old car: ${avg_price_old:.2f}\n")
+            file.write(f"  {price_label} price of a new car: ${avg_price_new:.2f}\n")
+            file.write(f"  {price_label} price of a 6-year-old car: ${avg_price_old:.2f}\n")
             
             if avg_temp is not None:
                 file.write(f"  Average temperature: {avg_temp:.2f}°C\n")
@@ -149,7 +590,50 @@ def main():
             
             file.write("\n")
 
+# rewrites the report from the stored car_depreciation and climate averages, without
+# recomputing either. prices are labelled with the statistic they were stored with
+def write_stored_report(climate_store=None, path='depreciation_report.txt'):
+    setup_city_catalog(get_connection())
+    statistic = stored_statistic()
+    if climate_store:
+        weather_by_city = fetch_store_weather_by_city(climate_store)
+    else:
+        weather_by_city = fetch_weather_data_by_city()
+    write_report(fetch_depreciation_by_city(), weather_by_city, statistic, path)
+
+def main(full_weather_refresh=False, verify_weather=False, climate_store=None, statistic='mean'):
+    conn = get_connection()
+    setup_price_storage(conn)
+    setup_city_catalog(conn)
+
+    store_average_weather(full=full_weather_refresh, verify=verify_weather)
+    
+    # Calculate and store depreciation by city, by model and by city and model using all cars
+    results, model_years = calculate_depreciation(statistic=statistic)
+    store_depreciation_results(results, statistic=statistic)
+    depreciation_by_city = label_by_city(results['city'])
+    
+    # Fetch weather data by city
+    if climate_store:
+        weather_by_city = fetch_store_weather_by_city(climate_store)
+    else:
+        weather_by_city = fetch_weather_data_by_city()
+    
+    write_report(depreciation_by_city, weather_by_city, statistic)
+
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Calculate depreciation and climate averages and write depreciation_report.txt")
+    parser.add_argument('--full-weather-refresh', action='store_true',
+                        help="rebuild the city climate averages from every hourly_climate row")
+    parser.add_argument('--verify-weather', action='store_true',
+                        help="check the incremental climate averages against a full recompute")
+    parser.add_argument('--climate-store', nargs='?', const='climate_store', metavar='DIR',
+                        help="report weather averages over every hour in the columnar climate store")
+    parser.add_argument('--statistic', choices=STATISTICS, default='mean',
+                        help="listing price statistic compared, median and trimmed use the price sketches")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    with instrumentation.session(args.metrics, args.profile):
+        main(args.full_weather_refresh, args.verify_weather, args.climate_store, args.statistic)
 
 
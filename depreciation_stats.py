@@ -0,0 +1,227 @@
+# regression of depreciation against the city climate averages, with bootstrap
+# confidence intervals
+#
+# every fit works on per-city sufficient statistics (listing count, sum and sum of
+# squares of depreciation, and the city's climate), so the cost does not grow with the
+# number of listings. a bootstrap resample is a row of city weights drawn from a
+# multinomial, and all resamples of a chunk are evaluated at once as one
+# (resamples x cities) @ (cities x statistics) product.
+#
+# level 'city' has one observation per city (its car_depreciation figure). level
+# 'listing' has one observation per old-year listing: its price against the average new
+# price of the same model in the same city. listings in a city share its climate, so
+# they are resampled together with their city (a cluster bootstrap) rather than one by one
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from db import get_connection
+from depreciation import NEW_MODEL_YEAR, OLD_MODEL_YEAR, choose_model_years, fetch_price_groups
+
+CLIMATE_COLUMNS = {
+    'temperature': 'average_temperature_2m',
+    'humidity': 'average_relative_humidity_2m',
+    'windspeed': 'average_windspeed_10m',
+    'precipitation': 'average_precipitation',
+}
+DEFAULT_RESAMPLES = 10000
+# resamples evaluated per matrix product, bounds memory at chunk x cities weights
+CHUNK_SIZE = 2000
+
+
+def _climate_join():
+    columns = ', '.join(f'ca.{column}' for column in CLIMATE_COLUMNS.values())
+    not_null = ' AND '.join(f'ca.{column} IS NOT NULL' for column in CLIMATE_COLUMNS.values())
+    return columns, not_null
+
+
+# (city_ids, climate matrix, counts, sums, sums of squares) with one row per city that
+# has a depreciation figure and climate averages
+def city_level_data(conn=None):
+    c = (conn or get_connection()).cursor()
+    columns, not_null = _climate_join()
+    c.execute(f'''
+        SELECT dep.city_id, 1, dep.depreciation, dep.depreciation * dep.depreciation, {columns}
+        FROM car_depreciation dep
+        JOIN cities c ON dep.city_id = c.id
+        JOIN city_averages ca ON ca.city_id = COALESCE(c.weather_city_id, c.id)
+        WHERE dep.depreciation IS NOT NULL AND {not_null}
+        ORDER BY dep.city_id
+    ''')
+    return _split(c.fetchall())
+
+
+# the same shape with every old-year listing as an observation, aggregated per city by
+# sqlite in one pass over prices
+def listing_level_data(conn=None, new_year=NEW_MODEL_YEAR, old_year=OLD_MODEL_YEAR):
+    conn = conn or get_connection()
+    model_years = choose_model_years(fetch_price_groups(conn), new_year, old_year)
+    c = conn.cursor()
+    c.execute('CREATE TEMP TABLE IF NOT EXISTS chosen_model_years (make TEXT, model TEXT, new_year INTEGER, old_year INTEGER)')
+    c.execute('DELETE FROM chosen_model_years')
+    c.executemany('INSERT INTO chosen_model_years VALUES (?, ?, ?, ?)',
+                  [(make, model, new, old) for (make, model), (new, old) in model_years.items()])
+    columns, not_null = _climate_join()
+    c.execute(f'''
+        WITH new_prices AS (
+            SELECT p.city_id, y.make, y.model, AVG(p.price_cents) AS avg_new
+            FROM prices p
+            JOIN cars ON p.car_id = cars.id
+            JOIN chosen_model_years y ON cars.make = y.make AND cars.model = y.model AND cars.year = y.new_year
+            GROUP BY p.city_id, y.make, y.model
+        ),
+        listings AS (
+            SELECT p.city_id, (n.avg_new - p.price_cents) * 100.0 / n.avg_new AS dep
+            FROM prices p
+            JOIN cars ON p.car_id = cars.id
+            JOIN chosen_model_years y ON cars.make = y.make AND cars.model = y.model AND cars.year = y.old_year
+            JOIN new_prices n ON n.city_id = p.city_id AND n.make = y.make AND n.model = y.model
+            WHERE n.avg_new > 0
+        )
+        SELECT l.city_id, COUNT(*), SUM(l.dep), SUM(l.dep * l.dep), {columns}
+        FROM listings l
+        JOIN cities c ON l.city_id = c.id
+        JOIN city_averages ca ON ca.city_id = COALESCE(c.weather_city_id, c.id)
+        WHERE {not_null}
+        GROUP BY l.city_id
+        ORDER BY l.city_id
+    ''')
+    rows = c.fetchall()
+    c.execute('DROP TABLE chosen_model_years')
+    return _split(rows)
+
+def _split(rows):
+    if not rows:
+        return [], np.empty((0, len(CLIMATE_COLUMNS))), np.empty(0), np.empty(0), np.empty(0)
+    data = np.array([row[1:] for row in rows], dtype=np.float64)
+    return [row[0] for row in rows], data[:, 3:], data[:, 0], data[:, 1], data[:, 2]
+
+
+# per city statistics every estimate is built from, one row per city:
+# n, sum y, sum y^2, then for the design x1 = [1, x]: n * x1 x1^T (flattened) and x1 * sum y
+def sufficient_statistics(x, n, sy, syy):
+    x1 = np.column_stack([np.ones(len(x)), x])
+    outer = (x1[:, :, None] * x1[:, None, :]).reshape(len(x), -1)
+    return np.column_stack([n, sy, syy, n[:, None] * outer, x1 * sy[:, None]])
+
+
+# estimates from weighted totals, vectorized over the first axis (one row per resample).
+# distinct is the number of different cities behind each row
+def _estimates(totals, p, distinct):
+    k = p + 1
+    n, sy, syy = totals[:, 0], totals[:, 1], totals[:, 2]
+    xtx = totals[:, 3:3 + k * k].reshape(-1, k, k)
+    xty = totals[:, 3 + k * k:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_y = sy / n
+        var_y = syy / n - mean_y ** 2
+        mean_x = xtx[:, 0, 1:] / n[:, None]
+        var_x = np.diagonal(xtx, axis1=1, axis2=2)[:, 1:] / n[:, None] - mean_x ** 2
+        cov_xy = xty[:, 1:] / n[:, None] - mean_x * mean_y[:, None]
+        slopes = cov_xy / var_x
+        estimates = {
+            'slope': slopes,
+            'intercept': mean_y[:, None] - slopes * mean_x,
+            'r': cov_xy / np.sqrt(var_x * var_y[:, None]),
+        }
+        # the multiple regression needs more distinct cities than coefficients, an exact
+        # fit through k cities says nothing
+        singular = (distinct <= k) | (np.linalg.matrix_rank(xtx) < k)
+        xtx[singular] = np.eye(k)
+        beta = np.linalg.solve(xtx, xty[:, :, None])[:, :, 0]
+        beta[singular] = np.nan
+        residual = syy - 2 * np.einsum('bk,bk->b', beta, xty) + np.einsum('bk,bkl,bl->b', beta, xtx, beta)
+        estimates['coefficients'] = beta
+        estimates['r2'] = 1 - residual / (n * var_y)
+    return estimates
+
+
+def _bootstrap_chunk(job):
+    stats, p, size, seed = job
+    rng = np.random.default_rng(seed)
+    cities = len(stats)
+    weights = rng.multinomial(cities, np.full(cities, 1.0 / cities), size=size)
+    return _estimates(weights @ stats, p, np.count_nonzero(weights, axis=1))
+
+
+# point estimates and percentile bootstrap intervals of every simple regression
+# (depreciation ~ one climate variable), the correlations and the multiple regression on
+# all of them. workers > 1 spreads the resample chunks over a process pool
+def fit(x, n, sy, syy, resamples=DEFAULT_RESAMPLES, confidence=0.95, seed=0, workers=None,
+        chunk_size=CHUNK_SIZE):
+    stats = sufficient_statistics(x, n, sy, syy)
+    p = x.shape[1]
+    point = {name: values[0] for name, values in _estimates(stats.sum(axis=0)[None, :], p, np.array([len(stats)])).items()}
+
+    sizes = [min(chunk_size, resamples - start) for start in range(0, resamples, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    jobs = [(stats, p, size, s) for size, s in zip(sizes, seeds)]
+    if workers and workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunks = list(executor.map(_bootstrap_chunk, jobs))
+    else:
+        chunks = [_bootstrap_chunk(job) for job in jobs]
+    samples = {name: np.concatenate([chunk[name] for chunk in chunks]) for name in point}
+
+    tail = (1 - confidence) / 2 * 100
+    intervals = {}
+    for name, values in samples.items():
+        # resamples that drew too few distinct cities give nan and are left out
+        valid = ~np.isnan(values).any(axis=tuple(range(1, values.ndim)))
+        if valid.any():
+            intervals[name] = np.percentile(values[valid], [tail, 100 - tail], axis=0)
+        else:
+            intervals[name] = np.full((2,) + values.shape[1:], np.nan)
+    return {
+        'observations': int(n.sum()),
+        'cities': len(n),
+        'resamples': resamples,
+        'confidence': confidence,
+        'point': point,
+        'interval': intervals,
+    }
+
+
+def format_results(results, level):
+    variables = list(CLIMATE_COLUMNS)
+    point, interval = results['point'], results['interval']
+    level_pct = round(results['confidence'] * 100)
+    lines = [f"Depreciation vs climate, {level} level: {results['observations']} observations in "
+             f"{results['cities']} cities, {results['resamples']} bootstrap resamples ({level_pct}% intervals)"]
+    for i, name in enumerate(variables):
+        lines.append(
+            f"  {name:<14} slope {point['slope'][i]:9.4f} [{interval['slope'][0][i]:9.4f}, {interval['slope'][1][i]:9.4f}]"
+            f"  r {point['r'][i]:6.3f} [{interval['r'][0][i]:6.3f}, {interval['r'][1][i]:6.3f}]")
+    if np.isnan(point['coefficients']).any():
+        lines.append("  multiple regression: not identifiable, needs more cities than coefficients")
+    else:
+        lines.append(f"  multiple regression r2 {point['r2']:.3f} [{interval['r2'][0]:.3f}, {interval['r2'][1]:.3f}]")
+        for i, name in enumerate(['intercept'] + variables):
+            lines.append(f"    {name:<14} {point['coefficients'][i]:9.4f} "
+                         f"[{interval['coefficients'][0][i]:9.4f}, {interval['coefficients'][1][i]:9.4f}]")
+    return '\n'.join(lines)
+
+
+def main(level='city', resamples=DEFAULT_RESAMPLES, confidence=0.95, seed=0, workers=None):
+    if level == 'city':
+        _, x, n, sy, syy = city_level_data()
+    else:
+        _, x, n, sy, syy = listing_level_data()
+    if len(n) < 2:
+        print(f"Not enough cities with depreciation and climate data for the {level} level.")
+        return None
+    results = fit(x, n, sy, syy, resamples, confidence, seed, workers)
+    print(format_results(results, level))
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit depreciation against city climate with bootstrap confidence intervals")
+    parser.add_argument('--level', choices=['city', 'listing'], default='city')
+    parser.add_argument('--resamples', type=int, default=DEFAULT_RESAMPLES)
+    parser.add_argument('--confidence', type=float, default=0.95)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, help="processes for the bootstrap, default runs in this process")
+    args = parser.parse_args()
+    main(args.level, args.resamples, args.confidence, args.seed, args.workers)
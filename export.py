@@ -0,0 +1,309 @@
+# streams tables and joins of unified_data.db to CSV, JSON lines or Parquet for the
+# teams that want the raw data
+#
+#   python export.py prices --format parquet
+#   python export.py listings --format csv --compression gzip --incremental
+#   python export.py --query 'SELECT city_id, date, temperature_2m FROM hourly_climate' --format jsonl
+#
+# rows are read with fetchmany in chunks of --chunk-size and written out chunk by chunk,
+# so memory stays flat however large the table (each chunk is one Parquet row group).
+# files are written under a .part name and renamed when complete.
+#
+# --incremental exports only the rows whose key (rowid for tables) is past the
+# watermark stored in export_state by the previous incremental export under the same
+# name, and moves the watermark when the file is complete. the upper bound is read
+# before streaming, rows committed meanwhile go into the next export. this suits the
+# append-only tables (prices, hourly_climate); tables rewritten in place should be
+# exported whole. pyarrow is only needed for Parquet
+
+import argparse
+import csv
+import gzip
+import json
+import os
+import sys
+import time
+
+from city_catalog import setup_city_catalog
+from db import get_connection, transaction
+import instrumentation
+from instrumentation import timed
+from price_store import setup_price_storage
+
+DEFAULT_OUTPUT_DIR = 'exports'
+CHUNK_SIZE = 50000
+FORMATS = ('csv', 'jsonl', 'parquet')
+TEXT_COMPRESSION = ('none', 'gzip')
+PARQUET_COMPRESSION = ('none', 'snappy', 'gzip', 'zstd')
+# level 1 compresses at several times the speed of the default 6, which would keep the
+# export from running at disk speed, for files only a little larger
+GZIP_LEVEL = 1
+
+
+def setup_export_state(conn):
+    c = conn.cursor()
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS export_state (
+            name TEXT PRIMARY KEY,
+            watermark INTEGER,
+            rows INTEGER,
+            path TEXT,
+            exported_at REAL
+        )
+    ''')
+
+def load_watermark(conn, name):
+    c = conn.cursor()
+    c.execute('SELECT watermark FROM export_state WHERE name = ?', (name,))
+    row = c.fetchone()
+    return row[0] if row else 0
+
+def save_watermark(conn, name, watermark, rows, path):
+    with transaction(conn):
+        conn.execute('INSERT OR REPLACE INTO export_state (name, watermark, rows, path, exported_at) VALUES (?, ?, ?, ?, ?)',
+                     (name, watermark, rows, path, time.time()))
+
+
+# something to export: a SELECT without WHERE, the integer expression incremental
+# exports filter on (None when the source can only be exported whole) and a query
+# for the current maximum of that key
+class Source:
+    def __init__(self, name, select, key=None, bound=None):
+        self.name = name
+        self.select = select
+        self.key = key
+        self.bound = bound
+
+    # the query for the rows with lo < key <= hi, either bound may be None
+    def query(self, lo=None, hi=None):
+        clauses, params = [], []
+        if lo is not None:
+            clauses.append(f'{self.key} > ?')
+            params.append(lo)
+        if hi is not None:
+            clauses.append(f'{self.key} <= ?')
+            params.append(hi)
+        if clauses:
+            return f"{self.select} WHERE {' AND '.join(clauses)}", params
+        return self.select, params
+
+# joins downstream teams asked for next to the plain tables
+JOINS = {
+    # every listing with its car and city
+    'listings': Source('listings', '''
+        SELECT p.id, p.price_cents, p.car_id, c.make, c.model, c.year,
+               p.city_id, ci.city, ci.state, ci.zip_code
+        FROM prices p
+        JOIN cars c ON c.id = p.car_id
+        JOIN cities ci ON ci.id = p.city_id''', 'p.id', 'SELECT MAX(id) FROM prices'),
+    # depreciation next to climate, the rows of analysis.fetch_combined_data
+    'combined': Source('combined', '''
+        SELECT c.id AS city_id, c.city, c.state,
+               avg.average_temperature_2m AS avg_temp,
+               avg.average_relative_humidity_2m AS avg_humidity,
+               avg.average_windspeed_10m AS avg_windspeed,
+               avg.average_precipitation AS avg_precip,
+               dep.depreciation, dep.avg_new_price, dep.avg_old_price
+        FROM car_depreciation dep
+        JOIN cities c ON dep.city_id = c.id
+        JOIN city_averages avg ON avg.city_id = COALESCE(c.weather_city_id, c.id)'''),
+}
+
+# a whole table, keyed by rowid. csv and json have no bytes type, so blob columns (the
+# price sketches) are exported as hex there
+def table_source(conn, table, fmt):
+    c = conn.cursor()
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    if c.fetchone() is None:
+        raise ValueError(f"No table or export named {table!r}, exports are {', '.join(JOINS)}")
+    columns = []
+    for _, column, declared, _, _, _ in c.execute(f'PRAGMA table_info("{table}")').fetchall():
+        if fmt != 'parquet' and declared.upper() == 'BLOB':
+            columns.append(f'hex("{column}") AS "{column}"')
+        else:
+            columns.append(f'"{column}"')
+    return Source(table, f'SELECT {", ".join(columns)} FROM "{table}"', 'rowid', f'SELECT MAX(rowid) FROM "{table}"')
+
+# any SELECT. incremental exports need key to be one of its integer output columns
+def query_source(query, key=None, name='query'):
+    bound = f'SELECT MAX("{key}") FROM ({query})' if key else None
+    return Source(name, f'SELECT * FROM ({query})', f'"{key}"' if key else None, bound)
+
+
+def _open_text(path, compression):
+    if compression == 'gzip':
+        return gzip.open(path, 'wt', compresslevel=GZIP_LEVEL, newline='', encoding='utf-8')
+    return open(path, 'w', newline='', encoding='utf-8', buffering=1 << 20)
+
+def write_csv(path, columns, chunks, compression='none'):
+    rows = 0
+    with _open_text(path, compression) as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(columns)
+        for chunk in chunks:
+            writer.writerows(chunk)
+            rows += len(chunk)
+    return rows
+
+def _json_default(value):
+    if isinstance(value, bytes):
+        return value.hex()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def write_jsonl(path, columns, chunks, compression='none'):
+    encode = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=_json_default).encode
+    rows = 0
+    with _open_text(path, compression) as f:
+        for chunk in chunks:
+            f.write(''.join([encode(dict(zip(columns, row))) + '\n' for row in chunk]))
+            rows += len(chunk)
+    return rows
+
+# one chunk's values of a column as the type the file was started with. sqlite columns
+# are not typed: integers in a REAL column are widened, anything in a text column is
+# written as text, and a value that would lose data raises instead of being truncated
+def _arrow_column(pa, values, type):
+    if type == pa.string():
+        try:
+            return pa.array(values, type=type)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            return pa.array([None if v is None else str(v) for v in values], type=type)
+    array = pa.array(values)
+    if array.type == pa.null():
+        return pa.nulls(len(array), type)
+    return array if array.type == type else array.cast(type)
+
+def write_parquet(path, columns, chunks, compression='snappy'):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("Parquet export needs pyarrow (pip install pyarrow)") from e
+
+    writer = None
+    schema = None
+    rows = 0
+    try:
+        for chunk in chunks:
+            values = list(zip(*chunk))
+            if schema is None:
+                # types from the first chunk, a column that is all NULL there is text
+                types = [pa.array(v).type for v in values]
+                schema = pa.schema([(name, pa.string() if t == pa.null() else t) for name, t in zip(columns, types)])
+                writer = pq.ParquetWriter(path, schema, compression=compression)
+            arrays = [_arrow_column(pa, v, field.type) for v, field in zip(values, schema)]
+            writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+            rows += len(chunk)
+        if writer is None:
+            writer = pq.ParquetWriter(path, pa.schema([(name, pa.string()) for name in columns]), compression=compression)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+WRITERS = {'csv': write_csv, 'jsonl': write_jsonl, 'parquet': write_parquet}
+
+
+def default_path(name, fmt, compression, lo=None, hi=None, output_dir=DEFAULT_OUTPUT_DIR):
+    suffix = f'.{lo + 1}-{hi}' if hi is not None and lo is not None else ''
+    extension = fmt + ('.gz' if fmt != 'parquet' and compression == 'gzip' else '')
+    return os.path.join(output_dir, f'{name}{suffix}.{extension}')
+
+
+# streams source to a file and returns (rows, path), path None when an incremental
+# export found nothing new. source is a table name, a JOINS name or a Source from
+# query_source. `since` overrides the stored watermark as the exclusive lower bound;
+# state_name keeps separate watermarks for several consumers of the same source
+@timed
+def export(source, fmt='csv', path=None, compression=None, chunk_size=CHUNK_SIZE, incremental=False, since=None,
+           state_name=None, output_dir=DEFAULT_OUTPUT_DIR, conn=None):
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format {fmt!r}, expected one of {', '.join(FORMATS)}")
+    allowed = PARQUET_COMPRESSION if fmt == 'parquet' else TEXT_COMPRESSION
+    compression = compression or ('snappy' if fmt == 'parquet' else 'none')
+    if compression not in allowed:
+        raise ValueError(f"{fmt} files can be compressed with {', '.join(allowed)}, not {compression!r}")
+
+    conn = conn or get_connection()
+    # legacy TEXT prices become price_cents and cities get weather_city_id first, like
+    # for every other reader
+    setup_price_storage(conn)
+    setup_city_catalog(conn)
+    setup_export_state(conn)
+    if not isinstance(source, Source):
+        source = JOINS.get(source) or table_source(conn, source, fmt)
+    name = state_name or source.name
+    if (incremental or since is not None) and source.key is None:
+        raise ValueError(f"{source.name} has no key to export from a watermark, it can only be exported whole")
+
+    lo = hi = None
+    if incremental or since is not None:
+        lo = since if since is not None else load_watermark(conn, name)
+        hi = conn.execute(source.bound).fetchone()[0] or 0
+        if hi <= lo:
+            return 0, None
+
+    path = path or default_path(name, fmt, compression, lo, hi, output_dir)
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    query, params = source.query(lo, hi)
+    cursor = conn.cursor()
+    cursor.execute(query, params)
+    columns = [d[0] for d in cursor.description]
+    chunks = iter(lambda: cursor.fetchmany(chunk_size), [])
+
+    partial = path + '.part'
+    try:
+        rows = WRITERS[fmt](partial, columns, chunks, compression)
+    except BaseException:
+        cursor.close()
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    os.replace(partial, path)
+    if incremental:
+        save_watermark(conn, name, hi, rows, path)
+    return rows, path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream tables and joins of unified_data.db to CSV, JSON lines or Parquet")
+    parser.add_argument('source', nargs='?', help=f"a table name or one of {', '.join(JOINS)}")
+    parser.add_argument('--query', help="export the rows of this SELECT instead")
+    parser.add_argument('--key', help="integer output column of --query that --incremental and --since filter on")
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--compression', choices=sorted(set(TEXT_COMPRESSION + PARQUET_COMPRESSION)),
+                        help="gzip or none for csv and jsonl (default none), none, snappy, gzip or zstd for parquet (default snappy)")
+    parser.add_argument('--output', help="file to write (default <output-dir>/<name>.<format>)")
+    parser.add_argument('--output-dir', default=DEFAULT_OUTPUT_DIR)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="rows per fetch and per parquet row group")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only the rows added since the last incremental export under this name")
+    parser.add_argument('--since', type=int, metavar='KEY', help="only rows with a key above this (rowid for tables)")
+    parser.add_argument('--name', help="export_state name of the watermark (default the source)")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    if (args.source is None) == (args.query is None):
+        parser.error("give a source or --query")
+    if args.key and not args.query:
+        parser.error("--key only applies to --query")
+
+    source = query_source(args.query, args.key, args.name or 'query') if args.query else args.source
+    with instrumentation.session(args.metrics, args.profile):
+        started = time.perf_counter()
+        try:
+            rows, path = export(source, args.format, args.output, args.compression, args.chunk_size,
+                                args.incremental, args.since, args.name, args.output_dir)
+        except ValueError as e:
+            parser.error(str(e))
+        if path is None:
+            print("Nothing new to export.")
+            return 0
+        seconds = time.perf_counter() - started
+        size = os.path.getsize(path) / 1e6
+        print(f"Exported {rows} rows to {path} ({size:.1f} MB) in {seconds:.2f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+# pulls listing prices out of KBB search result pages
+#
+# "soup" is the reference implementation (a full BeautifulSoup tree), "strainer" only
+# builds tree nodes for the price divs, and "fast" jumps straight to each price div and
+# parses just that element, so the rest of the page is never tokenized
+
+from html.parser import HTMLParser
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+PRICE_CLASS = "text-size-600 text-ultra-bold first-price"
+PRICE_MARKER = "first-price"
+CHUNK_SIZE = 2048
+
+
+def extract_soup(html):
+    soup = BeautifulSoup(html, 'html.parser')
+
+    price_tags = soup.find_all('div', class_=PRICE_CLASS)
+    return [price_tag.text.strip() for price_tag in price_tags if price_tag.text != '']
+
+
+# at parse time the strainer sees the raw attribute string, so compare on whitespace
+# separated tokens and leave the exact class match to find_all
+def _has_price_class(value):
+    if value is None:
+        return False
+    tokens = value.split() if isinstance(value, str) else value
+    return PRICE_MARKER in tokens
+
+
+def extract_strainer(html):
+    only_prices = SoupStrainer('div', class_=_has_price_class)
+    soup = BeautifulSoup(html, 'html.parser', parse_only=only_prices)
+
+    price_tags = soup.find_all('div', class_=PRICE_CLASS)
+    return [price_tag.text.strip() for price_tag in price_tags if price_tag.text != '']
+
+
+# parses a single element starting at a '<'. if that element is a price div its text is
+# collected, otherwise the parser gives up straight away. tag_length is the length of the
+# first start tag as written, quotes and all
+class _PriceDivParser(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.depth = 0
+        self.matched = False
+        self.done = False
+        self.parts = []
+        self.tag_length = 0
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if not self.matched:
+            self.tag_length = len(self.get_starttag_text())
+            classes = dict(attrs).get('class') or ''
+            if tag != 'div' or ' '.join(classes.split()) != PRICE_CLASS:
+                self.done = True
+                return
+            self.matched = True
+        if tag == 'div':
+            self.depth += 1
+
+    def handle_endtag(self, tag):
+        if not self.matched:
+            self.done = True
+        elif not self.done and tag == 'div':
+            self.depth -= 1
+            if self.depth == 0:
+                self.done = True
+
+    def handle_data(self, data):
+        if not self.matched:
+            self.done = True
+        elif not self.done:
+            self.parts.append(data)
+
+    # anything other than a start tag before the price div means the '<' was not one
+    def handle_comment(self, data):
+        if not self.matched:
+            self.done = True
+
+    def handle_decl(self, decl):
+        self.done = True
+
+    def handle_pi(self, data):
+        self.done = True
+
+
+def _is_div_start(html, start):
+    return html[start + 1:start + 4].lower() == 'div' and html[start + 4:start + 5] in (' ', '\t', '\n', '\r', '\f')
+
+
+def extract_fast(html):
+    prices = []
+    pos = html.find(PRICE_MARKER)
+    while pos != -1:
+        # only a div start tag can hold the marker in its attributes, a marker in text,
+        # a comment or another tag is skipped. whether the tag is still open at the
+        # marker is left to the parser, a '>' can sit inside a quoted attribute
+        start = html.rfind('<', 0, pos)
+        if start != -1 and _is_div_start(html, start):
+            parser = _PriceDivParser()
+            # most price divs have no nested divs, so try up to the first closing tag
+            end = html.find('</div>', pos)
+            offset = end + len('</div>') if end != -1 else len(html)
+            parser.feed(html[start:offset])
+            while not parser.done and offset < len(html):
+                parser.feed(html[offset:offset + CHUNK_SIZE])
+                offset += CHUNK_SIZE
+            text = ''.join(parser.parts)
+            tag_end = start + parser.tag_length
+            if parser.matched and pos < tag_end:
+                if text != '':
+                    prices.append(text.strip())
+                # later markers in the same start tag belong to this div
+                pos = tag_end - len(PRICE_MARKER)
+        pos = html.find(PRICE_MARKER, pos + len(PRICE_MARKER))
+    return prices
+
+
+EXTRACTORS = {
+    'soup': extract_soup,
+    'strainer': extract_strainer,
+    'fast': extract_fast,
+}
+DEFAULT_EXTRACTOR = 'fast'
+
+
+def get_extractor(name=None):
+    name = name or DEFAULT_EXTRACTOR
+    if name not in EXTRACTORS:
+        raise ValueError(f"Unknown price extractor {name!r}, expected one of {', '.join(EXTRACTORS)}")
+    return EXTRACTORS[name]
+
+
+def extract_prices(html, backend=None):
+    return get_extractor(backend)(html)
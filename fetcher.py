@@ -0,0 +1,158 @@
+# concurrent, rate limited page fetching used by the scraper
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import instrumentation
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# errors worth another attempt, any other requests error fails the page straight away
+RETRY_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+
+class FetchError(Exception):
+    pass
+
+
+# spaces requests to a single host out to a fixed rate and caps how many are in flight
+class HostLimiter:
+    def __init__(self, requests_per_second, max_concurrency):
+        self.interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.lock = threading.Lock()
+        self.next_start = 0.0
+
+    def acquire(self):
+        self.slots.acquire()
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+    def release(self):
+        self.slots.release()
+
+
+class Fetcher:
+    def __init__(self, requests_per_second=2.0, max_concurrency=4, retries=3,
+                 backoff_factor=0.5, timeout=30, headers=None, cache=None, replay_only=False):
+        self.requests_per_second = requests_per_second
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.headers = headers or {}
+        self.cache = cache
+        self.replay_only = replay_only
+        self.sessions = {}
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    # one keep-alive session (and connection pool) per host
+    def _host_state(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.sessions:
+                session = instrumentation.instrument_session(requests.Session())
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers.update(self.headers)
+                self.sessions[host] = session
+                self.limiters[host] = HostLimiter(self.requests_per_second, self.max_concurrency)
+            return self.sessions[host], self.limiters[host]
+
+    def _backoff(self, attempt, response=None):
+        delay = self.backoff_factor * (2 ** attempt)
+        if response is not None and response.headers.get('Retry-After', '').isdigit():
+            delay = max(delay, int(response.headers['Retry-After']))
+        time.sleep(delay)
+
+    def fetch(self, url):
+        cached = self.cache.get(url) if self.cache else None
+        if self.replay_only:
+            if cached is None:
+                raise FetchError(f"{url} is not in the cache and replay only mode is on")
+            instrumentation.record_cache('kbb_pages', 'hits')
+            return cached
+        if cached is not None and self.cache.is_fresh(cached):
+            instrumentation.record_cache('kbb_pages', 'hits')
+            return cached
+
+        conditional = self.cache.validators(cached) if cached is not None else {}
+        response = self._get(url, conditional)
+        if response.status_code == 304 and cached is not None:
+            self.cache.refresh(url, cached)
+            instrumentation.record_cache('kbb_pages', 'revalidated')
+            return cached
+        if self.cache:
+            instrumentation.record_cache('kbb_pages', 'misses')
+        response.from_cache = False
+        if self.cache and response.status_code == 200:
+            self.cache.put(url, response.text, response.headers)
+        return response
+
+    def _get(self, url, headers):
+        session, limiter = self._host_state(url)
+        for attempt in range(self.retries + 1):
+            limiter.acquire()
+            try:
+                response = session.get(url, headers=headers, timeout=self.timeout)
+            except RETRY_ERRORS as e:
+                if attempt == self.retries:
+                    raise FetchError(f"Failed to load page {url}: {e}") from e
+                response = None
+            except requests.RequestException as e:
+                raise FetchError(f"Failed to load page {url}: {e}") from e
+            finally:
+                limiter.release()
+
+            if response is not None and response.status_code not in RETRY_STATUSES:
+                return response
+            if attempt < self.retries:
+                self._backoff(attempt, response)
+        raise FetchError(f"Failed to load page {url} (status {response.status_code})")
+
+    # jobs is an iterable of (key, url). yields (key, response, error) as each fetch
+    # finishes; jobs are only pulled from the iterable when a worker is free, so the
+    # caller can stop early without having fetched the rest of the matrix
+    def fetch_all(self, jobs, max_workers=None):
+        max_workers = max_workers or self.max_concurrency
+        jobs = iter(jobs)
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        in_flight = {}
+        try:
+            for key, url in jobs:
+                in_flight[executor.submit(self.fetch, url)] = key
+                if len(in_flight) < max_workers:
+                    continue
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield self._result(in_flight.pop(future), future)
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield self._result(in_flight.pop(future), future)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    # a failed page is handed back as its error, one bad page (or a page cache that can
+    # not be written) must not end the whole run
+    def _result(self, key, future):
+        try:
+            return key, future.result(), None
+        except (FetchError, OSError) as e:
+            return key, None, e
+
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
+        self.sessions.clear()
+        self.limiters.clear()
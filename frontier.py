@@ -0,0 +1,95 @@
+# crawl frontier for the scraper: one row per (car, city, result page) that remembers
+# when it was last fetched and how many new prices it produced, so each run picks up
+# where the last one stopped instead of starting from the top of the cars list
+
+from db import transaction
+
+PAGE_SIZE = 25
+STALE_AFTER_DAYS = 7
+MAX_ATTEMPTS = 3
+
+
+def setup_frontier(conn):
+    c = conn.cursor()
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS crawl_frontier (
+            car_id INTEGER,
+            city_id INTEGER,
+            page INTEGER,
+            status TEXT DEFAULT 'pending',
+            last_fetched TEXT,
+            listings INTEGER DEFAULT 0,
+            yield INTEGER DEFAULT 0,
+            total_yield INTEGER DEFAULT 0,
+            attempts INTEGER DEFAULT 0,
+            PRIMARY KEY (car_id, city_id, page),
+            FOREIGN KEY (car_id) REFERENCES cars(id),
+            FOREIGN KEY (city_id) REFERENCES cities(id)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_frontier_schedule ON crawl_frontier(status, last_fetched)')
+
+
+# makes sure every configured car exists and has a first page in the frontier for every
+# city of the catalogue (or just city_ids)
+def seed_frontier(conn, cars, city_ids=None):
+    with transaction(conn):
+        _seed_frontier(conn.cursor(), cars, city_ids)
+
+def _seed_frontier(c, cars, city_ids):
+    c.executemany('INSERT OR IGNORE INTO cars (make, model, year) VALUES (?, ?, ?)', cars)
+    city_filter = ''
+    if city_ids is not None:
+        city_filter = f" AND cities.id IN ({', '.join(str(int(city_id)) for city_id in city_ids)})"
+    c.executemany(f'''
+        INSERT OR IGNORE INTO crawl_frontier (car_id, city_id, page)
+        SELECT cars.id, cities.id, 0 FROM cars, cities
+        WHERE cars.make = ? AND cars.model = ? AND cars.year = ?{city_filter}''', cars)
+
+
+# never fetched units first, then failures worth retrying, then stale units with the
+# best recent yield. fresh units are left alone until they go stale, and a unit that used
+# up its attempts is tried again once its last failure is as old as a stale unit
+def next_units(conn, limit, stale_after_days=STALE_AFTER_DAYS, max_attempts=MAX_ATTEMPTS):
+    c = conn.cursor()
+    c.execute('''
+        SELECT f.car_id, f.city_id, f.page, cars.make, cars.model, cars.year,
+               cities.city, cities.state, cities.zip_code
+        FROM crawl_frontier f
+        JOIN cars ON f.car_id = cars.id
+        JOIN cities ON f.city_id = cities.id
+        WHERE f.status = 'pending'
+           OR (f.status = 'failed' AND (f.attempts < ? OR f.last_fetched < datetime('now', ?)))
+           OR (f.status = 'done' AND f.last_fetched < datetime('now', ?))
+        ORDER BY CASE f.status WHEN 'pending' THEN 0 WHEN 'failed' THEN 1 ELSE 2 END,
+                 f.yield DESC, f.last_fetched ASC, f.page ASC
+        LIMIT ?
+    ''', (max_attempts, f'-{stale_after_days} days', f'-{stale_after_days} days', limit))
+    return c.fetchall()
+
+
+# records a fetched page. a full page means there are probably more results, so the
+# next page is queued behind it
+def mark_fetched(conn, car_id, city_id, page, listings, new_prices):
+    with transaction(conn):
+        _mark_fetched(conn.cursor(), car_id, city_id, page, listings, new_prices)
+
+def _mark_fetched(c, car_id, city_id, page, listings, new_prices):
+    c.execute('''
+        UPDATE crawl_frontier
+        SET status = 'done', last_fetched = datetime('now'), listings = ?, yield = ?,
+            total_yield = total_yield + ?, attempts = 0
+        WHERE car_id = ? AND city_id = ? AND page = ?
+    ''', (listings, new_prices, new_prices, car_id, city_id, page))
+    if listings >= PAGE_SIZE:
+        c.execute('INSERT OR IGNORE INTO crawl_frontier (car_id, city_id, page) VALUES (?, ?, ?)',
+                  (car_id, city_id, page + 1))
+
+
+def mark_failed(conn, car_id, city_id, page):
+    c = conn.cursor()
+    c.execute('''
+        UPDATE crawl_frontier
+        SET status = 'failed', last_fetched = datetime('now'), attempts = attempts + 1
+        WHERE car_id = ? AND city_id = ? AND page = ?
+    ''', (car_id, city_id, page))
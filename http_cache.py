@@ -0,0 +1,116 @@
+# on-disk cache of fetched pages, keyed by url, with ttl and size based lru eviction
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+DEFAULT_CACHE_DIR = '.kbb_cache'
+
+
+class CachedPage:
+    def __init__(self, url, text, meta):
+        self.url = url
+        self.text = text
+        self.status_code = 200
+        self.headers = {}
+        self.from_cache = True
+        self.meta = meta
+
+
+class PageCache:
+    def __init__(self, directory=DEFAULT_CACHE_DIR, ttl=24 * 3600, max_bytes=200 * 1024 * 1024):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.total_bytes = sum(size for _, size, _ in self._entries())
+
+    def _paths(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        folder = os.path.join(self.directory, key[:2])
+        return os.path.join(folder, key + '.html'), os.path.join(folder, key + '.json')
+
+    # (meta path, body size, last used) for every entry on disk
+    def _entries(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith('.json'):
+                    continue
+                meta_path = os.path.join(root, name)
+                body_path = meta_path[:-5] + '.html'
+                try:
+                    yield meta_path, os.path.getsize(body_path), os.path.getmtime(meta_path)
+                except OSError:
+                    continue
+
+    def get(self, url):
+        body_path, meta_path = self._paths(url)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            with open(body_path, encoding='utf-8') as f:
+                text = f.read()
+        except (OSError, ValueError):
+            return None
+        # the meta file's mtime doubles as the lru clock
+        os.utime(meta_path)
+        return CachedPage(url, text, meta)
+
+    def is_fresh(self, page):
+        return time.time() - page.meta['fetched_at'] < self.ttl
+
+    # headers for a conditional request that revalidates a stale entry
+    def validators(self, page):
+        headers = {}
+        if page.meta.get('etag'):
+            headers['If-None-Match'] = page.meta['etag']
+        if page.meta.get('last_modified'):
+            headers['If-Modified-Since'] = page.meta['last_modified']
+        return headers
+
+    def put(self, url, text, headers):
+        body_path, meta_path = self._paths(url)
+        os.makedirs(os.path.dirname(body_path), exist_ok=True)
+        meta = {
+            'url': url,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'fetched_at': time.time(),
+        }
+        old_size = os.path.getsize(body_path) if os.path.exists(body_path) else 0
+        data = text.encode('utf-8')
+        self._write(body_path, data)
+        self._write(meta_path, json.dumps(meta).encode('utf-8'))
+        with self.lock:
+            self.total_bytes += len(data) - old_size
+            over = self.total_bytes > self.max_bytes
+        if over:
+            self.evict()
+
+    # a 304 means the stored body is still good, restart its ttl
+    def refresh(self, url, page):
+        _, meta_path = self._paths(url)
+        page.meta['fetched_at'] = time.time()
+        self._write(meta_path, json.dumps(page.meta).encode('utf-8'))
+
+    def evict(self):
+        with self.lock:
+            entries = sorted(self._entries(), key=lambda entry: entry[2])
+            for meta_path, size, _ in entries:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                for path in (meta_path, meta_path[:-5] + '.html'):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                self.total_bytes -= size
+
+    def _write(self, path, data):
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
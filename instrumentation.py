@@ -0,0 +1,229 @@
+# opt-in metrics for the scripts: timing spans per stage and function, http latency and
+# status per host, cache hit ratios and sqlite statement counts and durations
+#
+#   python OMfinal.py --metrics metrics.jsonl --profile omfinal.prof
+#
+# spans are written to the json-lines file as they finish, one object per line:
+#   {"type": "span", "name": "OMfinal.fetch_weather_batch", "seconds": 1.92, "thread": "MainThread", ...}
+# and when the run ends, one summary line per host, cache and sql statement:
+#   {"type": "http", "host": "archive-api.open-meteo.com", "requests": 12, "statuses": {"200": 12}, ...}
+#   {"type": "cache", "name": "requests_cache", "hits": 10, "misses": 2, "hit_ratio": 0.83}
+#   {"type": "sqlite", "statement": "INSERT INTO hourly_climate ...", "count": 5, "seconds": 0.04}
+#
+# everything is off until enable() (or session()) is called. disabled, a decorated
+# function costs one flag check, span() hands back a shared no-op context, and sqlite
+# connections are opened without the timing wrapper
+
+import atexit
+import functools
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from urllib.parse import urlsplit
+
+ENABLED = False
+STATEMENT_LENGTH = 80
+
+_lock = threading.Lock()
+_sink = None
+_http = {}
+_caches = {}
+_statements = {}
+_noop = nullcontext()
+
+
+def enable(path):
+    global ENABLED, _sink
+    with _lock:
+        if _sink is None:
+            _sink = open(path, 'a', buffering=1)
+            atexit.register(disable)
+        ENABLED = True
+
+# writes the summary lines and closes the file
+def disable():
+    global ENABLED, _sink
+    if _sink is None:
+        return
+    for record in summary():
+        _write(record)
+    with _lock:
+        ENABLED = False
+        _sink.close()
+        _sink = None
+        _http.clear()
+        _caches.clear()
+        _statements.clear()
+
+
+def _write(record):
+    line = json.dumps(record, default=str)
+    with _lock:
+        if _sink is not None:
+            _sink.write(line + '\n')
+
+
+@contextmanager
+def _span(name, fields):
+    started = time.perf_counter()
+    wall = time.time()
+    try:
+        yield
+    finally:
+        _write(dict(fields, type='span', name=name, start=wall, seconds=time.perf_counter() - started,
+                    thread=threading.current_thread().name))
+
+# times the block as a span, e.g. `with span('stage', stage='scrape'):`
+def span(name, **fields):
+    if not ENABLED:
+        return _noop
+    return _span(name, fields)
+
+
+# records every call of the decorated function as a span named module.function
+def timed(func):
+    module = os.path.splitext(os.path.basename(func.__code__.co_filename))[0]
+    name = f"{module}.{func.__qualname__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not ENABLED:
+            return func(*args, **kwargs)
+        with _span(name, {}):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def record_http(host, status, seconds):
+    if not ENABLED:
+        return
+    with _lock:
+        stats = _http.setdefault(host, {'requests': 0, 'statuses': {}, 'seconds': 0.0, 'max_seconds': 0.0})
+        stats['requests'] += 1
+        stats['statuses'][str(status)] = stats['statuses'].get(str(status), 0) + 1
+        stats['seconds'] += seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+# outcome is 'hits', 'misses' or 'revalidated' (a stale entry the server confirmed,
+# which counts as a hit)
+def record_cache(name, outcome):
+    if not ENABLED:
+        return
+    with _lock:
+        counts = _caches.setdefault(name, {})
+        counts[outcome] = counts.get(outcome, 0) + 1
+
+
+def _response_hook(response, *args, **kwargs):
+    if ENABLED:
+        record_http(urlsplit(response.url).netloc, response.status_code, response.elapsed.total_seconds())
+
+# a requests_cache session runs the hooks twice for a response from the network, first
+# for the raw response and then for the wrapped one with from_cache set. only the second
+# is counted, cache hits as hits and the rest as http requests and misses
+def _cached_response_hook(response, *args, **kwargs):
+    if not ENABLED or not hasattr(response, 'from_cache'):
+        return
+    if response.from_cache:
+        record_cache('requests_cache', 'hits')
+    else:
+        record_cache('requests_cache', 'misses')
+        _response_hook(response)
+
+# reports every response of a requests session (cached=True for a requests_cache one)
+def instrument_session(session, cached=False):
+    session.hooks['response'].append(_cached_response_hook if cached else _response_hook)
+    return session
+
+
+def _record_statement(sql, seconds):
+    if not ENABLED:
+        return
+    key = re.sub(r'\s+', ' ', sql).strip()[:STATEMENT_LENGTH]
+    with _lock:
+        stats = _statements.setdefault(key, [0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, *args):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, *args)
+        finally:
+            _record_statement(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, *args):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, *args)
+        finally:
+            _record_statement(sql, time.perf_counter() - started)
+
+
+# connection class for sqlite3.connect(factory=...). conn.execute goes through cursor(),
+# so every statement is timed. time spent fetching rows afterwards is not included
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+# the connection factory db.connect should use, None while disabled
+def connection_factory():
+    return TimedConnection if ENABLED else None
+
+
+def summary():
+    with _lock:
+        records = []
+        for host, stats in sorted(_http.items()):
+            records.append(dict(stats, type='http', host=host,
+                                mean_seconds=stats['seconds'] / stats['requests'] if stats['requests'] else None))
+        for name, counts in sorted(_caches.items()):
+            lookups = sum(counts.values())
+            records.append(dict(counts, type='cache', name=name,
+                                hit_ratio=(lookups - counts.get('misses', 0)) / lookups if lookups else None))
+        for statement, (count, seconds) in sorted(_statements.items(), key=lambda item: -item[1][1]):
+            records.append({'type': 'sqlite', 'statement': statement, 'count': count, 'seconds': seconds})
+    return records
+
+
+# metrics to metrics_path and/or a cProfile of the block to profile_path (load it with
+# pstats or snakeviz). the slowest functions are printed when profiling ends
+@contextmanager
+def session(metrics_path=None, profile_path=None, top=20):
+    if metrics_path:
+        enable(metrics_path)
+    profiler = None
+    if profile_path:
+        # pstats pulls in inspect and dataclasses, a third of a cold start
+        import cProfile
+        profiler = cProfile.Profile()
+    try:
+        with span('run'):
+            if profiler:
+                profiler.enable()
+            try:
+                yield
+            finally:
+                if profiler:
+                    profiler.disable()
+    finally:
+        if profiler:
+            import pstats
+            profiler.dump_stats(profile_path)
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(top)
+            print(f"Profile written to {profile_path}")
+        if metrics_path:
+            disable()
+            print(f"Metrics written to {metrics_path}")
+
+
+# adds the --metrics and --profile options to a script's parser
+def add_arguments(parser):
+    parser.add_argument('--metrics', metavar='PATH', help="append timing, http, cache and sqlite metrics to this json-lines file")
+    parser.add_argument('--profile', metavar='PATH', help="run under cProfile and write the stats here")
@@ -0,0 +1,115 @@
+# local stand-in for kbb.com search result pages, so the scraper can run offline
+#
+#   python kbb_stub.py --pages saved_pages --record     proxy kbb.com and save every page
+#   python kbb_stub.py --pages saved_pages              serve the saved pages
+#
+# then run the scraper with KBB_BASE_URL=http://127.0.0.1:8765
+# pages are stored like the scraper's page cache, <sha256 of the kbb url>.html with a
+# .json next to it holding {"url": ...}, so a .kbb_cache directory can be served as is.
+# a request matches a saved page by path and query, whatever host the page was saved from
+
+import argparse
+import hashlib
+import json
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+from urllib.request import Request, urlopen
+
+UPSTREAM_URL = "https://www.kbb.com"
+
+
+def _request_key(url):
+    parts = urlsplit(url)
+    return f"{parts.path}?{parts.query}" if parts.query else parts.path
+
+
+# {path?query: .html path} for every saved page under directory
+def index_pages(directory):
+    pages = {}
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if not name.endswith('.json'):
+                continue
+            body_path = os.path.join(root, name[:-5] + '.html')
+            try:
+                with open(os.path.join(root, name)) as f:
+                    url = json.load(f)['url']
+            except (OSError, ValueError, KeyError):
+                continue
+            if os.path.exists(body_path):
+                pages[_request_key(url)] = body_path
+    return pages
+
+
+def save_page(directory, url, body):
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    folder = os.path.join(directory, key[:2])
+    os.makedirs(folder, exist_ok=True)
+    body_path = os.path.join(folder, key + '.html')
+    with open(body_path, 'wb') as f:
+        f.write(body)
+    with open(os.path.join(folder, key + '.json'), 'w') as f:
+        json.dump({'url': url}, f)
+    return body_path
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    pages_dir = None
+    pages = {}
+    record = False
+    upstream = UPSTREAM_URL
+
+    def do_GET(self):
+        key = _request_key(self.path)
+        body_path = self.pages.get(key)
+        if body_path is None and self.record:
+            url = self.upstream + key
+            with urlopen(Request(url, headers={'User-Agent': 'Mozilla/5.0'})) as upstream:
+                body_path = save_page(self.pages_dir, url, upstream.read())
+            self.pages[key] = body_path
+
+        if body_path is None:
+            self._reply(404, b'')
+            return
+        with open(body_path, 'rb') as f:
+            body = f.read()
+        # an etag lets the scraper's page cache revalidate against the stub
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self._reply(304, b'', etag)
+            return
+        self._reply(200, body, etag)
+
+    def _reply(self, status, body, etag=None):
+        self.send_response(status)
+        if etag:
+            self.send_header('ETag', etag)
+        if status == 200:
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=8765, pages_dir='saved_pages', record=False):
+    os.makedirs(pages_dir, exist_ok=True)
+    handler = type('Handler', (StubHandler,), {
+        'pages_dir': pages_dir, 'pages': index_pages(pages_dir), 'record': record,
+    })
+    return ThreadingHTTPServer(('127.0.0.1', port), handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve saved KBB search result pages")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--pages', default='saved_pages', help="directory of saved pages (a page cache works too)")
+    parser.add_argument('--record', action='store_true', help="fetch unknown pages from kbb.com and save them")
+    args = parser.parse_args()
+    server = serve(args.port, args.pages, args.record)
+    print(f"Serving {len(server.RequestHandlerClass.pages)} pages on http://127.0.0.1:{args.port}")
+    server.serve_forever()
@@ -0,0 +1,153 @@
+# local stand-in for the Open-Meteo archive api, so the weather fetch can run offline
+#
+#   python openmeteo_stub.py --responses recordings --record     proxy the real api and save every response
+#   python openmeteo_stub.py --responses recordings              serve the saved responses
+#   python openmeteo_stub.py --synthetic                         answer anything with generated data
+#
+# then run the fetch with OPEN_METEO_ARCHIVE_URL=http://127.0.0.1:8766/v1/archive
+# responses are the raw FlatBuffer bodies, stored under a hash of the query string
+
+import argparse
+import hashlib
+import math
+import os
+from datetime import date, datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlsplit
+from urllib.request import urlopen
+
+import flatbuffers
+import numpy as np
+
+UPSTREAM_URL = "https://archive-api.open-meteo.com/v1/archive"
+
+
+def response_key(query):
+    params = sorted((k, v) for k, v in parse_qsl(query) if k != 'format')
+    return hashlib.sha256(urlencode(params).encode('utf-8')).hexdigest()
+
+
+# builds one length-prefixed WeatherApiResponse message with a single hourly or daily
+# block, the same layout the api streams back per location
+def encode_response(latitude, longitude, start_time, interval, series, daily=False, location_id=0):
+    builder = flatbuffers.Builder(1024)
+    variables = []
+    for i, values in enumerate(series):
+        vector = builder.CreateNumpyVector(np.asarray(values, dtype=np.float32))
+        builder.StartObject(4)
+        builder.PrependUint8Slot(0, i + 1, 0)
+        builder.PrependUOffsetTRelativeSlot(3, vector, 0)
+        variables.append(builder.EndObject())
+    builder.StartVector(4, len(variables), 4)
+    for offset in reversed(variables):
+        builder.PrependUOffsetTRelative(offset)
+    variables_vector = builder.EndVector()
+
+    length = len(series[0]) if series else 0
+    builder.StartObject(4)
+    builder.PrependInt64Slot(0, start_time, 0)
+    builder.PrependInt64Slot(1, start_time + length * interval, 0)
+    builder.PrependInt32Slot(2, interval, 0)
+    builder.PrependUOffsetTRelativeSlot(3, variables_vector, 0)
+    block = builder.EndObject()
+
+    builder.StartObject(12)
+    builder.PrependFloat32Slot(0, latitude, 0)
+    builder.PrependFloat32Slot(1, longitude, 0)
+    builder.PrependInt64Slot(4, location_id, 0)
+    builder.PrependUOffsetTRelativeSlot(10 if daily else 11, block, 0)
+    builder.Finish(builder.EndObject())
+    data = bytes(builder.Output())
+    return len(data).to_bytes(4, 'little') + data
+
+
+# deterministic weather for any request: a seasonal temperature cycle that gets colder
+# with latitude, steady humidity and wind, and light rain
+def synthetic_body(query):
+    params = dict(parse_qsl(query))
+    latitudes = [float(v) for v in params['latitude'].split(',')]
+    longitudes = [float(v) for v in params['longitude'].split(',')]
+    start = date.fromisoformat(params['start_date'])
+    end = date.fromisoformat(params['end_date'])
+    daily = 'daily' in params
+    names = (params.get('daily') or params.get('hourly')).split(',')
+
+    interval = 86400 if daily else 3600
+    steps = ((end - start).days + 1) * (1 if daily else 24)
+    start_time = int(datetime(start.year, start.month, start.day, tzinfo=timezone.utc).timestamp())
+    day_of_year = (start.timetuple().tm_yday + np.arange(steps) * interval / 86400.0) % 365.25
+
+    body = b''
+    for location_id, (latitude, longitude) in enumerate(zip(latitudes, longitudes)):
+        season = np.cos(2 * math.pi * (day_of_year - 200) / 365.25)
+        temperature = 25 - 0.5 * abs(latitude) + 12 * season * (abs(latitude) / 45)
+        humidity = np.full(steps, 50 + (longitude % 40))
+        wind = np.full(steps, 5 + abs(latitude) / 10)
+        rain = np.where(np.arange(steps) % 7 == 0, 0.5, 0.0)
+        # variables come back in the order they were asked for, which for OMfinal is
+        # temperature, humidity, wind, precipitation
+        series = [temperature, humidity, wind, rain][:len(names)]
+        body += encode_response(latitude, longitude, start_time, interval, series, daily, location_id)
+    return body
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    responses_dir = None
+    record = False
+    synthetic = False
+    upstream = UPSTREAM_URL
+
+    def do_GET(self):
+        query = urlsplit(self.path).query
+        path = os.path.join(self.responses_dir, response_key(query) + '.fb') if self.responses_dir else None
+
+        body = None
+        if path and os.path.exists(path):
+            with open(path, 'rb') as f:
+                body = f.read()
+        elif self.record:
+            with urlopen(f"{self.upstream}?{query}") as upstream:
+                body = upstream.read()
+            with open(path, 'wb') as f:
+                f.write(body)
+        elif self.synthetic:
+            body = synthetic_body(query)
+
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=8766, responses_dir=None, record=False, synthetic=False):
+    if responses_dir:
+        os.makedirs(responses_dir, exist_ok=True)
+    handler = type('Handler', (StubHandler,), {
+        'responses_dir': responses_dir, 'record': record, 'synthetic': synthetic,
+    })
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve recorded or synthetic Open-Meteo archive responses")
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--responses', help="directory of recorded responses")
+    parser.add_argument('--record', action='store_true', help="fetch unknown requests from the real api and save them")
+    parser.add_argument('--synthetic', action='store_true', help="generate data for requests with no recording")
+    args = parser.parse_args()
+    if args.record and not args.responses:
+        parser.error("--record needs --responses")
+    server = serve(args.port, args.responses, args.record, args.synthetic)
+    print(f"Serving on http://127.0.0.1:{args.port}/v1/archive")
+    server.serve_forever()
@@ -0,0 +1,308 @@
+# one entry point for the whole refresh: scrape, weather, climate averages and
+# aggregates, depreciation, the report and (optionally) the charts, run as a dag of stages
+#
+#   scrape ─────────────────────────► depreciation ──┐
+#   weather ─┬─► climate_averages ───────────────────┴─► report ─► charts
+#            └─► climate_aggregates
+#
+# stages whose dependencies are done run side by side on a thread pool, so the scraper
+# and the weather loader (independent sources, both already incremental) fetch at the
+# same time. every derived stage records a watermark of its inputs in pipeline_state:
+# row count and max id for the large append-only tables, a content hash for the small
+# derived ones. a stage whose inputs still match its watermark is skipped, so a refresh
+# with nothing new only runs the two source stages, which find nothing to fetch. when
+# the new price rows are plain appends, depreciation is recomputed for the cities they
+# belong to only
+
+import argparse
+import hashlib
+import json
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+from city_catalog import DEFAULT_CATALOG
+from db import get_connection, transaction
+from depreciation import STATISTICS
+import instrumentation
+from instrumentation import span
+
+STAGE_ORDER = ('scrape', 'weather', 'climate_averages', 'climate_aggregates', 'depreciation', 'report', 'charts')
+
+
+def setup_pipeline_state(conn):
+    c = conn.cursor()
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS pipeline_state (
+            stage TEXT PRIMARY KEY,
+            watermark TEXT,
+            finished_at REAL,
+            seconds REAL
+        )
+    ''')
+
+def load_state(conn):
+    c = conn.cursor()
+    c.execute('SELECT stage, watermark FROM pipeline_state')
+    return {stage: json.loads(watermark) for stage, watermark in c.fetchall()}
+
+def save_state(conn, stage, watermark, seconds):
+    with transaction(conn):
+        conn.execute('INSERT OR REPLACE INTO pipeline_state (stage, watermark, finished_at, seconds) VALUES (?, ?, ?, ?)',
+                     (stage, json.dumps(watermark, sort_keys=True), time.time(), seconds))
+
+
+def _table_exists(conn, table):
+    c = conn.cursor()
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    return c.fetchone() is not None
+
+# [row count, max rowid] of an append-mostly table, read from its rowid index
+def table_watermark(conn, table):
+    if not _table_exists(conn, table):
+        return [0, 0]
+    c = conn.cursor()
+    c.execute(f'SELECT COUNT(*), COALESCE(MAX(rowid), 0) FROM {table}')
+    return list(c.fetchone())
+
+# sha1 of every row of a small table, for tables that are rewritten in place where
+# count and max id would not move
+def table_hash(conn, table, order_by):
+    if not _table_exists(conn, table):
+        return None
+    digest = hashlib.sha1()
+    c = conn.cursor()
+    for row in c.execute(f'SELECT * FROM {table} ORDER BY {order_by}'):
+        digest.update(repr(row).encode())
+    return digest.hexdigest()
+
+def value_hash(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+
+# the cities with price rows past a previous [count, max id] watermark, or None when the
+# table changed in some other way than appends (then every city has to be recomputed)
+def appended_cities(conn, previous, current):
+    if previous is None:
+        return None
+    (old_count, old_max), (new_count, _) = previous, current
+    c = conn.cursor()
+    c.execute('SELECT COUNT(*), COUNT(DISTINCT city_id) FROM prices WHERE id > ?', (old_max,))
+    appended, _ = c.fetchone()
+    if new_count - old_count != appended:
+        return None
+    c.execute('SELECT DISTINCT city_id FROM prices WHERE id > ?', (old_max,))
+    return {city_id for city_id, in c.fetchall()}
+
+
+# a stage: the stages it waits for, a function returning the watermark of its inputs
+# (None for source stages, which always run and do their own change detection) and the
+# function doing the work. run(options, previous) gets the watermark stored by the last
+# successful run and may return extra state to store with the new one
+class Stage:
+    def __init__(self, name, deps, inputs, run):
+        self.name = name
+        self.deps = deps
+        self.inputs = inputs
+        self.run = run
+
+
+def run_scrape(options, previous):
+    import carscraping
+    carscraping.main(max_requests_per_run=options.max_requests,
+                     cache_dir=None if options.no_cache else carscraping.DEFAULT_CACHE_DIR,
+                     replay_only=options.replay, catalog=options.catalog)
+
+def run_weather(options, previous):
+    import OMfinal
+    OMfinal.main(options.backfill, store_dir=options.climate_store, catalog=options.catalog,
+                 store_backfill=options.backfill and options.climate_store is not None)
+
+def climate_inputs(conn, options):
+    return {'hourly_climate': table_watermark(conn, 'hourly_climate'), 'cities': table_watermark(conn, 'cities')}
+
+def run_climate_averages(options, previous):
+    from depreciation import store_average_weather
+    print(f"Updated climate averages for {store_average_weather()} cities.")
+
+def run_climate_aggregates(options, previous):
+    from climate_aggregates import refresh_climate_aggregates
+    print(f"Wrote {refresh_climate_aggregates()} climate aggregate rows.")
+
+def depreciation_inputs(conn, options):
+    return {'prices': table_watermark(conn, 'prices'), 'cars': table_watermark(conn, 'cars'),
+            'statistic': options.statistic}
+
+def run_depreciation(options, previous):
+    from depreciation import fetch_depreciation_groups, update_depreciation
+    from price_store import setup_price_storage
+
+    conn = get_connection()
+    setup_price_storage(conn)
+    current = depreciation_inputs(conn, options)
+    city_ids = None
+    # only plain appends of prices, with the same cars, statistic and model years as
+    # last time, limit the work to the cities that got listings
+    if previous and {k: v for k, v in previous['inputs'].items() if k != 'prices'} == \
+            {k: v for k, v in current.items() if k != 'prices'}:
+        city_ids = appended_cities(conn, previous['inputs']['prices'], current['prices'])
+
+    groups, model_years = fetch_depreciation_groups(conn, statistic=options.statistic)
+    years_hash = value_hash(sorted(model_years.items()))
+    if city_ids is not None and previous.get('model_years') != years_hash:
+        # a new model year shifts every city's comparison
+        city_ids = None
+    update_depreciation(city_ids, statistic=options.statistic, groups=groups, model_years=model_years)
+    scope = 'every city' if city_ids is None else f"{len(city_ids)} changed cities"
+    print(f"Recomputed depreciation for {scope}.")
+    return {'model_years': years_hash}
+
+def report_inputs(conn, options):
+    return {'car_depreciation': table_hash(conn, 'car_depreciation', 'city_id'),
+            'city_averages': table_hash(conn, 'city_averages', 'city_id'),
+            'climate_store': options.climate_store}
+
+def run_report(options, previous):
+    from depreciation import write_stored_report
+    write_stored_report(options.climate_store)
+    print("Wrote depreciation_report.txt.")
+
+def charts_inputs(conn, options):
+    return dict(report_inputs(conn, options), output_dir=options.output_dir)
+
+def run_charts(options, previous):
+    import matplotlib
+    matplotlib.use('Agg')
+    import analysis
+    analysis.main(options.climate_store, headless=True, output_dir=options.output_dir)
+
+
+STAGES = {stage.name: stage for stage in (
+    Stage('scrape', (), None, run_scrape),
+    Stage('weather', (), None, run_weather),
+    Stage('climate_averages', ('weather',), climate_inputs, run_climate_averages),
+    Stage('climate_aggregates', ('weather',), climate_inputs, run_climate_aggregates),
+    Stage('depreciation', ('scrape',), depreciation_inputs, run_depreciation),
+    Stage('report', ('depreciation', 'climate_averages'), report_inputs, run_report),
+    Stage('charts', ('report',), charts_inputs, run_charts),
+)}
+
+
+# runs one stage in the calling thread: 'skipped' when its inputs match the stored
+# watermark, 'ran' otherwise
+def execute_stage(stage, options, state, force=False, dry_run=False):
+    conn = get_connection()
+    previous = state.get(stage.name)
+    watermark = stage.inputs(conn, options) if stage.inputs else None
+    if not force and watermark is not None and previous is not None and previous['inputs'] == watermark:
+        return 'skipped'
+    if dry_run:
+        return 'stale'
+    started = time.perf_counter()
+    with span('stage', stage=stage.name):
+        extra = stage.run(options, previous) or {}
+    # the watermark read before running, so anything written meanwhile runs next time
+    save_state(conn, stage.name, dict(extra, inputs=watermark), time.perf_counter() - started)
+    return 'ran'
+
+
+# stands in for the thread pool with workers=1: stages run in the calling thread, one
+# after the other, which is what --profile needs (cProfile only sees its own thread)
+class _InlineExecutor:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+# the tables the stages share, created here in the calling thread before any stage
+# starts. scrape and weather run side by side and would otherwise both migrate the same
+# database (catalog columns, price cents) at the same time
+def setup_shared_schema():
+    from carscraping import setup_database
+    from OMfinal import initialize_db
+    setup_database()
+    initialize_db()
+
+
+# runs the selected stages in dependency order, each as soon as the stages it depends on
+# are done. stages left out of `stages` count as done. returns {stage: status}
+def run_pipeline(options, stages=STAGE_ORDER, force=(), workers=4, dry_run=False):
+    conn = get_connection()
+    if not dry_run:
+        setup_shared_schema()
+    setup_pipeline_state(conn)
+    state = load_state(conn)
+
+    pending = [name for name in STAGE_ORDER if name in stages]
+    status = {}
+    running = {}
+    with (ThreadPoolExecutor(max_workers=workers) if workers > 1 else _InlineExecutor()) as executor:
+        while pending or running:
+            for name in list(pending):
+                deps = [dep for dep in STAGES[name].deps if dep in stages]
+                if any(status.get(dep) == 'failed' for dep in deps):
+                    status[name] = 'failed'
+                    pending.remove(name)
+                elif all(dep in status for dep in deps):
+                    pending.remove(name)
+                    running[executor.submit(execute_stage, STAGES[name], options, state,
+                                            name in force or 'all' in force, dry_run)] = (name, time.perf_counter())
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, started = running.pop(future)
+                try:
+                    status[name] = future.result()
+                except Exception as e:
+                    print(f"Stage {name} failed: {e!r}")
+                    status[name] = 'failed'
+                print(f"[{name}] {status[name]} in {time.perf_counter() - started:.2f}s")
+    return status
+
+
+def main(options, stages=STAGE_ORDER, force=(), workers=4, dry_run=False):
+    started = time.perf_counter()
+    status = run_pipeline(options, stages, force, workers, dry_run)
+    ran = [name for name in STAGE_ORDER if status.get(name) == 'ran']
+    skipped = [name for name in STAGE_ORDER if status.get(name) == 'skipped']
+    print(f"Pipeline finished in {time.perf_counter() - started:.2f}s: "
+          f"ran {', '.join(ran) or 'nothing'}; up to date: {', '.join(skipped) or 'nothing'}")
+    return status
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refresh every dataset and the report, skipping stages that are up to date")
+    parser.add_argument('--skip', action='append', default=[], choices=STAGE_ORDER,
+                        help="leave a stage out of this run, may be repeated")
+    parser.add_argument('--force', action='append', default=[], choices=STAGE_ORDER + ('all',),
+                        help="run a stage even if its inputs did not change, may be repeated")
+    parser.add_argument('--charts', action='store_true', help="also render the charts headless")
+    parser.add_argument('--output-dir', default='charts', help="where the charts stage writes")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="report which derived stages are stale without running anything")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="stages run at the same time, 1 runs them in order in this thread (use it with --profile)")
+    parser.add_argument('--max-requests', type=int, default=50, help="scraper request budget for this run")
+    parser.add_argument('--no-cache', action='store_true', help="scrape without the page cache")
+    parser.add_argument('--replay', action='store_true', help="scrape from cached pages only")
+    parser.add_argument('--backfill', action='store_true',
+                        help="load every missing weather date, and every missing climate store year with --climate-store")
+    parser.add_argument('--climate-store', nargs='?', const='climate_store', metavar='DIR',
+                        help="keep every weather hour in the columnar store and report averages from it")
+    parser.add_argument('--statistic', choices=STATISTICS, default='mean',
+                        help="listing price statistic the depreciation stage compares")
+    parser.add_argument('--catalog', default=DEFAULT_CATALOG, help="csv of cities")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    stages = [name for name in STAGE_ORDER if name not in args.skip and (name != 'charts' or args.charts)]
+    with instrumentation.session(args.metrics, args.profile):
+        main(args, stages, args.force, args.workers, args.dry_run)
@@ -0,0 +1,208 @@
+# streaming quantile sketches of listing prices, one per (city_id, car_id)
+#
+# each sketch is a merging t-digest: a few dozen (mean, weight) centroids that are small
+# near the tails and larger around the median, so medians and trimmed means come out
+# within a fraction of a percent from a sketch of bounded size. sketches are updated
+# as store_prices inserts listings, persisted in price_sketches, and merge into state
+# and national figures without reading prices again
+
+import math
+from array import array
+
+from db import get_connection, transaction
+
+DEFAULT_COMPRESSION = 100
+
+
+class TDigest:
+    def __init__(self, compression=DEFAULT_COMPRESSION):
+        self.compression = compression
+        self.means = []
+        self.weights = []
+        self.buffer = []
+        self.min = math.inf
+        self.max = -math.inf
+
+    @property
+    def count(self):
+        return sum(self.weights) + sum(w for _, w in self.buffer)
+
+    def add(self, value, weight=1):
+        self.buffer.append((float(value), weight))
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if len(self.buffer) >= 5 * self.compression:
+            self._compress()
+
+    def merge(self, other):
+        other._compress()
+        self.buffer.extend(zip(other.means, other.weights))
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress()
+        return self
+
+    # k1 scale function: a centroid may span one unit of k, which keeps centroids at
+    # the tails small
+    def _k(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def _q(self, k):
+        return (math.sin(min(k * 2 * math.pi / self.compression, math.pi / 2)) + 1) / 2
+
+    def _compress(self):
+        if not self.buffer:
+            return
+        points = sorted(list(zip(self.means, self.weights)) + self.buffer)
+        self.buffer = []
+        total = sum(w for _, w in points)
+        means, weights = [points[0][0]], [points[0][1]]
+        seen = 0
+        limit = total * self._q(self._k(0) + 1)
+        for mean, weight in points[1:]:
+            if seen + weights[-1] + weight <= limit:
+                weights[-1] += weight
+                means[-1] += (mean - means[-1]) * weight / weights[-1]
+            else:
+                seen += weights[-1]
+                limit = total * self._q(self._k(seen / total) + 1)
+                means.append(mean)
+                weights.append(weight)
+        self.means, self.weights = means, weights
+
+    def quantile(self, q):
+        self._compress()
+        if not self.weights:
+            return None
+        total = sum(self.weights)
+        target = q * total
+        # centroid centers on the cumulative weight axis, with min and max as end points
+        cumulative = 0
+        previous_center, previous_mean = 0, self.min
+        for mean, weight in zip(self.means, self.weights):
+            center = cumulative + weight / 2
+            if target <= center:
+                if center == previous_center:
+                    return mean
+                return previous_mean + (mean - previous_mean) * (target - previous_center) / (center - previous_center)
+            previous_center, previous_mean = center, mean
+            cumulative += weight
+        if total == previous_center:
+            return self.max
+        return previous_mean + (self.max - previous_mean) * (target - previous_center) / (total - previous_center)
+
+    # mean of the values between the low and high quantiles
+    def trimmed_mean(self, low=0.1, high=0.9):
+        self._compress()
+        total = sum(self.weights)
+        if not total:
+            return None
+        start, end = low * total, high * total
+        cumulative = kept = weighted = 0
+        for mean, weight in zip(self.means, self.weights):
+            overlap = min(cumulative + weight, end) - max(cumulative, start)
+            if overlap > 0:
+                kept += overlap
+                weighted += overlap * mean
+            cumulative += weight
+        return weighted / kept if kept else self.quantile(0.5)
+
+    def to_bytes(self):
+        self._compress()
+        values = array('d', [self.compression, self.min, self.max])
+        for mean, weight in zip(self.means, self.weights):
+            values.extend((mean, weight))
+        return values.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        values = array('d')
+        values.frombytes(data)
+        digest = cls(values[0])
+        digest.min, digest.max = values[1], values[2]
+        digest.means = list(values[3::2])
+        digest.weights = list(values[4::2])
+        return digest
+
+
+def setup_price_sketches(conn):
+    c = conn.cursor()
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS price_sketches (
+            city_id INTEGER,
+            car_id INTEGER,
+            count INTEGER,
+            total_cents INTEGER,
+            sketch BLOB,
+            PRIMARY KEY (city_id, car_id),
+            FOREIGN KEY (city_id) REFERENCES cities(id),
+            FOREIGN KEY (car_id) REFERENCES cars(id)
+        )
+    ''')
+    # prices scraped before the sketches existed are folded in once
+    c.execute('SELECT EXISTS (SELECT 1 FROM price_sketches)')
+    if not c.fetchone()[0]:
+        rebuild_price_sketches(conn)
+
+
+# adds newly stored prices (in cents) to the (city_id, car_id) sketch
+def update_price_sketch(conn, city_id, car_id, prices_cents):
+    if not prices_cents:
+        return
+    with transaction(conn):
+        c = conn.cursor()
+        c.execute('SELECT sketch FROM price_sketches WHERE city_id = ? AND car_id = ?', (city_id, car_id))
+        row = c.fetchone()
+        digest = TDigest.from_bytes(row[0]) if row else TDigest()
+        for cents in prices_cents:
+            digest.add(cents)
+        c.execute('''
+            INSERT INTO price_sketches (city_id, car_id, count, total_cents, sketch) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (city_id, car_id) DO UPDATE SET
+                count = count + excluded.count,
+                total_cents = total_cents + excluded.total_cents,
+                sketch = excluded.sketch
+        ''', (city_id, car_id, len(prices_cents), sum(prices_cents), digest.to_bytes()))
+
+
+# builds every sketch from prices in one ordered pass, holding one sketch at a time
+def rebuild_price_sketches(conn=None):
+    conn = conn or get_connection()
+    with transaction(conn):
+        c = conn.cursor()
+        c.execute('DELETE FROM price_sketches')
+        rows = conn.execute('SELECT city_id, car_id, price_cents FROM prices ORDER BY city_id, car_id')
+        key, digest, count, total = None, None, 0, 0
+        written = 0
+        for city_id, car_id, cents in rows:
+            if (city_id, car_id) != key:
+                if key is not None:
+                    c.execute('INSERT INTO price_sketches VALUES (?, ?, ?, ?, ?)', key + (count, total, digest.to_bytes()))
+                    written += 1
+                key, digest, count, total = (city_id, car_id), TDigest(), 0, 0
+            digest.add(cents)
+            count += 1
+            total += cents
+        if key is not None:
+            c.execute('INSERT INTO price_sketches VALUES (?, ?, ?, ?, ?)', key + (count, total, digest.to_bytes()))
+            written += 1
+    return written
+
+
+# (city_id, state, make, model, year, count, total_cents, digest) for every sketch
+def fetch_sketch_groups(conn=None, city_ids=None):
+    c = (conn or get_connection()).cursor()
+    where = ''
+    params = ()
+    if city_ids is not None:
+        city_ids = list(city_ids)
+        where = f"WHERE s.city_id IN ({', '.join('?' * len(city_ids))})"
+        params = tuple(city_ids)
+    c.execute(f'''
+        SELECT s.city_id, cities.state, cars.make, cars.model, cars.year, s.count, s.total_cents, s.sketch
+        FROM price_sketches s
+        JOIN cars ON s.car_id = cars.id
+        JOIN cities ON s.city_id = cities.id
+        {where}
+    ''', params)
+    return [row[:7] + (TDigest.from_bytes(row[7]),) for row in c.fetchall()]
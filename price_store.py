@@ -0,0 +1,64 @@
+# listing prices are stored as integer cents so averages and percentiles can be
+# computed by SQLite instead of parsing '23,990' style strings in Python
+
+import re
+
+from db import transaction
+
+
+def parse_price_cents(price):
+    if price is None:
+        return None
+    if isinstance(price, (int, float)):
+        return int(round(price * 100))
+    digits = re.sub(r'[^\d.]', '', price)
+    if digits in ('', '.'):
+        return None
+    try:
+        return int(round(float(digits) * 100))
+    except ValueError:
+        return None
+
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+
+# one time rebuild of the old TEXT price column into price_cents. rows that do not
+# contain a number are dropped, the same rows the old averages could not have parsed
+def migrate_prices_to_cents(conn):
+    columns = _columns(conn, 'prices')
+    if 'price_cents' in columns or 'price' not in columns:
+        return False
+
+    conn.create_function('parse_price_cents', 1, parse_price_cents, deterministic=True)
+    with transaction(conn):
+        _rebuild_prices(conn.cursor())
+    return True
+
+def _rebuild_prices(c):
+    c.execute('''CREATE TABLE prices_migrated
+                 (id INTEGER PRIMARY KEY, car_id INTEGER, city_id INTEGER, price_cents INTEGER NOT NULL,
+                  FOREIGN KEY(car_id) REFERENCES cars(id),
+                  FOREIGN KEY(city_id) REFERENCES cities(id),
+                  UNIQUE(car_id, city_id, price_cents))''')
+    c.execute('''
+        INSERT OR IGNORE INTO prices_migrated (id, car_id, city_id, price_cents)
+        SELECT id, car_id, city_id, parse_price_cents(price) FROM prices
+        WHERE parse_price_cents(price) IS NOT NULL
+        ORDER BY id''')
+    c.execute('DROP TABLE prices')
+    c.execute('ALTER TABLE prices_migrated RENAME TO prices')
+
+
+def setup_price_storage(conn):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS prices
+                 (id INTEGER PRIMARY KEY, car_id INTEGER, city_id INTEGER, price_cents INTEGER NOT NULL,
+                  FOREIGN KEY(car_id) REFERENCES cars(id),
+                  FOREIGN KEY(city_id) REFERENCES cities(id),
+                  UNIQUE(car_id, city_id, price_cents))''')
+    migrate_prices_to_cents(conn)
+    # covering indexes for the per city / per model year aggregates
+    c.execute('CREATE INDEX IF NOT EXISTS idx_prices_city_car ON prices(city_id, car_id, price_cents)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_cars_year ON cars(year, id)')
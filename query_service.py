@@ -0,0 +1,315 @@
+# local read-only json api over unified_data.db for dashboards
+#
+#   python query_service.py --port 8780
+#   curl 'http://127.0.0.1:8780/depreciation?level=model&make=toyota'
+#
+# endpoints (every filter is optional and may be repeated):
+#   /cities                                     cities with their climate averages
+#   /depreciation?level=city&city_id=3          car_depreciation
+#   /depreciation?level=model|city_model        model_depreciation (&make= &model= &city_id= &statistic=)
+#   /combined                                   depreciation next to climate, the rows of analysis.fetch_combined_data
+#   /climate/<window>?city_id=3&metric=freeze_days&since=2020-01-01
+#                                               climate_aggregates of one window (month, season, year, rolling30...)
+#   /health
+#
+# the service only reads: climate aggregates are as fresh as the last refresh by the
+# pipeline or analysis.fetch_window_data
+#
+# responses are built once and kept in memory with their ETag, so repeated requests
+# cost a dict lookup, and a client that sends If-None-Match gets a 304 with no body.
+# the cache is checked against the database on every request: PRAGMA data_version on
+# a watcher connection tells (in microseconds) whether anyone committed since the last
+# look, and only then are the watermarks of the tables behind each endpoint read again
+# and the endpoints whose tables changed dropped. queries run on a small pool of
+# read-only connections, so the service never blocks the scraper or the weather
+# loader and can not write by accident
+
+import argparse
+import hashlib
+import json
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import db
+from climate_aggregates import fetch_climate_periods
+from pipeline import table_hash, table_watermark
+
+DEFAULT_PORT = 8780
+POOL_SIZE = 4
+# the weather cell of a city, from before and after city_catalog added weather_city_id
+WEATHER_ID = 'COALESCE(c.weather_city_id, c.id)'
+LEGACY_WEATHER_ID = 'c.id'
+
+# the tables each endpoint reads, and how a change to them is detected. tables whose rows
+# are rewritten or updated in place (integer primary keys, INSERT OR REPLACE, the
+# catalog's UPDATE of the grid columns) are hashed, the others are compared by row count
+# and max rowid
+RESOURCE_TABLES = {
+    'cities': (('cities', 'hash'), ('city_averages', 'hash')),
+    'depreciation': (('car_depreciation', 'hash'), ('model_depreciation', 'watermark')),
+    'combined': (('cities', 'hash'), ('car_depreciation', 'hash'), ('city_averages', 'hash')),
+    # climate_aggregate_state moves whenever aggregates are refreshed
+    'climate': (('climate_aggregate_state', 'hash'),),
+}
+
+
+class ConnectionPool:
+    def __init__(self, path=None, size=POOL_SIZE):
+        self.connections = queue.Queue()
+        for _ in range(size):
+            self.connections.put(db.connect(path, read_only=True))
+
+    @contextmanager
+    def connection(self):
+        conn = self.connections.get()
+        try:
+            yield conn
+        finally:
+            self.connections.put(conn)
+
+    def close(self):
+        while not self.connections.empty():
+            self.connections.get().close()
+
+
+def _rows(conn, query, params=()):
+    c = conn.cursor()
+    c.execute(query, params)
+    columns = [d[0] for d in c.description]
+    return [dict(zip(columns, row)) for row in c.fetchall()]
+
+def _filters(params, allowed):
+    clauses, values = [], []
+    for name, (column, cast) in allowed.items():
+        wanted = params.get(name)
+        if wanted:
+            clauses.append(f"{column} IN ({', '.join('?' * len(wanted))})")
+            values.extend(cast(v) for v in wanted)
+    return clauses, values
+
+def _where(clauses):
+    return f"WHERE {' AND '.join(clauses)}" if clauses else ''
+
+
+def query_cities(conn, params, weather_id=WEATHER_ID):
+    clauses, values = _filters(params, {'city_id': ('c.id', int), 'state': ('c.state', str)})
+    return _rows(conn, f'''
+        SELECT c.id AS city_id, c.city, c.state, c.zip_code, c.latitude, c.longitude,
+               {weather_id} AS weather_city_id,
+               avg.average_temperature_2m, avg.average_relative_humidity_2m,
+               avg.average_windspeed_10m, avg.average_precipitation
+        FROM cities c
+        LEFT JOIN city_averages avg ON avg.city_id = {weather_id}
+        {_where(clauses)}
+        ORDER BY c.id
+    ''', values)
+
+def query_depreciation(conn, params):
+    level = (params.get('level') or ['city'])[0]
+    if level == 'city':
+        clauses, values = _filters(params, {'city_id': ('city_id', int), 'state': ('state', str)})
+        return _rows(conn, f'''
+            SELECT city_id, city, state, depreciation, avg_new_price, avg_old_price
+            FROM car_depreciation {_where(clauses)} ORDER BY city_id
+        ''', values)
+    if level not in ('model', 'city_model'):
+        raise ValueError(f"Unknown level {level!r}, expected city, model or city_model")
+    clauses, values = _filters(params, {'city_id': ('city_id', int), 'make': ('make', str), 'model': ('model', str),
+                                        'statistic': ('statistic', str)})
+    # city_id 0 holds the all-cities figure of a model
+    clauses.append('city_id = 0' if level == 'model' else 'city_id <> 0')
+    return _rows(conn, f'''
+        SELECT city_id, make, model, new_year, old_year, statistic, depreciation, avg_new_price, avg_old_price,
+               new_listings, old_listings
+        FROM model_depreciation {_where(clauses)} ORDER BY city_id, make, model, new_year, old_year, statistic
+    ''', values)
+
+def query_combined(conn, params, weather_id=WEATHER_ID):
+    clauses, values = _filters(params, {'city_id': ('c.id', int), 'state': ('c.state', str)})
+    return _rows(conn, f'''
+        SELECT c.id AS city_id, c.city, c.state,
+               avg.average_temperature_2m AS avg_temp,
+               avg.average_relative_humidity_2m AS avg_humidity,
+               avg.average_windspeed_10m AS avg_windspeed,
+               avg.average_precipitation AS avg_precip,
+               dep.depreciation, dep.avg_new_price, dep.avg_old_price
+        FROM car_depreciation dep
+        JOIN cities c ON dep.city_id = c.id
+        JOIN city_averages avg ON avg.city_id = {weather_id}
+        {_where(clauses)}
+        ORDER BY c.id
+    ''', values)
+
+# one object per (city, period) with the metrics as a nested object
+def query_climate(conn, params, window):
+    return fetch_climate_periods(window, params.get('metric'), [int(v) for v in params.get('city_id', [])],
+                                 (params.get('since') or [None])[0], conn)
+
+
+# the query and the invalidation resource of a request path. weather_id is the
+# expression for a city's weather cell in the database being served
+def route(path, weather_id=WEATHER_ID):
+    parts = [p for p in path.split('/') if p]
+    if parts == ['cities']:
+        return 'cities', lambda conn, params: query_cities(conn, params, weather_id)
+    if parts == ['depreciation']:
+        return 'depreciation', query_depreciation
+    if parts == ['combined']:
+        return 'combined', lambda conn, params: query_combined(conn, params, weather_id)
+    if len(parts) == 2 and parts[0] == 'climate':
+        return 'climate', lambda conn, params: query_climate(conn, params, parts[1])
+    return None, None
+
+
+class QueryService:
+    def __init__(self, path=None, pool_size=POOL_SIZE):
+        self.pool = ConnectionPool(path, pool_size)
+        self.watcher = db.connect(path, read_only=True)
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.data_version = None
+        self.versions = {}
+        self.hits = self.misses = 0
+        self.weather_id = self._weather_id()
+
+    # the service can not migrate the schema, a database that never went through
+    # city_catalog.setup_city_catalog has no weather_city_id and every city is its own cell
+    def _weather_id(self):
+        columns = [row[1] for row in self.watcher.execute('PRAGMA table_info(cities)')]
+        return WEATHER_ID if 'weather_city_id' in columns else LEGACY_WEATHER_ID
+
+    def _table_version(self, table, kind):
+        if kind == 'hash':
+            return table_hash(self.watcher, table, 'rowid')
+        return table_watermark(self.watcher, table)
+
+    # drops the cached responses of every resource whose tables changed since the last
+    # call. costs one pragma when nothing was committed in between
+    def check(self):
+        with self.lock:
+            version = self.watcher.execute('PRAGMA data_version').fetchone()[0]
+            if version == self.data_version:
+                return
+            self.data_version = version
+            weather_id = self._weather_id()
+            if weather_id != self.weather_id:
+                # the catalog was migrated while serving
+                self.weather_id = weather_id
+                self.versions.clear()
+                self.cache.clear()
+            tables = {}
+            for resource, sources in RESOURCE_TABLES.items():
+                current = [tables.setdefault(table, self._table_version(table, kind)) for table, kind in sources]
+                if self.versions.get(resource) != current:
+                    self.versions[resource] = current
+                    for key in [key for key in self.cache if key[0] == resource]:
+                        del self.cache[key]
+
+    # (etag, json body) of a request, from the cache when possible
+    def get(self, path, query):
+        resource, handler = route(path, self.weather_id)
+        if resource is None:
+            raise LookupError(path)
+        params = parse_qs(query)
+        key = (resource, path, tuple(sorted((k, tuple(v)) for k, v in params.items())))
+        self.check()
+        with self.lock:
+            token = self.versions.get(resource)
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.hits += 1
+                return cached
+            self.misses += 1
+        with self.pool.connection() as conn:
+            rows = handler(conn, params)
+        body = json.dumps(rows, separators=(',', ':')).encode('utf-8')
+        entry = (f'"{hashlib.sha1(body).hexdigest()}"', body)
+        with self.lock:
+            # a check() from another request may have seen newer tables while the query
+            # ran, then this answer is not cached
+            if self.versions.get(resource) is token:
+                self.cache[key] = entry
+        return entry
+
+    def health(self):
+        with self.lock:
+            return {'status': 'ok', 'data_version': self.data_version, 'cached': len(self.cache),
+                    'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        self.pool.close()
+        self.watcher.close()
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out as separate writes, with Nagle on the body waits for the
+    # client's delayed ack (40ms per keep-alive request)
+    disable_nagle_algorithm = True
+    service = None
+
+    def _send(self, status, body=b'', etag=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if etag:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path.rstrip('/') == '/health':
+            self._send(200, json.dumps(self.service.health()).encode('utf-8'))
+            return
+        try:
+            etag, body = self.service.get(url.path, url.query)
+        except LookupError:
+            self._send(404, json.dumps({'error': f"no such endpoint {url.path}"}).encode('utf-8'))
+            return
+        except ValueError as e:
+            self._send(400, json.dumps({'error': str(e)}).encode('utf-8'))
+            return
+        except sqlite3.Error as e:
+            # a table or column the pipeline has not created yet, e.g. "no such table:
+            # climate_aggregates" before the first aggregate refresh
+            self._send(503, json.dumps({'error': f"database not ready: {e}"}).encode('utf-8'))
+            return
+        if etag in (self.headers.get('If-None-Match') or ''):
+            self._send(304, etag=etag)
+        else:
+            self._send(200, body, etag)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=DEFAULT_PORT, path=None, pool_size=POOL_SIZE, host='127.0.0.1'):
+    service = QueryService(path, pool_size)
+    handler = type('Handler', (QueryHandler,), {'service': service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve depreciation and climate aggregates from unified_data.db as JSON")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--db', help="database file (default unified_data.db or $UNIFIED_DB)")
+    parser.add_argument('--pool-size', type=int, default=POOL_SIZE, help="read-only connections")
+    args = parser.parse_args()
+    server = serve(args.port, args.db, args.pool_size, args.host)
+    print(f"Serving on http://{args.host}:{server.server_address[1]}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()